@@ -0,0 +1,152 @@
+import asyncio
+
+import pytest
+import pytest_asyncio
+from aiohttp import web
+
+from audio import utils
+from audio.transcription import TranscriptionClient
+from audio.utils import TranscriptionError
+from resilience import Policy
+from shared_state import SharedState
+
+
+class FakeAssemblyAI:
+    """Local stand-in for the AssemblyAI transcript endpoints."""
+
+    def __init__(self, processing_polls=2, final_status="completed", failures=0):
+        self.processing_polls = processing_polls
+        self.final_status = final_status
+        self.failures = failures
+        self.polls = 0
+        self.requests = []
+
+    async def transcript(self, request):
+        self.requests.append(await request.json())
+        if self.failures:
+            self.failures -= 1
+            return web.json_response({"error": "unavailable"}, status=503)
+        return web.json_response({"id": "t1", "status": "queued"})
+
+    async def status(self, request):
+        self.polls += 1
+        if self.polls <= self.processing_polls:
+            return web.json_response({"id": "t1", "status": "processing"})
+        return web.json_response(
+            {"id": "t1", "status": self.final_status, "error": "bad audio"}
+        )
+
+    async def paragraphs(self, request):
+        return web.json_response({"paragraphs": [{"text": "bonjour whatia"}]})
+
+
+@pytest_asyncio.fixture
+async def fake_assemblyai(monkeypatch):
+    # Read by the clients when they are created
+    monkeypatch.setenv("ASSEMBLYAI_API_KEY", "test")
+    fake = FakeAssemblyAI()
+    app = web.Application()
+    app.router.add_post("/v2/transcript", fake.transcript)
+    app.router.add_get("/v2/transcript/{id}", fake.status)
+    app.router.add_get("/v2/transcript/{id}/paragraphs", fake.paragraphs)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    monkeypatch.setattr(
+        utils, "transcript_endpoint", f"http://127.0.0.1:{port}/v2/transcript"
+    )
+    yield fake
+    await runner.cleanup()
+
+
+@pytest_asyncio.fixture
+async def transcriber(fake_assemblyai):
+    client = TranscriptionClient(timeout=5)
+    await client.start()
+    yield client
+    await client.stop()
+
+
+@pytest.mark.asyncio
+async def test_polls_until_completed(fake_assemblyai, transcriber):
+    text = await transcriber.audio_to_text("https://media/voice.ogg")
+
+    assert text == "bonjour whatia"
+    assert fake_assemblyai.polls == 3
+    assert fake_assemblyai.requests[0]["audio_url"] == "https://media/voice.ogg"
+
+
+@pytest.mark.asyncio
+async def test_failed_transcript_raises(fake_assemblyai, transcriber):
+    fake_assemblyai.final_status = "error"
+
+    with pytest.raises(TranscriptionError):
+        await transcriber.audio_to_text("https://media/voice.ogg")
+
+
+@pytest.mark.asyncio
+async def test_overall_timeout(fake_assemblyai, transcriber):
+    fake_assemblyai.processing_polls = 1000
+    transcriber.timeout = 1
+
+    with pytest.raises(asyncio.TimeoutError):
+        await transcriber.audio_to_text("https://media/voice.ogg")
+
+
+@pytest.mark.asyncio
+async def test_webhook_wakes_up_the_wait(fake_assemblyai, transcriber):
+    fake_assemblyai.processing_polls = 1
+    transcriber.webhook_url = "https://whatia/transcription"
+    transcriber.webhook_secret = "secret"
+    # Without the callback, the second poll would only happen after 5s
+    start = asyncio.get_running_loop().time()
+
+    async def callback():
+        await asyncio.sleep(0.2)
+        assert not await transcriber.notify("t1", "completed", secret="wrong")
+        assert await transcriber.notify("t1", "completed", secret="secret")
+
+    text, _ = await asyncio.gather(
+        transcriber.audio_to_text("https://media/voice.ogg"), callback()
+    )
+
+    assert text == "bonjour whatia"
+    assert asyncio.get_running_loop().time() - start < 2
+    assert fake_assemblyai.requests[0]["webhook_url"] == "https://whatia/transcription"
+
+
+@pytest.mark.asyncio
+async def test_webhook_received_by_another_process_wakes_up_the_wait(
+    fake_assemblyai, tmp_path
+):
+    fake_assemblyai.processing_polls = 1
+    state = SharedState(str(tmp_path / "state.sqlite3"))
+    # The worker waiting for the transcript, and the one receiving the callback
+    waiting, receiving = (
+        TranscriptionClient(timeout=5, webhook_url="https://whatia/transcription", state=state)
+        for _ in range(2)
+    )
+    await waiting.start()
+    start = asyncio.get_running_loop().time()
+
+    async def callback():
+        await asyncio.sleep(0.2)
+        assert await receiving.notify("t1", "completed")
+
+    text, _ = await asyncio.gather(waiting.audio_to_text("https://media/voice.ogg"), callback())
+    await waiting.stop()
+    state.close()
+
+    assert text == "bonjour whatia"
+    assert asyncio.get_running_loop().time() - start < 2
+
+
+@pytest.mark.asyncio
+async def test_unavailable_upstream_is_retried(fake_assemblyai, transcriber):
+    fake_assemblyai.failures = 2
+    transcriber.policy = Policy("assemblyai", timeout=1, retries=2, backoff=0.01)
+
+    assert await transcriber.audio_to_text("https://media/voice.ogg") == "bonjour whatia"
+    assert len(fake_assemblyai.requests) == 3
@@ -1,10 +1,31 @@
+import asyncio
+import logging
 import os
 
+import aiohttp
+
 from audio import utils
+from rate_limiter import AsyncRateLimiter
+from resilience import CircuitBreaker, Policy
 from utils import load_config
 
 load_config()
 
+logger = logging.getLogger(__name__)
+
+MAX_CALLS_PER_MINUTE = 60
+WEBHOOK_AUTH_HEADER = "X-Whatia-Webhook-Secret"
+# Seconds between two looks for a completion received by another process
+SHARED_COMPLETION_INTERVAL = 0.25
+
+transcription_limiter = AsyncRateLimiter(
+    "transcription", requests_per_minute=MAX_CALLS_PER_MINUTE
+)
+# Each request to AssemblyAI, the whole transcription is bounded by `timeout`
+transcription_policy = Policy(
+    "assemblyai", timeout=30, retries=2, breaker=CircuitBreaker("assemblyai")
+)
+
 
 def audio_to_text(media_url):
     # Create header with authorization along with content-type
@@ -30,5 +51,151 @@ def audio_to_text(media_url):
     return paragraphs[0]["text"]
 
 
+class TranscriptionClient:
+    """
+    Non-blocking AssemblyAI client sharing one connection pool between calls.
+
+    Completion is detected by polling with a growing delay. When `webhook_url`
+    is given, AssemblyAI is also asked to call it back on completion, and the
+    route receiving the callback wakes the waiting call up through `notify`.
+    With several worker processes, the callback may reach another process than
+    the one waiting: the completion is then recorded in the `SharedState`,
+    where the waiting process looks for it.
+
+    Args:
+        timeout (float): Overall deadline of a transcription, in seconds.
+        webhook_url (str, optional): Public URL of the completion webhook route.
+        webhook_secret (str, optional): Value expected in WEBHOOK_AUTH_HEADER.
+        max_connections (int): Size of the connection pool, when the client opens its own.
+        policy (Policy, optional): Policy of the requests, `transcription_policy` by default.
+        state (SharedState, optional): State shared with the other processes.
+    """
+
+    def __init__(
+        self,
+        timeout=120,
+        webhook_url=None,
+        webhook_secret=None,
+        max_connections=10,
+        policy=None,
+        state=None,
+    ):
+        self.timeout = timeout
+        self.state = state
+        self.policy = policy or transcription_policy
+        self.webhook_url = webhook_url
+        self.webhook_secret = webhook_secret
+        self.max_connections = max_connections
+        self.header = {
+            "authorization": os.getenv("ASSEMBLYAI_API_KEY"),
+            "content-type": "application/json",
+        }
+        self._session = None
+        self._owns_session = False
+        self._completed = {}
+
+    async def start(self, session=None):
+        """
+        Args:
+            session (aiohttp.ClientSession, optional): Shared session, the client
+                otherwise opens and closes its own.
+        """
+        self._owns_session = session is None
+        self._session = session or aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_connections),
+            timeout=aiohttp.ClientTimeout(total=30),
+        )
+
+    async def stop(self):
+        if self._owns_session:
+            await self._session.close()
+        self._session = None
+
+    async def notify(self, transcript_id, status, secret=None):
+        """
+        Called by the completion webhook route.
+
+        Returns:
+            bool: False if the call is not authenticated.
+        """
+        if self.webhook_secret and secret != self.webhook_secret:
+            return False
+        completed = self._completed.get(transcript_id)
+        if completed is not None:
+            logger.info(f"Transcript {transcript_id} is {status}")
+            completed.set()
+        elif self.state is not None:
+            # Waited for by another process, if any
+            await self.state.call("remember", self._completion(transcript_id))
+        return True
+
+    def _completion(self, transcript_id):
+        return f"transcript:{transcript_id}"
+
+    async def _watch(self, transcript_id, completed):
+        """Set `completed` once another process received the callback."""
+        while not await self.state.call("known", self._completion(transcript_id)):
+            await asyncio.sleep(SHARED_COMPLETION_INTERVAL)
+        logger.info(f"Transcript {transcript_id} is done, according to another process")
+        completed.set()
+
+    async def audio_to_text(self, media_url):
+        """
+        Transcribe the audio at `media_url`.
+
+        Raises:
+            asyncio.TimeoutError: If the transcription is not done within `timeout`.
+            audio.utils.TranscriptionError: If AssemblyAI failed to transcribe.
+            aiohttp.ClientError: If AssemblyAI could not be reached.
+            CircuitOpenError: If AssemblyAI has been failing, without calling it.
+        """
+        await transcription_limiter.acquire()
+        return await asyncio.wait_for(self._transcribe(media_url), self.timeout)
+
+    async def _transcribe(self, media_url):
+        webhook = None
+        first_delay, max_delay = 0.5, 5
+        if self.webhook_url:
+            webhook = {"webhook_url": self.webhook_url}
+            if self.webhook_secret:
+                webhook["webhook_auth_header_name"] = WEBHOOK_AUTH_HEADER
+                webhook["webhook_auth_header_value"] = self.webhook_secret
+            # Polling is only a safety net for lost callbacks
+            first_delay, max_delay = 5, 15
+
+        transcript_response = await self.policy.call(
+            lambda: utils.async_request_transcript(
+                self._session, {"upload_url": media_url}, self.header, webhook
+            )
+        )
+        transcript_id = transcript_response["id"]
+        polling_endpoint = utils.make_polling_endpoint(transcript_response)
+
+        completed = asyncio.Event() if self.webhook_url else None
+        self._completed[transcript_id] = completed
+        watcher = None
+        if completed is not None and self.state is not None:
+            watcher = asyncio.ensure_future(self._watch(transcript_id, completed))
+        try:
+            await utils.async_wait_for_completion(
+                self._session,
+                polling_endpoint,
+                self.header,
+                first_delay=first_delay,
+                max_delay=max_delay,
+                completed=completed,
+                policy=self.policy,
+            )
+        finally:
+            del self._completed[transcript_id]
+            if watcher is not None:
+                watcher.cancel()
+
+        paragraphs = await self.policy.call(
+            lambda: utils.async_get_paragraphs(self._session, polling_endpoint, self.header)
+        )
+        return paragraphs[0]["text"]
+
+
 if __name__ == "__main__":
     res = audio_to_text(media_url=None)
@@ -1,9 +1,21 @@
+import asyncio
+import os
 import time
 
 import requests
 
-upload_endpoint = "https://api.assemblyai.com/v2/upload"
-transcript_endpoint = "https://api.assemblyai.com/v2/transcript"
+# Overridable so that the async client can be pointed at a local fake AssemblyAI
+api_url = os.getenv("ASSEMBLYAI_API_URL", "https://api.assemblyai.com")
+upload_endpoint = f"{api_url}/v2/upload"
+transcript_endpoint = f"{api_url}/v2/transcript"
+
+# Connections kept alive between the calls of the synchronous helpers
+http = requests.Session()
+TIMEOUT = 30
+
+
+class TranscriptionError(Exception):
+    pass
 
 
 # Helper for `upload_file()`
@@ -18,8 +30,8 @@ def _read_file(filename, chunk_size=5242880):
 
 # Uploads a file to AAI servers
 def upload_file(audio_file, header):
-    upload_response = requests.post(
-        upload_endpoint, headers=header, data=_read_file(audio_file)
+    upload_response = http.post(
+        upload_endpoint, headers=header, data=_read_file(audio_file), timeout=TIMEOUT
     )
     return upload_response.json()
 
@@ -27,15 +39,15 @@ def upload_file(audio_file, header):
 # Request transcript for file uploaded to AAI servers
 def request_transcript(upload_url, header):
     transcript_request = {"audio_url": upload_url["upload_url"], "language_code": "fr"}
-    transcript_response = requests.post(
-        transcript_endpoint, json=transcript_request, headers=header
+    transcript_response = http.post(
+        transcript_endpoint, json=transcript_request, headers=header, timeout=TIMEOUT
     )
     return transcript_response.json()
 
 
 # Make a polling endpoint
 def make_polling_endpoint(transcript_response):
-    polling_endpoint = "https://api.assemblyai.com/v2/transcript/"
+    polling_endpoint = f"{transcript_endpoint}/"
     polling_endpoint += transcript_response["id"]
     return polling_endpoint
 
@@ -43,7 +55,7 @@ def make_polling_endpoint(transcript_response):
 # Wait for the transcript to finish
 def wait_for_completion(polling_endpoint, header):
     while True:
-        polling_response = requests.get(polling_endpoint, headers=header)
+        polling_response = http.get(polling_endpoint, headers=header, timeout=TIMEOUT)
         polling_response = polling_response.json()
 
         if polling_response["status"] == "completed":
@@ -54,7 +66,9 @@ def wait_for_completion(polling_endpoint, header):
 
 # Get the paragraphs of the transcript
 def get_paragraphs(polling_endpoint, header):
-    paragraphs_response = requests.get(polling_endpoint + "/paragraphs", headers=header)
+    paragraphs_response = http.get(
+        polling_endpoint + "/paragraphs", headers=header, timeout=TIMEOUT
+    )
     paragraphs_response = paragraphs_response.json()
 
     paragraphs = []
@@ -62,3 +76,74 @@ def get_paragraphs(polling_endpoint, header):
         paragraphs.append(para)
 
     return paragraphs
+
+
+# Async counterparts of the helpers above, sharing the caller's aiohttp session
+
+
+async def async_request_transcript(session, upload_url, header, webhook=None):
+    transcript_request = {"audio_url": upload_url["upload_url"], "language_code": "fr"}
+    if webhook is not None:
+        transcript_request.update(webhook)
+    async with session.post(
+        transcript_endpoint, json=transcript_request, headers=header
+    ) as response:
+        response.raise_for_status()
+        return await response.json()
+
+
+async def async_get_status(session, polling_endpoint, header):
+    async with session.get(polling_endpoint, headers=header) as response:
+        response.raise_for_status()
+        polling_response = await response.json()
+
+    if polling_response["status"] == "error":
+        raise TranscriptionError(polling_response.get("error"))
+    return polling_response["status"]
+
+
+async def async_wait_for_completion(
+    session,
+    polling_endpoint,
+    header,
+    first_delay=0.5,
+    max_delay=5,
+    completed=None,
+    policy=None,
+):
+    """
+    Poll the transcript until it is completed, waiting `first_delay` seconds
+    first and backing off up to `max_delay` seconds between two polls.
+
+    Args:
+        completed (asyncio.Event, optional): Set when a completion webhook is
+            received, to stop waiting before the next poll.
+        policy (resilience.Policy, optional): Policy each poll is made under.
+    """
+
+    async def get_status():
+        return await async_get_status(session, polling_endpoint, header)
+
+    delay = first_delay
+    while True:
+        status = await (policy.call(get_status) if policy is not None else get_status())
+        if status == "completed":
+            return
+
+        if completed is None:
+            await asyncio.sleep(delay)
+        else:
+            try:
+                await asyncio.wait_for(completed.wait(), delay)
+                completed.clear()
+            except asyncio.TimeoutError:
+                pass
+        delay = min(delay * 1.5, max_delay)
+
+
+async def async_get_paragraphs(session, polling_endpoint, header):
+    async with session.get(polling_endpoint + "/paragraphs", headers=header) as response:
+        response.raise_for_status()
+        paragraphs_response = await response.json()
+
+    return paragraphs_response["paragraphs"]
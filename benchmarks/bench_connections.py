@@ -0,0 +1,128 @@
+"""
+Latency of sequential HTTPS calls opening a new connection each time, as the
+integrations used to do, versus reusing the keep-alive pool of `ClientPool`.
+
+    python -m benchmarks.bench_connections --requests 200
+    python -m benchmarks.bench_connections --requests 50 --url https://api.twilio.com
+
+By default the calls go to a local HTTPS server with a self-signed certificate,
+so the difference is only the TCP and TLS handshakes; against a remote API it
+also includes the network round trips of the handshakes.
+"""
+import argparse
+import asyncio
+import datetime
+import ssl
+import statistics
+import tempfile
+import time
+
+import aiohttp
+from aiohttp import web
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+from http_clients import ClientPool
+
+
+def make_certificate(directory):
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now)
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .sign(key, hashes.SHA256())
+    )
+    cert_file, key_file = f"{directory}/cert.pem", f"{directory}/key.pem"
+    with open(cert_file, "wb") as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(key_file, "wb") as f:
+        f.write(
+            key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption(),
+            )
+        )
+    return cert_file, key_file
+
+
+async def start_server(directory):
+    async def handler(request):
+        return web.json_response({"status": "ok"})
+
+    app = web.Application()
+    app.router.add_get("/", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(*make_certificate(directory))
+    site = web.TCPSite(runner, "127.0.0.1", 0, ssl_context=context)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"https://127.0.0.1:{port}/"
+
+
+async def timed(session, url, verify):
+    start = time.perf_counter()
+    async with session.get(url, ssl=None if verify else False) as response:
+        await response.read()
+    return time.perf_counter() - start
+
+
+async def new_connection_per_call(url, nb_requests, verify):
+    latencies = []
+    for _ in range(nb_requests):
+        start = time.perf_counter()
+        async with aiohttp.ClientSession() as session:
+            await timed(session, url, verify)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+async def pooled(url, nb_requests, verify):
+    pool = ClientPool()
+    session = pool.session("twilio")
+    await timed(session, url, verify)
+    latencies = [await timed(session, url, verify) for _ in range(nb_requests)]
+    await pool.stop()
+    return latencies
+
+
+def report(label, latencies):
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(
+        f"{label:<25} mean {statistics.mean(latencies) * 1000:7.2f} ms"
+        f"  p50 {statistics.median(latencies) * 1000:7.2f} ms  p95 {p95 * 1000:7.2f} ms"
+    )
+
+
+async def main(args):
+    with tempfile.TemporaryDirectory() as directory:
+        runner = None
+        url, verify = args.url, True
+        if url is None:
+            runner, url = await start_server(directory)
+            verify = False
+
+        report("new connection per call", await new_connection_per_call(url, args.requests, verify))
+        report("shared keep-alive pool", await pooled(url, args.requests, verify))
+
+        if runner is not None:
+            await runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--url", help="Remote URL to call instead of the local server")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,228 @@
+"""
+Offline end-to-end load test of the bot.
+
+The app runs in-process behind an ASGI transport, with its users and Stripe
+events in memory and every upstream API replaced by `FakeUpstreams`. For each
+concurrency level, that many simulated users first subscribe through signed
+Stripe events posted to `/webhook`, then each sends `--messages` WhatsApp
+messages to `/bot`, one after the other, waiting for the answer to the
+previous one.
+
+    python -m benchmarks.bench_load --concurrency 1 10 50 --messages 5 --llm-latency 0.5
+
+Reported per level, as p50/p95/p99 in milliseconds:
+- webhook: time to acknowledge a Stripe event
+- ack: time to acknowledge a Twilio message, which grows when the event loop
+  is blocked
+- answer: time from posting a message to the end of its answer reaching Twilio
+and the throughput in answered messages per second.
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import math
+import os
+import time
+import uuid
+
+os.environ.setdefault("ENV_WHATIA", "DEVELOPMENT")
+for name, value in {
+    "DATABASE_URI": "mongodb://localhost:27017",
+    "OPENAI_API_KEY": "sk-load-test",
+    "TWILIO_ACCOUNT_SID": "ACloadtest",
+    "TWILIO_AUTH_TOKEN": "load-test",
+    "TWILIO_PHONE_NUMBER": "+15550000000",
+    "STRIPE_SECRET_KEY": "sk_test_load_test",
+    "STRIPE_ENDPOINT": "whsec_load_test",
+    "ASSEMBLYAI_API_KEY": "load-test",
+}.items():
+    os.environ.setdefault(name, value)
+
+import httpx  # noqa: E402
+import stripe  # noqa: E402
+
+import chatbot  # noqa: E402
+from audio import transcription  # noqa: E402
+from audio import utils as assemblyai  # noqa: E402
+from benchmarks.fake_mongo import AsyncInMemoryCollection  # noqa: E402
+from benchmarks.fake_upstreams import FakeUpstreams  # noqa: E402
+from chatgpt_api import chatgpt  # noqa: E402
+from mongodb_db import AsyncMessageLog, AsyncStripeEventCollection, AsyncUserCollection  # noqa: E402
+from notifier import send_notification  # noqa: E402
+from rate_limiter import AsyncRateLimiter  # noqa: E402
+from session_cache import UserSessionCache  # noqa: E402
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return "      -       -       -"
+    return " ".join(
+        f"{values[max(math.ceil(p * len(values)) - 1, 0)] * 1000:7.0f}" for p in (0.5, 0.95, 0.99)
+    )
+
+
+def wire(upstreams, args):
+    """Point the app at the fakes, with a fresh in-memory database."""
+    os.environ["OPENAI_BASE_URL"] = f"{upstreams.url}/v1"
+    send_notification.twilio_api_url = upstreams.url
+    assemblyai.transcript_endpoint = f"{upstreams.url}/v2/transcript"
+    stripe.api_base = upstreams.url
+
+    db = {
+        "users": AsyncInMemoryCollection(latency=args.mongo_latency),
+        "stripe_events": AsyncInMemoryCollection(latency=args.mongo_latency),
+        "messages": AsyncInMemoryCollection(latency=args.mongo_latency),
+    }
+    chatbot.users = AsyncUserCollection("users", db=db)
+    chatbot.message_log = AsyncMessageLog(db=db)
+    chatbot.sessions = UserSessionCache(chatbot.users)
+    chatbot.stripe_events = AsyncStripeEventCollection(db=db)
+    chatbot.STREAMING = not args.no_streaming
+    chatbot.delivery.pacing = args.pacing
+    chatbot.turns.debounce = args.debounce
+
+    if not args.keep_rate_limits:
+        chatgpt.chat_limiter = AsyncRateLimiter("chat", 10**9, 10**12)
+        for model in chatgpt.model_limiters:
+            chatgpt.model_limiters[model] = AsyncRateLimiter(f"chat-{model}", 10**9, 10**12)
+        transcription.transcription_limiter = AsyncRateLimiter("transcription", 10**9)
+
+
+def signed_event(event_type, object_):
+    payload = json.dumps(
+        {
+            "id": f"evt_{uuid.uuid4().hex}",
+            "object": "event",
+            "type": event_type,
+            "data": {"object": object_},
+        }
+    )
+    timestamp = int(time.time())
+    signature = hmac.new(
+        chatbot.stripe_keys["endpoint_secret"].encode(),
+        f"{timestamp}.{payload}".encode(),
+        hashlib.sha256,
+    ).hexdigest()
+    return payload, {"Stripe-Signature": f"t={timestamp},v1={signature}"}
+
+
+async def subscribe(client, phone_number, latencies):
+    payload, headers = signed_event(
+        "customer.subscription.created",
+        {
+            "object": "subscription",
+            "customer": "cus_" + phone_number.lstrip("+"),
+            "current_period_end": time.time() + 30 * 86400,
+        },
+    )
+    start = time.perf_counter()
+    response = await client.post("/webhook", content=payload, headers=headers)
+    latencies.append(time.perf_counter() - start)
+    response.raise_for_status()
+
+
+async def converse(client, upstreams, phone_number, args, results):
+    for i in range(args.messages):
+        form = {"From": f"whatsapp:{phone_number}", "MessageSid": f"SM{uuid.uuid4().hex}"}
+        if args.audio_every and (i + 1) % args.audio_every == 0:
+            form.update(
+                {"Body": "", "MediaUrl0": f"{upstreams.url}/media.ogg", "MediaContentType0": "audio/ogg"}
+            )
+        else:
+            form["Body"] = f"Question {i} de {phone_number} : comment marche un moteur ?"
+
+        answered = upstreams.wait_for_message(phone_number, upstreams.answer.split()[-1])
+        start = time.perf_counter()
+        response = await client.post("/bot", data=form)
+        results["ack"].append(time.perf_counter() - start)
+        response.raise_for_status()
+        try:
+            await asyncio.wait_for(answered, args.timeout)
+        except asyncio.TimeoutError:
+            results["timeouts"] += 1
+            continue
+        results["answer"].append(time.perf_counter() - start)
+
+
+async def run_level(client, upstreams, concurrency, args):
+    wire(upstreams, args)
+    phones = [f"+1555{concurrency:03d}{i:04d}" for i in range(concurrency)]
+    results = {"webhook": [], "ack": [], "answer": [], "timeouts": 0}
+
+    await asyncio.gather(*(subscribe(client, phone, results["webhook"]) for phone in phones))
+    await chatbot.stripe_queue.join()
+    await chatbot.delivery.join()
+
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(converse(client, upstreams, phone, args, results) for phone in phones)
+    )
+    elapsed = time.perf_counter() - start
+    await chatbot.delivery.join()
+
+    print(
+        f"{concurrency:>11} {len(results['answer']):>8} {results['timeouts']:>8}"
+        f" {len(results['answer']) / elapsed:>10.1f}"
+        f"  {percentiles(results['webhook'])}  {percentiles(results['ack'])}"
+        f"  {percentiles(results['answer'])}"
+    )
+
+
+async def main(args):
+    upstreams = FakeUpstreams(
+        llm_latency=args.llm_latency,
+        twilio_latency=args.twilio_latency,
+        transcription_latency=args.transcription_latency,
+        stripe_latency=args.stripe_latency,
+        chat_error_rate=args.chat_error_rate,
+    )
+    await upstreams.start()
+    wire(upstreams, args)
+    if args.turn_workers:
+        chatbot.turns.workers = args.turn_workers
+
+    print(
+        f"{'concurrency':>11} {'answered':>8} {'timeouts':>8} {'msg/s':>10}"
+        f"  {'webhook p50/p95/p99 ms':>23}  {'ack p50/p95/p99 ms':>23}"
+        f"  {'answer p50/p95/p99 ms':>23}"
+    )
+    async with chatbot.lifespan(chatbot.app):
+        transport = httpx.ASGITransport(app=chatbot.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bot") as client:
+            for concurrency in args.concurrency:
+                await run_level(client, upstreams, concurrency, args)
+    await upstreams.stop()
+    if args.chat_error_rate:
+        print(f"Chat completions failed on purpose: {upstreams.chat_errors}/{upstreams.chat_calls}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 5, 10, 25, 50])
+    parser.add_argument("--messages", type=int, default=5, help="Messages sent by each user")
+    parser.add_argument("--audio-every", type=int, default=0, help="Every Nth message is a voice note")
+    parser.add_argument("--llm-latency", type=float, default=0.5)
+    parser.add_argument("--twilio-latency", type=float, default=0.05)
+    parser.add_argument("--transcription-latency", type=float, default=1.0)
+    parser.add_argument("--stripe-latency", type=float, default=0.1)
+    parser.add_argument(
+        "--chat-error-rate", type=float, default=0.0, help="Share of chat completions failing"
+    )
+    parser.add_argument("--mongo-latency", type=float, default=0.002)
+    parser.add_argument("--pacing", type=float, default=0.0, help="Delivery pacing per recipient")
+    parser.add_argument("--debounce", type=float, default=0.0, help="Turn debounce per user")
+    parser.add_argument("--turn-workers", type=int, help="Defaults to TURN_WORKERS")
+    parser.add_argument("--no-streaming", action="store_true")
+    parser.add_argument("--keep-rate-limits", action="store_true")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    if not args.verbose:
+        logging.disable(logging.WARNING)
+    asyncio.run(main(args))
@@ -0,0 +1,97 @@
+"""
+Requests/sec of a `/bot`-like handler doing the usual user lookup, counter
+increment and history update, against a mocked Mongo backend that takes
+`--latency` seconds per round trip.
+
+    python -m benchmarks.bench_mongo --requests 200 --concurrency 50 --latency 0.02
+
+"before" drives the blocking `UserCollection` from inside the async handler,
+"after" drives `AsyncUserCollection`.
+"""
+import argparse
+import asyncio
+import os
+import time
+
+import httpx
+from fastapi import FastAPI
+
+os.environ.setdefault("DATABASE_URI", "mongodb://localhost:27017")
+
+from benchmarks.fake_mongo import AsyncInMemoryCollection, InMemoryCollection  # noqa: E402
+from mongodb_db import AsyncUserCollection, UserCollection  # noqa: E402
+
+
+def make_app(users, is_async):
+    app = FastAPI()
+
+    @app.post("/bot/{phone_number}")
+    async def bot(phone_number: str):
+        if is_async:
+            doc = await users.find_document("phone_number", phone_number)
+            await users.increment_nb_tokens_messages(doc, 10)
+            await users.update_user_history(phone_number, [])
+        else:
+            doc = users.find_document("phone_number", phone_number)
+            users.increment_nb_tokens_messages(doc, 10)
+            users.update_user_history(phone_number, [])
+        return ""
+
+    return app
+
+
+async def run(app, nb_requests, concurrency, nb_users):
+    semaphore = asyncio.Semaphore(concurrency)
+    transport = httpx.ASGITransport(app=app)
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as http:
+
+        async def one(i):
+            async with semaphore:
+                await http.post(f"/bot/+33600000{i % nb_users:03d}")
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(nb_requests)))
+        return nb_requests / (time.perf_counter() - start)
+
+
+async def seed(users, nb_users, is_async):
+    for i in range(nb_users):
+        if is_async:
+            await users.add_user(f"+33600000{i:03d}")
+        else:
+            users.add_user(f"+33600000{i:03d}")
+
+
+async def main(args):
+    sync_users = UserCollection(
+        "users", db={"users": InMemoryCollection(latency=args.latency)}
+    )
+    async_users = AsyncUserCollection(
+        "users", db={"users": AsyncInMemoryCollection(latency=args.latency)}
+    )
+    await seed(sync_users, args.users, is_async=False)
+    await seed(async_users, args.users, is_async=True)
+
+    before = await run(
+        make_app(sync_users, False), args.requests, args.concurrency, args.users
+    )
+    after = await run(
+        make_app(async_users, True), args.requests, args.concurrency, args.users
+    )
+    print(
+        f"latency={args.latency * 1000:.0f}ms concurrency={args.concurrency} "
+        f"requests={args.requests}"
+    )
+    print(f"before (pymongo, blocking): {before:8.1f} req/s")
+    print(f"after  (motor, awaited):    {after:8.1f} req/s")
+    print(f"speedup: x{after / before:.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--users", type=int, default=20)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,58 @@
+"""
+Mongo round trips made by one `/bot` turn, with the per-field calls used before
+and with `get_or_create_user` + `commit_turn`.
+
+    python -m benchmarks.bench_round_trips
+
+Against a real server, `mongodb_db.round_trips` counts the commands sent.
+"""
+import asyncio
+import os
+
+os.environ.setdefault("DATABASE_URI", "mongodb://localhost:27017")
+
+from benchmarks.fake_mongo import AsyncInMemoryCollection  # noqa: E402
+from mongodb_db import AsyncUserCollection  # noqa: E402
+
+FREE_TRIAL_LIMIT = 1
+
+
+async def turn_before(users, phone_number):
+    doc = await users.find_document("phone_number", phone_number)
+    if doc is None:
+        doc_id = await users.add_user(phone_number)
+        doc = await users.get_user(doc_id)
+    if doc["nb_messages"] >= FREE_TRIAL_LIMIT and doc["current_period_end"] is None:
+        await users.block_user(doc["_id"])
+    history = doc["history"] + [{"role": "user", "content": "bonjour"}]
+    await users.increment_nb_tokens_messages(doc, 10)
+    await users.update_user_history(phone_number, history)
+
+
+async def turn_after(users, phone_number):
+    doc, _ = await users.get_or_create_user(phone_number)
+    block = doc["nb_messages"] >= FREE_TRIAL_LIMIT and doc["current_period_end"] is None
+    await users.commit_turn(doc, [{"role": "user", "content": "bonjour"}], 10, block=block)
+
+
+async def count(turn):
+    collection = AsyncInMemoryCollection()
+    users = AsyncUserCollection("users", db={"users": collection})
+    counts = []
+    for _ in range(2):
+        start = collection.round_trips
+        await turn(users, "+33600000001")
+        counts.append(collection.round_trips - start)
+    return counts
+
+
+async def main():
+    before = await count(turn_before)
+    after = await count(turn_after)
+    print("round trips per turn      new user  at trial limit")
+    print(f"before                    {before[0]:8d}  {before[1]:14d}")
+    print(f"after                     {after[0]:8d}  {after[1]:14d}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,69 @@
+"""
+Startup and counting cost of the tokenizer.
+
+    python -m benchmarks.bench_tokenizer --turns 2000
+
+- import: time to `import utils` in a fresh interpreter, which used to load
+  the tiktoken encoding eagerly.
+- count: tokens of the prompt of a turn (system prompt + history + question),
+  encoding every string each time versus `Tokenizer.count_messages` with its
+  memo.
+"""
+import argparse
+import subprocess
+import sys
+import time
+
+import tiktoken
+
+from tokenizer import Tokenizer
+
+SYSTEM_PROMPT = (
+    "WhatIA is an assistant who automatically speaks the language of the person who "
+    "interacts with you. if he changes language, you automatically adopt the new "
+    "language. you answer all questions unless you don't think you have the answer, "
+    "in which case you answer by saying that your answer is less certain."
+)
+
+
+def make_turns(nb_turns):
+    history = [
+        {"role": "user", "content": "Qu'est-ce que le machine learning ?"},
+        {"role": "assistant", "content": "Le machine learning est une branche de l'IA. " * 20},
+    ]
+    for i in range(nb_turns):
+        question = {"role": "user", "content": f"Peux-tu détailler le point {i % 50} ?"}
+        yield [{"role": "system", "content": SYSTEM_PROMPT}] + history + [question]
+
+
+def bench_import():
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "import utils"], check=True)
+    return time.perf_counter() - start
+
+
+def main(args):
+    print(f"import utils (fresh interpreter): {bench_import() * 1000:.0f} ms")
+
+    encoding = tiktoken.encoding_for_model("gpt-4")
+    start = time.perf_counter()
+    for messages in make_turns(args.turns):
+        sum(len(encoding.encode(m["content"])) for m in messages)
+    naive = time.perf_counter() - start
+
+    tokenizer = Tokenizer("gpt-4")
+    tokenizer.count("warm-up")
+    start = time.perf_counter()
+    for messages in make_turns(args.turns):
+        tokenizer.count_messages(messages)
+    memoized = time.perf_counter() - start
+
+    print(f"encode every string: {naive / args.turns * 1e6:8.1f} us/turn")
+    print(f"memoized:            {memoized / args.turns * 1e6:8.1f} us/turn")
+    print(f"memo: {tokenizer.memo_info()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--turns", type=int, default=2000)
+    main(parser.parse_args())
@@ -0,0 +1,217 @@
+"""
+In-memory stand-ins for pymongo/Motor collections, with a configurable
+per-operation latency to emulate a slow database server.
+
+Only the subset of the query and update language used by `mongodb_db` is
+supported.
+"""
+import asyncio
+import copy
+import itertools
+import time
+from types import SimpleNamespace
+
+from pymongo.errors import DuplicateKeyError
+
+_ids = itertools.count(1)
+
+
+def _matches(doc, query):
+    for field, condition in query.items():
+        value = doc.get(field)
+        if isinstance(condition, dict):
+            for op, operand in condition.items():
+                if op == "$lt" and not (value is not None and value < operand):
+                    return False
+                if op == "$gt" and not (value is not None and value > operand):
+                    return False
+                if op == "$ne" and value == operand:
+                    return False
+                if op == "$in" and value not in operand:
+                    return False
+        elif value != condition:
+            return False
+    return True
+
+
+def _project(doc, projection):
+    if not projection:
+        return doc
+    if any(projection.values()):
+        keep = {field for field, flag in projection.items() if flag} | {"_id"}
+        return {field: value for field, value in doc.items() if field in keep}
+    return {field: value for field, value in doc.items() if field not in projection}
+
+
+def _apply_update(doc, update, inserting=False):
+    # Stored values are copies, as they would be once sent to the server
+    for field, value in update.get("$set", {}).items():
+        doc[field] = copy.deepcopy(value)
+    if inserting:
+        for field, value in update.get("$setOnInsert", {}).items():
+            doc[field] = copy.deepcopy(value)
+    for field, amount in update.get("$inc", {}).items():
+        doc[field] = doc.get(field, 0) + amount
+    for field, value in update.get("$push", {}).items():
+        values = doc.setdefault(field, [])
+        if isinstance(value, dict) and "$each" in value:
+            values.extend(copy.deepcopy(value["$each"]))
+            size = value.get("$slice")
+            if size is not None:
+                doc[field] = values[size:] if size < 0 else values[:size]
+        else:
+            values.append(copy.deepcopy(value))
+    return doc
+
+
+class InMemoryCollection:
+    """Blocking fake: every operation sleeps `latency` seconds like pymongo would."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.docs = {}
+        self.round_trips = 0
+
+    def _wait(self):
+        self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _find(self, query):
+        if not isinstance(query, dict):
+            query = {"_id": query}
+        for doc in self.docs.values():
+            if _matches(doc, query):
+                return doc
+
+    def _upsert(self, query, update):
+        doc = {k: v for k, v in query.items() if not isinstance(v, dict)}
+        doc = _apply_update(doc, update, inserting=True)
+        doc.setdefault("_id", next(_ids))
+        self.docs[doc["_id"]] = doc
+        return doc
+
+    def find_one(self, query=None):
+        self._wait()
+        doc = self._find(query or {})
+        return copy.deepcopy(doc)
+
+    def find(self, query=None, projection=None):
+        self._wait()
+        return _Cursor(
+            _project(copy.deepcopy(d), projection)
+            for d in self.docs.values()
+            if _matches(d, query or {})
+        )
+
+    def create_index(self, keys, **kwargs):
+        self._wait()
+        return keys if isinstance(keys, str) else "_".join(f"{k}_{d}" for k, d in keys)
+
+    def insert_one(self, doc):
+        self._wait()
+        doc = copy.deepcopy(doc)
+        doc.setdefault("_id", next(_ids))
+        if doc["_id"] in self.docs:
+            raise DuplicateKeyError(f"duplicate _id {doc['_id']}")
+        self.docs[doc["_id"]] = doc
+        return SimpleNamespace(inserted_id=doc["_id"])
+
+    def update_one(self, query, update, upsert=False):
+        self._wait()
+        doc = self._find(query)
+        if doc is None:
+            if not upsert:
+                return SimpleNamespace(matched_count=0, modified_count=0)
+            self._upsert(query, update)
+            return SimpleNamespace(matched_count=0, modified_count=0)
+        _apply_update(doc, update)
+        return SimpleNamespace(matched_count=1, modified_count=1)
+
+    def update_many(self, query, update):
+        self._wait()
+        docs = [d for d in self.docs.values() if _matches(d, query)]
+        for doc in docs:
+            _apply_update(doc, update)
+        return SimpleNamespace(matched_count=len(docs), modified_count=len(docs))
+
+    def find_one_and_update(self, query, update, upsert=False, return_document=False):
+        self._wait()
+        doc = self._find(query)
+        before = copy.deepcopy(doc)
+        if doc is None:
+            if not upsert:
+                return None
+            doc = self._upsert(query, update)
+        else:
+            _apply_update(doc, update)
+        return copy.deepcopy(doc) if return_document else before
+
+    def delete_one(self, query):
+        self._wait()
+        doc = self._find(query)
+        if doc is not None:
+            del self.docs[doc["_id"]]
+        return SimpleNamespace(deleted_count=int(doc is not None))
+
+    def delete_many(self, query):
+        self._wait()
+        ids = [i for i, d in self.docs.items() if _matches(d, query)]
+        for i in ids:
+            del self.docs[i]
+        return SimpleNamespace(deleted_count=len(ids))
+
+
+class _Cursor(list):
+    def sort(self, key, direction=1):
+        super().sort(key=lambda doc: doc.get(key), reverse=direction < 0)
+        return self
+
+    def limit(self, length):
+        del self[length:]
+        return self
+
+
+class _AsyncCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, key, direction=1):
+        self.docs.sort(key, direction)
+        return self
+
+    def limit(self, length):
+        self.docs.limit(length)
+        return self
+
+    async def to_list(self, length=None):
+        return self.docs[:length] if length else self.docs
+
+
+class AsyncInMemoryCollection:
+    """Non-blocking fake: operations await `latency` seconds like Motor would."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.sync = InMemoryCollection()
+
+    @property
+    def docs(self):
+        return self.sync.docs
+
+    @property
+    def round_trips(self):
+        return self.sync.round_trips
+
+    def find(self, query=None, projection=None):
+        return _AsyncCursor(self.sync.find(query, projection))
+
+    def __getattr__(self, name):
+        method = getattr(self.sync, name)
+
+        async def call(*args, **kwargs):
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            return method(*args, **kwargs)
+
+        return call
@@ -0,0 +1,153 @@
+"""
+Local stand-ins for the upstream APIs of the bot (OpenAI, Twilio, AssemblyAI
+and Stripe) served by a single aiohttp server, each answering after a
+configurable latency.
+
+Only the endpoints and fields used by the bot are implemented.
+"""
+import asyncio
+import itertools
+import json
+import random
+import time
+
+from aiohttp import web
+
+_ids = itertools.count(1)
+
+
+class FakeUpstreams:
+    """
+    Args:
+        llm_latency (float): Seconds before the first token of a chat completion.
+        token_interval (float): Seconds between two streamed pieces of an answer.
+        twilio_latency (float): Seconds to accept a message.
+        transcription_latency (float): Seconds before a transcript is completed.
+        stripe_latency (float): Seconds to retrieve a customer.
+        answer (str): Answer of every chat completion.
+        chat_error_rate (float): Share of the chat completions failing with a 503.
+    """
+
+    def __init__(
+        self,
+        llm_latency=0.5,
+        token_interval=0.01,
+        twilio_latency=0.05,
+        transcription_latency=1.0,
+        stripe_latency=0.1,
+        answer="Voici une réponse de test. Elle tient en trois phrases. Fin.",
+        chat_error_rate=0.0,
+    ):
+        self.llm_latency = llm_latency
+        self.token_interval = token_interval
+        self.twilio_latency = twilio_latency
+        self.transcription_latency = transcription_latency
+        self.stripe_latency = stripe_latency
+        self.answer = answer
+        self.chat_error_rate = chat_error_rate
+        self.messages = []
+        self.chat_calls = 0
+        self.chat_errors = 0
+        self._transcripts = {}
+        self._waiters = {}
+        self._runner = None
+        self.url = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        app.router.add_post("/2010-04-01/Accounts/{sid}/Messages.json", self.twilio_message)
+        app.router.add_post("/v2/transcript", self.request_transcript)
+        app.router.add_get("/v2/transcript/{id}", self.transcript_status)
+        app.router.add_get("/v2/transcript/{id}/paragraphs", self.paragraphs)
+        app.router.add_get("/v1/customers/{id}", self.stripe_customer)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        self.url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    def wait_for_message(self, phone_number, text):
+        """Future resolved when a message containing `text` is sent to `phone_number`."""
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(phone_number, []).append((text, future))
+        return future
+
+    async def chat_completions(self, request):
+        payload = await request.json()
+        self.chat_calls += 1
+        await asyncio.sleep(self.llm_latency)
+        if random.random() < self.chat_error_rate:
+            self.chat_errors += 1
+            return web.json_response(
+                {"error": {"message": "The server is overloaded", "type": "server_error"}},
+                status=503,
+            )
+        base = {"id": f"chatcmpl-{next(_ids)}", "created": int(time.time()), "model": payload["model"]}
+
+        if not payload.get("stream"):
+            return web.json_response(
+                {
+                    **base,
+                    "object": "chat.completion",
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": self.answer},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": {"prompt_tokens": 100, "completion_tokens": 20, "total_tokens": 120},
+                }
+            )
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for word in self.answer.split(" "):
+            chunk = {
+                **base,
+                "object": "chat.completion.chunk",
+                "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}],
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            await asyncio.sleep(self.token_interval)
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def twilio_message(self, request):
+        form = await request.post()
+        await asyncio.sleep(self.twilio_latency)
+        phone_number = form["To"].removeprefix("whatsapp:")
+        body = form.get("Body", "")
+        self.messages.append((phone_number, body, time.monotonic()))
+
+        waiters = self._waiters.get(phone_number, [])
+        for text, future in list(waiters):
+            if text in body and not future.done():
+                future.set_result(time.monotonic())
+                waiters.remove((text, future))
+        return web.json_response({"sid": f"SM{next(_ids):032d}"}, status=201)
+
+    async def request_transcript(self, request):
+        transcript_id = f"tr-{next(_ids)}"
+        self._transcripts[transcript_id] = time.monotonic() + self.transcription_latency
+        return web.json_response({"id": transcript_id, "status": "queued"})
+
+    async def transcript_status(self, request):
+        done_at = self._transcripts[request.match_info["id"]]
+        status = "completed" if time.monotonic() >= done_at else "processing"
+        return web.json_response({"id": request.match_info["id"], "status": status})
+
+    async def paragraphs(self, request):
+        return web.json_response({"paragraphs": [{"text": "question posée à l'oral"}]})
+
+    async def stripe_customer(self, request):
+        await asyncio.sleep(self.stripe_latency)
+        customer_id = request.match_info["id"]
+        return web.json_response(
+            {"id": customer_id, "object": "customer", "phone": "+" + customer_id.removeprefix("cus_")}
+        )
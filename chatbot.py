@@ -1,30 +1,111 @@
+import asyncio
 import datetime
 import logging
 import os
 import re
 import time
+from contextlib import asynccontextmanager
 from logging.config import dictConfig
 
+import aiohttp
+import httpx
+import openai
 import stripe
+from botocore.exceptions import BotoCoreError, ClientError
 import uvicorn
 from fastapi import FastAPI, Request, Response, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 from twilio.twiml.messaging_response import MessagingResponse
 
-from audio.transcription import audio_to_text
-from chatgpt_api.chatgpt import ask_chat_conversation
-from mongodb_db import UserCollection
-from notifier.send_notification import send_message
+from audio.transcription import WEBHOOK_AUTH_HEADER, TranscriptionClient
+from audio.utils import TranscriptionError
+from chatgpt_api.chatgpt import (
+    CHAT_MODEL,
+    ask_chat_conversation,
+    estimate_tokens,
+    stream_chat_conversation,
+)
+from chatgpt_api.response_cache import ResponseCache
+from chatgpt_api.router import ModelRouter, parse_route
+from chatgpt_api.summarizer import Summarizer
+from mongodb_db import AsyncMessageLog, AsyncStripeEventCollection, AsyncUserCollection
+from notifier.delivery import DeliveryQueue
 from parse_phone_numbers import extract_phone_number
-from prompt_to_image.prompt_to_image import generate_image
-from utils import count_tokens, split_long_string, load_config
+from rate_limiter import limiters
+from resilience import CircuitOpenError, Policy
+from prompt_to_image.prompt_to_image import ImageCache
+from history import HistoryManager
+from http_clients import clients
+from maintenance import MaintenanceScheduler
+from metrics import (
+    QUEUE_DEPTH,
+    RATE_LIMITER_SATURATION,
+    REGISTRY,
+    RESPONSE_CACHE,
+    SESSION_CACHE,
+    STAGE_SECONDS,
+    TOKENS,
+    TOKENS_SAVED,
+)
+from session_cache import UserSessionCache
+from shared_state import SharedState
+from stripe_customers import CustomerPhoneCache
+from turn_queue import SharedTurnQueue, TurnQueue
+from txt_to_speech.txt_to_speech import SpeechSynthesizer
+from utils import SentenceChunker, count_tokens, split_long_string, load_config
 
 env_name = os.getenv("ENV_WHATIA")
 config = load_config(env_name)
 
 HISTORY_TTL = config.getint(env_name, "HISTORY_TTL")
 FREE_TRIAL_LIMIT = config.getint(env_name, "FREE_TRIAL_LIMIT")
+DELIVERY_PACING = config.getfloat(env_name, "DELIVERY_PACING")
+TWILIO_MAX_CONCURRENCY = config.getint(env_name, "TWILIO_MAX_CONCURRENCY")
+ASYNC_TURNS = config.getboolean(env_name, "ASYNC_TURNS")
+TURN_WORKERS = config.getint(env_name, "TURN_WORKERS")
+TURN_DEBOUNCE = config.getfloat(env_name, "TURN_DEBOUNCE")
+STREAMING = config.getboolean(env_name, "STREAMING")
+STREAM_FLUSH_LEN = config.getint(env_name, "STREAM_FLUSH_LEN")
+TRANSCRIPTION_TIMEOUT = config.getint(env_name, "TRANSCRIPTION_TIMEOUT")
+SESSION_CACHE_SIZE = config.getint(env_name, "SESSION_CACHE_SIZE")
+SESSION_CACHE_TTL = config.getint(env_name, "SESSION_CACHE_TTL")
+HISTORY_TOKEN_BUDGET = config.getint(env_name, "HISTORY_TOKEN_BUDGET")
+HISTORY_WINDOW = config.getint(env_name, "HISTORY_WINDOW")
+ROUTE_TRIAL = parse_route(config.get(env_name, "ROUTE_TRIAL"))
+ROUTE_SUBSCRIBER = parse_route(config.get(env_name, "ROUTE_SUBSCRIBER"))
+ROUTE_SHORT = parse_route(config.get(env_name, "ROUTE_SHORT"))
+ROUTE_SHORT_TOKENS = config.getint(env_name, "ROUTE_SHORT_TOKENS")
+CHAT_HEDGE_AFTER = config.getfloat(env_name, "CHAT_HEDGE_AFTER")
+SUMMARY_THRESHOLD = config.getint(env_name, "SUMMARY_THRESHOLD")
+SUMMARY_KEEP = config.getint(env_name, "SUMMARY_KEEP")
+SUMMARY_MAX_TOKENS = config.getint(env_name, "SUMMARY_MAX_TOKENS")
+SUMMARY_MODEL = config.get(env_name, "SUMMARY_MODEL")
+RESPONSE_CACHE_SIZE = config.getint(env_name, "RESPONSE_CACHE_SIZE")
+RESPONSE_CACHE_TTL = config.getint(env_name, "RESPONSE_CACHE_TTL")
+RESPONSE_CACHE_SIMILARITY = config.getfloat(env_name, "RESPONSE_CACHE_SIMILARITY")
+VOICE_REPLIES = config.getboolean(env_name, "VOICE_REPLIES")
+SPEECH_CACHE_BYTES = config.getint(env_name, "SPEECH_CACHE_BYTES")
+IMAGE_WORKERS = config.getint(env_name, "IMAGE_WORKERS")
+IMAGE_QUEUE_SIZE = config.getint(env_name, "IMAGE_QUEUE_SIZE")
+IMAGE_CACHE_SIZE = config.getint(env_name, "IMAGE_CACHE_SIZE")
+IMAGE_CACHE_TTL = config.getint(env_name, "IMAGE_CACHE_TTL")
+MAINTENANCE_INTERVAL = config.getint(env_name, "MAINTENANCE_INTERVAL")
+MAINTENANCE_BATCH_SIZE = config.getint(env_name, "MAINTENANCE_BATCH_SIZE")
+MAINTENANCE_PAUSE = config.getfloat(env_name, "MAINTENANCE_PAUSE")
+STRIPE_REPLAY_INTERVAL = config.getint(env_name, "STRIPE_REPLAY_INTERVAL")
+METRICS_PUBLISH_INTERVAL = config.getint(env_name, "METRICS_PUBLISH_INTERVAL")
+# Public base URL of this app, from which Twilio fetches the voice replies
+PUBLIC_URL = os.getenv("PUBLIC_URL")
+# Set by gunicorn.conf.py when the app runs in several processes
+SHARED_STATE_PATH = os.getenv("SHARED_STATE_PATH")
+# What a call to an upstream raises once its retries are exhausted
+UPSTREAM_FAILURES = (
+    openai.OpenAIError,
+    httpx.HTTPError,
+    asyncio.TimeoutError,
+    CircuitOpenError,
+)
 
 dictConfig(
     {
@@ -45,7 +126,88 @@ dictConfig(
     }
 )
 
-app = FastAPI()
+state = SharedState(SHARED_STATE_PATH) if SHARED_STATE_PATH else None
+users = AsyncUserCollection("users", history_window=HISTORY_WINDOW)
+message_log = AsyncMessageLog()
+sessions = UserSessionCache(
+    users, maxsize=SESSION_CACHE_SIZE, ttl=SESSION_CACHE_TTL, state=state
+)
+stripe_events = AsyncStripeEventCollection()
+customer_phones = CustomerPhoneCache()
+history_manager = HistoryManager(token_budget=HISTORY_TOKEN_BUDGET, ttl=HISTORY_TTL)
+router = ModelRouter(
+    trial=ROUTE_TRIAL,
+    subscriber=ROUTE_SUBSCRIBER,
+    short=ROUTE_SHORT,
+    short_tokens=ROUTE_SHORT_TOKENS,
+)
+summarizer = Summarizer(
+    history_manager,
+    threshold=SUMMARY_THRESHOLD,
+    keep=SUMMARY_KEEP,
+    max_tokens=SUMMARY_MAX_TOKENS,
+    model=SUMMARY_MODEL,
+)
+response_cache = ResponseCache(
+    maxsize=RESPONSE_CACHE_SIZE,
+    ttl=RESPONSE_CACHE_TTL,
+    similarity=RESPONSE_CACHE_SIMILARITY or None,
+)
+delivery = DeliveryQueue(
+    pacing=DELIVERY_PACING, max_concurrency=TWILIO_MAX_CONCURRENCY
+)
+transcriber = TranscriptionClient(
+    timeout=TRANSCRIPTION_TIMEOUT,
+    webhook_url=os.getenv("ASSEMBLYAI_WEBHOOK_URL"),
+    webhook_secret=os.getenv("ASSEMBLYAI_WEBHOOK_SECRET"),
+    state=state,
+)
+speech = SpeechSynthesizer(max_bytes=SPEECH_CACHE_BYTES, state=state)
+images = ImageCache(maxsize=IMAGE_CACHE_SIZE, ttl=IMAGE_CACHE_TTL)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    if state is not None:
+        # The processes share the OpenAI, DALL-E and AssemblyAI quotas
+        for limiter in limiters.values():
+            limiter.share(state)
+    await clients.start()
+    await delivery.start(session=clients.session("twilio"))
+    await transcriber.start(session=clients.session("assemblyai"))
+    await turns.start()
+    await image_jobs.start()
+    await summary_jobs.start()
+    await stripe_queue.start()
+    # Events received but not applied before the last shutdown
+    for event in await stripe_events.pending():
+        stripe_queue.submit(event, message_id=event["id"])
+    await users.create_indexes()
+    await message_log.create_indexes()
+    await maintenance.start()
+    await stripe_replay.start()
+    if state is not None:
+        metrics_publisher = asyncio.create_task(publish_metrics())
+    yield
+    if state is not None:
+        metrics_publisher.cancel()
+        await asyncio.gather(metrics_publisher, return_exceptions=True)
+    await stripe_replay.stop()
+    await maintenance.stop()
+    await stripe_queue.stop()
+    await turns.stop()
+    await image_jobs.stop()
+    await summary_jobs.stop()
+    await transcriber.stop()
+    await delivery.stop()
+    await clients.stop()
+    if state is not None:
+        # The counters of this process keep counting in the totals once it exited
+        await state.call("put_metrics", str(os.getpid()), snapshot_metrics())
+        state.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 logger = logging.getLogger(__name__)
 
@@ -229,6 +391,21 @@ EXAMPLE_MESSAGE = """
 🚗 Demander des informations sur les voitures : "Quelle est la meilleure voiture pour les longs trajets ?"
 """
 
+UNAVAILABLE_MESSAGE = (
+    "Je suis momentanément indisponible, réessaie dans quelques minutes. "
+    "I'm temporarily unavailable, please try again in a few minutes."
+)
+
+
+SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": "WhatIA is an assistant who automatically speaks the language of the person who interacts with "
+    "you. if he changes language, you automatically adopt the new language. you answer all "
+    "questions unless you don't think you have the answer, in which case you answer by saying that "
+    "your answer is less certain. WhatIA's responses should be informative, visual, logical and actionable. "
+    "WhatIA's responses should also be positive, interesting, entertaining and engaging.",
+}
+
 
 @app.get("/")
 async def root():
@@ -241,166 +418,381 @@ async def bot(request: Request):
     Handle incoming messages from users, process them, and send responses.
     This function is designed to be used as an endpoint for a webhook.
 
+    With ASYNC_TURNS enabled the turn is queued and Twilio is acknowledged right
+    away, the answer being sent later through the delivery queue. Messages sent
+    in a burst by the same user are then merged into a single turn.
+
     Returns:
         str: An empty string (required for Twilio to work correctly).
     """
-    collection_name = "users"
-    form_data = await request.form()
+    with STAGE_SECONDS.time(stage="form_parse"):
+        form_data = await request.form()
     incoming_msg = str(form_data.get("Body", "").lower().strip())
     phone_number = extract_phone_number(form_data.get("From", "").lower())
 
     response = MessagingResponse()
-    status_code = status.HTTP_202_ACCEPTED
-    headers = {"Content-Type": "text/xml"}
-    media_type = "text/xml"
     logger.info(
         f"Phone number {phone_number} sent the incoming message: {incoming_msg}"
     )
-    start_time = time.time()
 
     is_audio = False
     media_url = form_data.get("MediaUrl0")
     if not incoming_msg:
         if media_url and form_data.get("MediaContentType0") == "audio/ogg":
             is_audio = True
-            # TODO handle audio duration
-            # duration = get_audio_duration(media_url)
-            incoming_msg = audio_to_text(media_url)
         else:
             response.message(
                 "Il faut écrire un message textuel ou enregistrer un audio pour discuter avec moi."
             )
-            return Response(
-                content=str(response),
-                status_code=status_code,
-                headers=headers,
-                media_type=media_type,
-            )
+            return twiml_response(response)
 
-    nb_tokens = count_tokens(incoming_msg)
-    if nb_tokens >= int(MAX_TOKEN_LENGTH):
+    if count_tokens(incoming_msg) >= int(MAX_TOKEN_LENGTH):
         response.message("Ta question est beaucoup trop longue.")
-        return Response(
-            content=str(response),
-            status_code=status_code,
-            headers=headers,
-            media_type=media_type,
-        )
+        return twiml_response(response)
 
-    if incoming_msg.startswith(("!image", "! image")):
-        incoming_msg = re.sub(r"^! ?image", "", incoming_msg)
-        dalle_media_url = await generate_image(incoming_msg)
-        msg = response.message(incoming_msg)
-        msg.media(dalle_media_url)
-
-        return Response(
-            content=str(response),
-            status_code=status_code,
-            headers=headers,
-            media_type=media_type,
-        )
-    elif (
+    if (
         "essai gratuit (envoies moi un message) | free trial (just send a message)"
         in incoming_msg
     ):
         return ""
 
-    users = UserCollection(collection_name)
-    doc = get_user_document(users, phone_number)
+    turn = {
+        "phone_number": phone_number,
+        "messages": [
+            {"incoming_msg": incoming_msg, "media_url": media_url, "is_audio": is_audio}
+        ],
+        "received_at": time.time(),
+    }
+    if ASYNC_TURNS:
+        turns.submit(turn, message_id=form_data.get("MessageSid"), key=phone_number)
+    else:
+        await process_turn(turn)
 
-    if (
+    return twiml_response(response)
+
+
+def twiml_response(response):
+    return Response(
+        content=str(response),
+        status_code=status.HTTP_202_ACCEPTED,
+        headers={"Content-Type": "text/xml"},
+        media_type="text/xml",
+    )
+
+
+async def process_turn(turn):
+    """
+    Run a conversation turn: transcription, answer generation, delivery of the
+    answer and persistence of the history.
+
+    Args:
+        turn (dict): The inbound messages, as built by `bot` and `merge_turns`.
+    """
+    phone_number = turn["phone_number"]
+    start_time = turn["received_at"]
+    is_audio = any(message["is_audio"] for message in turn["messages"])
+
+    texts = await asyncio.gather(
+        *(transcribe(message, phone_number) for message in turn["messages"])
+    )
+    questions = []
+    for text in texts:
+        if text is None:
+            continue
+        if text.startswith(("!image", "! image")):
+            prompt = re.sub(r"^! ?image", "", text)
+            if not image_jobs.submit({"phone_number": phone_number, "prompt": prompt}):
+                delivery.submit(
+                    "Trop d'images sont en cours de création, réessaie dans quelques minutes.",
+                    phone_number,
+                )
+        else:
+            questions.append(text)
+    if not questions:
+        return
+
+    incoming_msg = "\n".join(questions)
+    nb_tokens = count_tokens(incoming_msg)
+
+    doc = await get_user_document(sessions, phone_number)
+
+    # Applied with the rest of the turn, the current message is still answered
+    block = (
         doc.get("nb_messages") >= FREE_TRIAL_LIMIT
         and doc.get("current_period_end") is None
-    ):
-        users.block_user(doc["_id"])
-
-    message = [
-        {
-            "role": "system",
-            "content": "WhatIA is an assistant who automatically speaks the language of the person who interacts with "
-            "you. if he changes language, you automatically adopt the new language. you answer all "
-            "questions unless you don't think you have the answer, in which case you answer by saying that "
-            "your answer is less certain. WhatIA's responses should be informative, visual, logical and actionable. "
-            "WhatIA's responses should also be positive, interesting, entertaining and engaging.",
-        },
-    ]
+    )
 
     if doc["is_blocked"]:
-        response.message(TRIAL_END_MESSAGE_GB)
-        response.message(TRIAL_END_MESSAGE_FR)
-        return Response(
-            content=str(response),
-            status_code=status_code,
-            headers=headers,
-            media_type=media_type,
-        )
-
-    historical_messages = doc.get("history", [])
-    historical_messages.append({"role": "user", "content": incoming_msg})
-
-    current_question = message + historical_messages
+        delivery.submit(TRIAL_END_MESSAGE_GB, phone_number)
+        delivery.submit(TRIAL_END_MESSAGE_FR, phone_number)
+        return
+
+    history = doc.get("history", [])
+    history_manager.add(history, "user", incoming_msg, tokens=nb_tokens)
+    # Older messages are replaced by their summary, when there is one
+    summary = history_manager.active_summary(doc.get("summary"))
+    historical_messages = history_manager.trim(history, summary=summary)
+    tokens_saved = history_manager.savings(history, summary)
+
+    current_question = history_manager.prompt(SYSTEM_MESSAGE, historical_messages, summary)
     end_time = time.time()
     elapsed_time = end_time - start_time
     logger.info(
         f"Elapsed time to get question prepared {phone_number}: {elapsed_time} seconds"
     )
-    if doc.get("current_period_end") is None:
-        answer = await ask_chat_conversation(current_question)
-    else:
-        answer = await ask_chat_conversation(current_question, max_tokens=500)
+    route = router.route(nb_tokens, subscriber=doc.get("current_period_end") is not None)
+    model, max_tokens = route.model, route.max_tokens
+    prefix = incoming_msg + "\n\n" if is_audio else ""
+    # Without previous messages, the answer only depends on the question
+    standalone = len(historical_messages) == 1 and summary is None
+    answer = None
+    if standalone:
+        answer = response_cache.get(incoming_msg, model, max_tokens)
+    from_cache = answer is not None
+
+    llm_start = time.perf_counter()
+    try:
+        if from_cache:
+            send_answer(prefix + answer, phone_number)
+        elif STREAMING:
+            # Includes the chunking of the streamed answer, also measured on its own
+            with STAGE_SECONDS.time(stage="llm"):
+                answer = await stream_answer(
+                    current_question, max_tokens, phone_number, prefix, model=model
+                )
+        else:
+            with STAGE_SECONDS.time(stage="llm"):
+                answer = await ask_chat_conversation(
+                    current_question,
+                    max_tokens=max_tokens,
+                    model=model,
+                    hedge_after=CHAT_HEDGE_AFTER or None,
+                )
+            send_answer(prefix + answer, phone_number)
+    except UPSTREAM_FAILURES as e:
+        # Nothing is committed, the question can simply be asked again
+        logger.error(f"No answer from {model} for {phone_number}: {e!r}")
+        delivery.submit(UNAVAILABLE_MESSAGE, phone_number)
+        return
+    llm_seconds = time.perf_counter() - llm_start
 
     end_time = time.time()
     elapsed_time = end_time - start_time
     logger.info(
         f"Elapsed time to get OpenAI answer for {phone_number}: {elapsed_time} seconds"
     )
-    nb_tokens += count_tokens(answer)
-
-    if is_audio:
-        answers = split_long_string(incoming_msg + "\n\n" + answer)
-    else:
-        answers = split_long_string(answer)
-
-    for answer in answers:
-        send_message(answer, phone_number)
-        time.sleep(1)
-        # response.message(answer)
+    answer_tokens = count_tokens(answer)
+    nb_tokens += answer_tokens
+    if not from_cache:
+        prompt_tokens = estimate_tokens(current_question, 0, model)
+        router.record(route, llm_seconds, prompt_tokens, answer_tokens)
+        if standalone and answer:
+            response_cache.put(
+                incoming_msg, model, max_tokens, answer, prompt_tokens + answer_tokens
+            )
 
     end_time = time.time()
     elapsed_time = end_time - start_time
     logger.info(
-        f"Elapsed time for message sending {phone_number}: {elapsed_time} seconds"
+        f"Elapsed time for message queuing {phone_number}: {elapsed_time} seconds"
     )
 
-    if len(historical_messages) > 4:
-        del historical_messages[:2]
+    history_manager.add(historical_messages, "assistant", answer, tokens=answer_tokens)
+    # Only the question and the answer are written, not the whole history
+    messages = historical_messages[-2:]
+    with STAGE_SECONDS.time(stage="mongo_commit"):
+        await asyncio.gather(
+            sessions.commit_turn(
+                doc, messages, nb_tokens, block=block, tokens_saved=tokens_saved
+            ),
+            message_log.append(phone_number, messages, nb_tokens),
+        )
+    plan = "subscriber" if doc.get("current_period_end") else "trial"
+    TOKENS.inc(nb_tokens, plan=plan)
+    TOKENS_SAVED.inc(tokens_saved, plan=plan)
+    if summarizer.due(history + messages[-1:], summary):
+        summary_jobs.submit({"phone_number": phone_number}, key=phone_number)
 
-    historical_messages.append({"role": "assistant", "content": answer})
-    users.increment_nb_tokens_messages(doc, nb_tokens)
-    users.update_user_history(phone_number, historical_messages)
+    if is_audio and VOICE_REPLIES and PUBLIC_URL and answer:
+        await send_voice_reply(answer, phone_number)
 
-    return Response(
-        content=str(response),
-        status_code=status_code,
-        headers=headers,
-        media_type=media_type,
-    )
 
+async def send_voice_reply(answer, phone_number):
+    """Send `answer` as a voice note, after its text."""
+    try:
+        key = await speech.speak(answer)
+    except (BotoCoreError, ClientError, asyncio.TimeoutError, CircuitOpenError) as e:
+        logger.error(f"Speech synthesis failed for {phone_number}: {e!r}")
+        return
+    delivery.submit("", phone_number, media_url=f"{PUBLIC_URL}/media/{key}")
 
-def get_user_document(users, phone_number):
-    doc = users.find_document("phone_number", phone_number)
 
-    if doc is None:
-        doc_id = users.add_user(phone_number)
-        send_message(WELCOME_MESSAGE, phone_number)
-        send_message(WELCOME_MESSAGE_GB, phone_number)
+def send_answer(answer, phone_number):
+    with STAGE_SECONDS.time(stage="chunking"):
+        chunks = split_long_string(answer)
+    for chunk in chunks:
+        delivery.submit(chunk, phone_number)
 
-        doc = users.collection.find_one(doc_id)
+
+async def stream_answer(prompt, max_tokens, phone_number, prefix="", model=CHAT_MODEL):
+    """
+    Stream the answer to `prompt`, sending each chunk to `phone_number` as soon as
+    it is complete.
+
+    Returns:
+        str: The whole answer, without `prefix`.
+    """
+    chunker = SentenceChunker(flush_len=STREAM_FLUSH_LEN)
+    chunking = 0.0
+
+    def feed(text):
+        nonlocal chunking
+        start = time.perf_counter()
+        chunks = chunker.feed(text) if text is not None else chunker.close()
+        chunking += time.perf_counter() - start
+        for chunk in chunks:
+            delivery.submit(chunk, phone_number)
+
+    feed(prefix)
+    parts = []
+    async for delta in stream_chat_conversation(prompt, max_tokens=max_tokens, model=model):
+        parts.append(delta)
+        feed(delta)
+    feed(None)
+    STAGE_SECONDS.observe(chunking, stage="chunking")
+
+    return "".join(parts)
+
+
+async def get_user_document(users, phone_number):
+    with STAGE_SECONDS.time(stage="user_lookup"):
+        doc, created = await users.get_or_create_user(phone_number)
+
+    if created:
+        delivery.submit(WELCOME_MESSAGE, phone_number)
+        delivery.submit(WELCOME_MESSAGE_GB, phone_number)
     return doc
 
 
+async def transcribe(message, phone_number):
+    """
+    Text of an inbound message, transcribing it if it is a voice note.
+
+    Returns:
+        str: The text, None if it could not be transcribed or is too long.
+    """
+    if not message["is_audio"]:
+        return message["incoming_msg"]
+
+    # TODO handle audio duration
+    # duration = get_audio_duration(media_url)
+    try:
+        with STAGE_SECONDS.time(stage="transcription"):
+            text = await transcriber.audio_to_text(message["media_url"])
+    except (asyncio.TimeoutError, TranscriptionError, aiohttp.ClientError, CircuitOpenError) as e:
+        logger.error(f"Transcription failed for {phone_number}: {e!r}")
+        delivery.submit(
+            "Je n'ai pas réussi à comprendre ton audio, peux-tu réessayer ?",
+            phone_number,
+        )
+        return None
+
+    if count_tokens(text) >= int(MAX_TOKEN_LENGTH):
+        delivery.submit("Ta question est beaucoup trop longue.", phone_number)
+        return None
+    return text
+
+
+def merge_turns(turns):
+    """Merge the turns of a burst of messages from one user, oldest first."""
+    return {
+        "phone_number": turns[0]["phone_number"],
+        "messages": [message for turn in turns for message in turn["messages"]],
+        "received_at": turns[0]["received_at"],
+    }
+
+
+def make_queue(handler, name, **kwargs):
+    """A `TurnQueue`, coordinated with the other processes when there are some."""
+    if state is not None:
+        return SharedTurnQueue(handler, state, name, **kwargs)
+    return TurnQueue(handler, **kwargs)
+
+
+turns = make_queue(
+    process_turn, "turns", workers=TURN_WORKERS, debounce=TURN_DEBOUNCE, merge=merge_turns
+)
+
+
+async def run_image_job(job):
+    """Generate the image of an `!image` command and send it."""
+    phone_number = job["phone_number"]
+    try:
+        media_url = await images.get(job["prompt"])
+    except UPSTREAM_FAILURES as e:
+        logger.error(f"Image generation failed for {phone_number}: {e!r}")
+        delivery.submit(
+            "Je n'ai pas réussi à créer ton image, réessaie plus tard.", phone_number
+        )
+        return
+    delivery.submit(job["prompt"], phone_number, media_url=media_url)
+
+
+# Image generation is slow and rate limited, it gets its own bounded pool
+image_jobs = TurnQueue(run_image_job, workers=IMAGE_WORKERS, maxsize=IMAGE_QUEUE_SIZE)
+
+
+async def run_summary_job(job):
+    """Fold the older messages of a conversation into its summary."""
+    phone_number = job["phone_number"]
+    doc = await users.find_document("phone_number", phone_number)
+    if doc is None:
+        return
+    summary = await summarizer.summarize(
+        doc.get("history", []), history_manager.active_summary(doc.get("summary"))
+    )
+    if summary is not None:
+        await sessions.set_summary(phone_number, summary)
+        logger.info(f"Conversation of {phone_number} summarized in {summary['tokens']} tokens")
+
+
+# Summaries are written after the answer, one at a time per user
+summary_jobs = make_queue(run_summary_job, "summaries", workers=1)
+
+
+@app.get("/media/{key}")
+async def media(key: str):
+    """
+    Voice replies, fetched by Twilio from the `media_url` of the message.
+    """
+    entry = await speech.fetch(key)
+    if entry is None:
+        return Response(status_code=status.HTTP_404_NOT_FOUND)
+    audio, content_type = entry
+    return Response(content=audio, media_type=content_type)
+
+
+@app.post("/transcription")
+async def transcription_webhook(request: Request):
+    """
+    Completion callback of AssemblyAI, waking up the turn waiting for the transcript.
+    """
+    payload = await request.json()
+    if not await transcriber.notify(
+        payload.get("transcript_id"),
+        payload.get("status"),
+        request.headers.get(WEBHOOK_AUTH_HEADER),
+    ):
+        return JSONResponse(content={"error": "Invalid secret"}, status_code=401)
+    return JSONResponse(content={"status": "success"}, status_code=200)
+
+
 @app.post("/webhook")
 async def webhook(request: Request):
+    """
+    Record a Stripe event and acknowledge it. The event is applied by
+    `apply_stripe_event` in the background, at most once per event id.
+    """
     payload = await request.body()
     sig_header = request.headers.get("Stripe-Signature")
 
@@ -415,56 +807,66 @@ async def webhook(request: Request):
         logger.error("Invalid signature")
         return JSONResponse(content={"error": "Invalid signature"}, status_code=400)
 
+    event = event.to_dict_recursive()
+    if await stripe_events.record(event):
+        stripe_queue.submit(event, message_id=event["id"])
+    else:
+        logger.info(f"Stripe event {event['id']} already received")
+
+    return JSONResponse(content={"status": "success"}, status_code=200)
+
+
+async def apply_stripe_event(event):
+    # Replayed events may have been applied since they were read
+    if not await stripe_events.is_pending(event["id"]):
+        return
     event_type = event["type"]
     object_ = event["data"]["object"]
     if event_type == "checkout.session.completed":
         stripe_customer_phone = object_["customer_details"]["phone"]
     else:
         stripe_customer_id = object_["customer"]
-        stripe_customer_phone = stripe.Customer.retrieve(stripe_customer_id)["phone"]
-
-    # Initialize the UserCollection with the specified collection name
-    users = UserCollection("users")
+        stripe_customer_phone = await customer_phones.get(stripe_customer_id)
 
     if event_type in [
         "customer.subscription.deleted",
         "customer.subscription.paused",
     ]:
-        users.delete_document({"phone_number": stripe_customer_phone})
+        await sessions.delete_document({"phone_number": stripe_customer_phone})
         logger.info(f"User deleted from database: {stripe_customer_phone}")
     elif event_type == "customer.subscription.created":
         sub_current_period_end = object_["current_period_end"]
-        _ = users.add_user(stripe_customer_phone, sub_current_period_end)
-        send_message(
+        _ = await sessions.add_user(stripe_customer_phone, sub_current_period_end)
+        delivery.submit(
             ACTIVATION_MESSAGE,
             stripe_customer_phone,
         )
-        send_message(
+        delivery.submit(
             ACTIVATION_MESSAGE_FR,
             stripe_customer_phone,
         )
     elif event_type == "customer.subscription.updated":
-        if object_.status in ["canceled", "unpaid"]:
-            if not object_.cancel_at_period_end:
-                users.delete_document({"phone_number": stripe_customer_phone})
+        if object_["status"] in ["canceled", "unpaid"]:
+            if not object_["cancel_at_period_end"]:
+                await sessions.delete_document({"phone_number": stripe_customer_phone})
                 logger.info(f"User deleted from database: {stripe_customer_phone}")
             else:
                 sub_current_period_end = object_["current_period_end"]
-                _ = users.add_user(stripe_customer_phone, sub_current_period_end)
-            send_message("Votre abonnement a pris fin.", stripe_customer_phone)
+                _ = await sessions.add_user(stripe_customer_phone, sub_current_period_end)
+            delivery.submit("Votre abonnement a pris fin.", stripe_customer_phone)
         if object_["status"] == "trialing":
             sub_current_period_end = object_["current_period_end"]
-            _ = users.add_user(stripe_customer_phone, sub_current_period_end)
-            send_message(
+            _ = await sessions.add_user(stripe_customer_phone, sub_current_period_end)
+            delivery.submit(
                 ACTIVATION_MESSAGE,
                 stripe_customer_phone,
             )
-            send_message(ACTIVATION_MESSAGE_FR, stripe_customer_phone)
+            delivery.submit(ACTIVATION_MESSAGE_FR, stripe_customer_phone)
         if object_["status"] == "active":
             sub_current_period_end = object_["current_period_end"]
-            _ = users.add_user(stripe_customer_phone, sub_current_period_end)
-            send_message(ACTIVATION_MESSAGE, stripe_customer_phone)
-            send_message(ACTIVATION_MESSAGE_FR, stripe_customer_phone)
+            _ = await sessions.add_user(stripe_customer_phone, sub_current_period_end)
+            delivery.submit(ACTIVATION_MESSAGE, stripe_customer_phone)
+            delivery.submit(ACTIVATION_MESSAGE_FR, stripe_customer_phone)
     elif event_type == "checkout.session.completed":
         sub_current_period_end = datetime.datetime.utcnow()
         # Pass 7 jours
@@ -478,16 +880,139 @@ async def webhook(request: Request):
                 days=30
             )
         sub_current_period_end = sub_current_period_end.timestamp()
-        _ = users.add_user(stripe_customer_phone, sub_current_period_end)
-        send_message(
+        _ = await sessions.add_user(stripe_customer_phone, sub_current_period_end)
+        delivery.submit(
             ACTIVATION_MESSAGE,
             stripe_customer_phone,
         )
-        send_message(ACTIVATION_MESSAGE_FR, stripe_customer_phone)
+        delivery.submit(ACTIVATION_MESSAGE_FR, stripe_customer_phone)
     else:
         logger.warning("Unhandled event type {}".format(event_type))
 
-    return JSONResponse(content={"status": "success"}, status_code=200)
+    await stripe_events.mark_done(event["id"])
+
+
+# Stripe lookups and database writes may fail for a while, the event is
+# acknowledged already so it is retried here, then replayed by `stripe_replay`
+stripe_policy = Policy(
+    "stripe_events", timeout=60, retries=4, backoff=2, max_backoff=30, retryable=lambda e: True
+)
+
+
+async def run_stripe_event(event):
+    try:
+        await stripe_policy.call(lambda: apply_stripe_event(event))
+    except Exception:
+        logger.exception(f"Stripe event {event['id']} failed, left pending for a replay")
+
+
+# A single worker applies the events of a customer in the order they were received
+stripe_queue = make_queue(run_stripe_event, "stripe_events", workers=1)
+
+
+async def replay_stripe_events(throttle):
+    """Queue again the events still pending, received before the last replay."""
+    received_before = datetime.datetime.utcnow() - datetime.timedelta(
+        seconds=STRIPE_REPLAY_INTERVAL
+    )
+    events = await stripe_events.pending(received_before=received_before)
+    for event in events:
+        # Already seen under its id, `apply_stripe_event` skips it if applied since
+        stripe_queue.submit(event)
+    return len(events)
+
+
+async def reset_tokens(throttle):
+    return await users.reset_tokens(batch_size=MAINTENANCE_BATCH_SIZE, throttle=throttle)
+
+
+async def delete_ended_subscriptions(throttle):
+    async def invalidate(phone_numbers):
+        for phone_number in phone_numbers:
+            await sessions.invalidate(phone_number)
+
+    return await users.delete_ended_subsciption(
+        batch_size=MAINTENANCE_BATCH_SIZE, throttle=throttle, on_deleted=invalidate
+    )
+
+
+maintenance = MaintenanceScheduler(
+    interval=MAINTENANCE_INTERVAL,
+    pause=MAINTENANCE_PAUSE,
+    # Conversations come first: batches wait while turns are queued up
+    busy=lambda: turns.qsize() > TURN_WORKERS,
+    leader=(
+        (lambda: state.acquire_lease("maintenance", str(os.getpid()), MAINTENANCE_INTERVAL))
+        if state is not None
+        else None
+    ),
+)
+maintenance.add("reset_tokens", reset_tokens)
+maintenance.add("delete_ended_subscriptions", delete_ended_subscriptions)
+
+stripe_replay = MaintenanceScheduler(
+    interval=STRIPE_REPLAY_INTERVAL,
+    first_delay=STRIPE_REPLAY_INTERVAL,
+    leader=(
+        (lambda: state.acquire_lease("stripe_replay", str(os.getpid()), STRIPE_REPLAY_INTERVAL))
+        if state is not None
+        else None
+    ),
+)
+stripe_replay.add("replay_stripe_events", replay_stripe_events)
+
+QUEUE_DEPTH.track(turns.qsize, queue="turns")
+QUEUE_DEPTH.track(image_jobs.qsize, queue="image_jobs")
+QUEUE_DEPTH.track(summary_jobs.qsize, queue="summaries")
+QUEUE_DEPTH.track(stripe_queue.qsize, queue="stripe_events")
+QUEUE_DEPTH.track(delivery.qsize, queue="delivery")
+
+
+def snapshot_metrics():
+    for name, limiter in limiters.items():
+        RATE_LIMITER_SATURATION.set(
+            limiter.metrics()["requests_saturation"], limiter=name
+        )
+    for stat, value in sessions.stats().items():
+        SESSION_CACHE.set(value, stat=stat)
+    for stat, value in response_cache.stats().items():
+        RESPONSE_CACHE.set(value, stat=stat)
+    return REGISTRY.snapshot()
+
+
+async def publish_metrics():
+    """
+    Share the metrics of this process every METRICS_PUBLISH_INTERVAL seconds,
+    since a scrape of `/metrics` reaches a single worker.
+    """
+    while True:
+        await asyncio.sleep(METRICS_PUBLISH_INTERVAL)
+        try:
+            await state.call("put_metrics", str(os.getpid()), snapshot_metrics())
+        except Exception:
+            logger.exception("Metrics could not be published")
+
+
+@app.get("/metrics")
+async def metrics():
+    """
+    Metrics of the app, in the Prometheus text format. With several workers,
+    those of every worker: counters and histograms are summed, gauges have a
+    `worker` label.
+    """
+    snapshot = snapshot_metrics()
+    if state is None:
+        return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+    await state.call("put_metrics", str(os.getpid()), snapshot)
+    snapshots, live = {}, set()
+    for worker, (worker_snapshot, age) in (await state.call("metrics")).items():
+        snapshots[worker] = worker_snapshot
+        # A worker that stopped publishing has exited, or hangs
+        if age < 3 * METRICS_PUBLISH_INTERVAL:
+            live.add(worker)
+    return PlainTextResponse(
+        REGISTRY.render(snapshots, live), media_type="text/plain; version=0.0.4"
+    )
 
 
 if __name__ == "__main__":
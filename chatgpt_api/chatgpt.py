@@ -1,26 +1,168 @@
+import asyncio
+import time
+
+import httpx
 import openai
-from openai import AsyncOpenAI
 
-client = AsyncOpenAI()
-from ratelimit import sleep_and_retry, limits
+from http_clients import clients
+from metrics import UPSTREAM_ERRORS
+from rate_limiter import AsyncRateLimiter
+from resilience import CircuitBreaker, Policy, error_kind
+from utils import count_message_tokens, count_tokens
+
+CHAT_MODEL = "gpt-4"
 
-ONE_MINUTE = 60
 MAX_CALLS_PER_MINUTE = 60
+MAX_TOKENS_PER_MINUTE = 40000
 
+chat_limiter = AsyncRateLimiter(
+    "chat",
+    requests_per_minute=MAX_CALLS_PER_MINUTE,
+    tokens_per_minute=MAX_TOKENS_PER_MINUTE,
+)
+# OpenAI limits each model separately, CHAT_MODEL uses `chat_limiter`
+model_limiters = {
+    "gpt-3.5-turbo": AsyncRateLimiter(
+        "chat-gpt-3.5-turbo", requests_per_minute=3500, tokens_per_minute=90000
+    ),
+}
 
-@sleep_and_retry
-@limits(calls=MAX_CALLS_PER_MINUTE, period=ONE_MINUTE)
-async def ask_chat_conversation(prompt, max_tokens=500):
-    try:
-        response = await client.chat.completions.create(
-            model="gpt-4",
+
+# Shared by every call to OpenAI, an outage affects them all
+openai_breaker = CircuitBreaker("openai", failure_threshold=5, reset_timeout=30)
+# An answer is sent within a minute or not at all, the user would have given up
+chat_policy = Policy(
+    "openai", timeout=45, retries=2, backoff=1, deadline=60, breaker=openai_breaker
+)
+# Deadline of the whole streamed answer, from its first byte
+STREAM_DEADLINE = 90
+
+
+def limiter_for(model):
+    if model == CHAT_MODEL:
+        return chat_limiter
+    return model_limiters.get(model, chat_limiter)
+
+
+def estimate_tokens(prompt, max_tokens, model=CHAT_MODEL):
+    # Upper bound of the tokens billed for the call: the prompt plus a full completion
+    return count_message_tokens(prompt, model) + max_tokens
+
+
+class Metered:
+    """
+    `request` as a `Policy` operation drawing `tokens` from `limiter` on every
+    attempt, since retries and hedges are billed like the first call.
+
+    The first attempt uses the reservation made by the caller before the call,
+    so that queueing on the limiter does not eat into its deadline. A failed
+    attempt gives its tokens back; a cancelled one (a timeout, a lost hedge)
+    keeps them, OpenAI probably billed it.
+    """
+
+    def __init__(self, limiter, tokens, request):
+        self.limiter = limiter
+        self.tokens = tokens
+        self.request = request
+        self.attempts = 0
+
+    async def __call__(self):
+        self.attempts += 1
+        if self.attempts > 1:
+            await self.limiter.acquire(self.tokens)
+        try:
+            return await self.request()
+        except Exception:
+            await self.limiter.refund(self.tokens)
+            raise
+
+    async def release(self):
+        """Give back the caller's reservation when no attempt was made."""
+        if self.attempts == 0:
+            await self.limiter.refund(self.tokens)
+
+
+async def ask_chat_conversation(prompt, max_tokens=500, model=CHAT_MODEL, hedge_after=None):
+    """
+    Args:
+        hedge_after (float, optional): Seconds after which a slow call is raced
+            against a second one, see `Policy`.
+
+    Raises:
+        openai.OpenAIError: If OpenAI still fails after the retries.
+        asyncio.TimeoutError: If no answer came within the deadline.
+        CircuitOpenError: If OpenAI has been failing, without calling it.
+    """
+    limiter = limiter_for(model)
+    estimated_tokens = estimate_tokens(prompt, max_tokens, model)
+    await limiter.acquire(estimated_tokens)
+
+    async def create():
+        return await clients.openai.chat.completions.create(
+            model=model,
             messages=prompt,
             max_tokens=max_tokens,
             stop=None,
             temperature=0.7,
             stream=False,
         )
-        reply_content = response.choices[0].message.content
-        return reply_content
-    except openai.RateLimitError as e:
-        print("[Log] Rate limit reached")
+
+    operation = Metered(limiter, estimated_tokens, create)
+    try:
+        response = await chat_policy.call(operation, hedge_after=hedge_after)
+    except BaseException:
+        await operation.release()
+        raise
+    await limiter.refund(estimated_tokens - response.usage.total_tokens)
+    return response.choices[0].message.content
+
+
+async def stream_chat_conversation(prompt, max_tokens=500, model=CHAT_MODEL):
+    """
+    Same as `ask_chat_conversation`, but yields the answer piece by piece as it
+    is generated. The call is retried until its first byte only: an answer
+    already partly sent cannot be taken back.
+
+    Raises:
+        asyncio.TimeoutError: If the answer is not complete within STREAM_DEADLINE.
+        httpx.HTTPError: If the connection broke in the middle of the answer.
+    """
+    limiter = limiter_for(model)
+    estimated_tokens = estimate_tokens(prompt, max_tokens, model)
+    await limiter.acquire(estimated_tokens)
+    parts = []
+
+    async def create():
+        return await clients.openai.chat.completions.create(
+            model=model,
+            messages=prompt,
+            max_tokens=max_tokens,
+            stop=None,
+            temperature=0.7,
+            stream=True,
+        )
+
+    operation = Metered(limiter, estimated_tokens, create)
+    try:
+        stream = await chat_policy.call(operation)
+    except BaseException:
+        await operation.release()
+        raise
+    deadline = time.monotonic() + STREAM_DEADLINE
+    try:
+        while True:
+            try:
+                chunk = await asyncio.wait_for(stream.__anext__(), deadline - time.monotonic())
+            except StopAsyncIteration:
+                break
+            delta = chunk.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                yield delta
+    except (openai.APIError, httpx.HTTPError, asyncio.TimeoutError) as e:
+        UPSTREAM_ERRORS.inc(upstream="openai", kind=error_kind(e))
+        raise
+    finally:
+        await stream.response.aclose()
+        # The part of the completion budget that was not used
+        await limiter.refund(max_tokens - count_tokens("".join(parts), model))
@@ -0,0 +1,157 @@
+import logging
+import math
+import re
+import time
+import zlib
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+NB_DIMENSIONS = 2048
+
+# Words that change the meaning of a question without moving its trigrams much
+ANCHOR_WORDS = {
+    "ne", "n", "pas", "jamais", "plus", "sans", "not", "no", "never", "don't",
+    "doesn't", "isn't", "without", "hier", "demain", "aujourd'hui", "yesterday",
+    "tomorrow", "today", "lundi", "mardi", "mercredi", "jeudi", "vendredi",
+    "samedi", "dimanche", "monday", "tuesday", "wednesday", "thursday", "friday",
+    "saturday", "sunday", "janvier", "février", "mars", "avril", "mai", "juin",
+    "juillet", "août", "septembre", "octobre", "novembre", "décembre", "january",
+    "february", "march", "april", "may", "june", "july", "august", "september",
+    "october", "november", "december",
+}
+TOKEN = re.compile(r"\d+|[\w']+")
+
+
+def normalize(question):
+    """Lowercase, collapse whitespace and drop trailing punctuation."""
+    question = re.sub(r"\s+", " ", question.lower()).strip()
+    return question.rstrip(" ?!.…")
+
+
+def embed(text):
+    """
+    Local bag of character trigrams, hashed into NB_DIMENSIONS buckets and
+    normalized, good enough to catch rephrasings that only differ by a few words
+    or typos.
+    """
+    padded = f"  {text} "
+    vector = {}
+    for i in range(len(padded) - 2):
+        bucket = zlib.crc32(padded[i : i + 3].encode()) % NB_DIMENSIONS
+        vector[bucket] = vector.get(bucket, 0) + 1
+    norm = math.sqrt(sum(v * v for v in vector.values()))
+    return {k: v / norm for k, v in vector.items()}
+
+
+def anchors(text):
+    """Numbers, negations, days and months of `text`, which a similar question must share."""
+    return frozenset(
+        token
+        for token in TOKEN.findall(text)
+        if token.isdigit() or token in ANCHOR_WORDS or token.startswith("n'")
+    )
+
+
+def cosine(a, b):
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(v * b.get(k, 0) for k, v in a.items())
+
+
+class ResponseCache:
+    """
+    Cache of answers to standalone questions, in front of the chat API.
+
+    The exact tier is keyed on the normalized question, the model and max_tokens.
+    The optional similarity tier returns the answer of the closest cached
+    question whose trigram embedding has a cosine similarity of at least
+    `similarity` with the one asked, and which has the same numbers, negations,
+    days and months: "en 2022" and "en 2023" are close in trigrams but not in
+    meaning.
+
+    Args:
+        maxsize (int): Maximum number of cached answers, least recently used evicted first.
+        ttl (float): Lifetime of an answer, in seconds.
+        similarity (float, optional): Threshold of the similarity tier, None to disable it.
+    """
+
+    def __init__(self, maxsize=1000, ttl=3600, similarity=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.similarity = similarity
+        self._entries = OrderedDict()
+        self.exact_hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self.saved_tokens = 0
+
+    def get(self, question, model, max_tokens):
+        now = time.monotonic()
+        question = normalize(question)
+        key = (question, model, max_tokens)
+        entry = self._entries.get(key)
+        if entry is not None and entry["expires_at"] < now:
+            del self._entries[key]
+            entry = None
+
+        if entry is None and self.similarity:
+            entry = self._closest(question, model, max_tokens, now)
+            if entry is not None:
+                self.similar_hits += 1
+        elif entry is not None:
+            self.exact_hits += 1
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(entry["key"])
+        self.saved_tokens += entry["tokens"]
+        logger.info(f"Answer served from cache ({entry['tokens']} tokens saved)")
+        return entry["answer"]
+
+    def put(self, question, model, max_tokens, answer, tokens):
+        """
+        Args:
+            tokens (int): Tokens billed to produce the answer, saved by each hit.
+        """
+        question = normalize(question)
+        key = (question, model, max_tokens)
+        self._entries[key] = {
+            "key": key,
+            "answer": answer,
+            "tokens": tokens,
+            "embedding": embed(question) if self.similarity else None,
+            "anchors": anchors(question) if self.similarity else None,
+            "expires_at": time.monotonic() + self.ttl,
+        }
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _closest(self, question, model, max_tokens, now):
+        embedding = embed(question)
+        question_anchors = anchors(question)
+        best, best_score = None, self.similarity
+        for entry in self._entries.values():
+            _, entry_model, entry_max_tokens = entry["key"]
+            if entry_model != model or entry_max_tokens != max_tokens:
+                continue
+            if entry["expires_at"] < now or entry["anchors"] != question_anchors:
+                continue
+            score = cosine(embedding, entry["embedding"])
+            if score >= best_score:
+                best, best_score = entry, score
+        return best
+
+    def stats(self):
+        lookups = self.exact_hits + self.similar_hits + self.misses
+        return {
+            "size": len(self._entries),
+            "exact_hits": self.exact_hits,
+            "similar_hits": self.similar_hits,
+            "misses": self.misses,
+            "hit_rate": (self.exact_hits + self.similar_hits) / lookups if lookups else 0.0,
+            "saved_tokens": self.saved_tokens,
+        }
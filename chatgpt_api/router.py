@@ -0,0 +1,95 @@
+import logging
+from collections import namedtuple
+
+from metrics import LLM_COST, LLM_SECONDS, LLM_TOKENS, ROUTES
+
+logger = logging.getLogger(__name__)
+
+# USD per 1000 prompt and completion tokens
+MODEL_PRICES = {
+    "gpt-4": (0.03, 0.06),
+    "gpt-4-1106-preview": (0.01, 0.03),
+    "gpt-3.5-turbo": (0.0015, 0.002),
+}
+
+Route = namedtuple("Route", ["model", "max_tokens", "reason"])
+
+
+def parse_route(value):
+    """
+    Args:
+        value (str): "model:max_tokens", as written in config.ini.
+
+    Returns:
+        tuple: The model and max_tokens, None for an empty value.
+    """
+    if not value:
+        return None
+    model, max_tokens = value.split(":")
+    return model.strip(), int(max_tokens)
+
+
+def cost(model, prompt_tokens, completion_tokens):
+    """Estimated cost of a call in USD, 0 for a model without a known price."""
+    prompt_price, completion_price = MODEL_PRICES.get(model, (0, 0))
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+
+class ModelRouter:
+    """
+    Picks the chat model and the answer length of each turn.
+
+    Trial users are answered by the `trial` route. Subscribers' questions of at
+    most `short_tokens` tokens, which rarely need the larger model, take the
+    `short` route, the others the `subscriber` route. Every decision, and the
+    latency and cost of every answer, are logged and exported as metrics.
+
+    Args:
+        trial (tuple): Model and max_tokens of the trial users.
+        subscriber (tuple): Model and max_tokens of the subscribers.
+        short (tuple, optional): Model and max_tokens of the subscribers' short
+            questions, the `subscriber` route otherwise.
+        short_tokens (int): Length of a short question, in tokens.
+    """
+
+    def __init__(self, trial, subscriber, short=None, short_tokens=0):
+        self.trial = trial
+        self.subscriber = subscriber
+        self.short = short
+        self.short_tokens = short_tokens
+
+    def route(self, question_tokens, subscriber):
+        """
+        Args:
+            question_tokens (int): Length of the question, from `count_tokens`.
+            subscriber (bool): Whether the user has a subscription or a pass.
+
+        Returns:
+            Route: The model, max_tokens and the reason of the decision.
+        """
+        if not subscriber:
+            (model, max_tokens), reason = self.trial, "trial"
+        elif self.short is not None and question_tokens <= self.short_tokens:
+            (model, max_tokens), reason = self.short, "short"
+        else:
+            (model, max_tokens), reason = self.subscriber, "subscriber"
+
+        plan = "subscriber" if subscriber else "trial"
+        ROUTES.inc(plan=plan, model=model, reason=reason)
+        logger.info(
+            f"Routed a {plan} question of {question_tokens} tokens to {model} "
+            f"(max_tokens={max_tokens}, {reason})"
+        )
+        return Route(model, max_tokens, reason)
+
+    def record(self, route, seconds, prompt_tokens, completion_tokens):
+        """Account for an answer of `route.model`."""
+        price = cost(route.model, prompt_tokens, completion_tokens)
+        LLM_SECONDS.observe(seconds, model=route.model)
+        LLM_TOKENS.inc(prompt_tokens, model=route.model, kind="prompt")
+        LLM_TOKENS.inc(completion_tokens, model=route.model, kind="completion")
+        LLM_COST.inc(price, model=route.model)
+        logger.info(
+            f"Answer of {route.model} ({route.reason}) in {seconds:.2f}s, "
+            f"{prompt_tokens}+{completion_tokens} tokens, ${price:.4f}"
+        )
@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import re
+from collections import Counter
+
+import openai
+
+from chatgpt_api.chatgpt import Metered, openai_breaker
+from http_clients import clients
+from rate_limiter import AsyncRateLimiter
+from resilience import CircuitOpenError, Policy
+from utils import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# Local method, without any call to OpenAI
+EXTRACTIVE = "extractive"
+
+SUMMARY_INSTRUCTIONS = (
+    "Summarize the conversation below between a user and WhatIA, in the language "
+    "of the conversation and in at most {words} words. Keep the facts, names, "
+    "preferences and open questions of the user, drop greetings and small talk."
+)
+
+SENTENCE = re.compile(r"(?<=[.!?\n])\s+")
+WORD = re.compile(r"\w{4,}")
+
+summary_limiter = AsyncRateLimiter(
+    "summary", requests_per_minute=60, tokens_per_minute=60000
+)
+# Summaries run in the background and have a local fallback, no need to insist
+summary_policy = Policy("openai", timeout=30, retries=1, breaker=openai_breaker)
+
+
+def transcript(summary, messages):
+    lines = [f"Earlier: {summary['content']}"] if summary is not None else []
+    lines += [f"{message['role'].capitalize()}: {message['content']}" for message in messages]
+    return "\n".join(lines)
+
+
+def extractive_summary(text, max_tokens):
+    """
+    Keep the sentences of `text` made of its most frequent words, in their
+    original order, within `max_tokens`.
+    """
+    sentences = [sentence.strip() for sentence in SENTENCE.split(text) if sentence.strip()]
+    frequencies = Counter(word.lower() for word in WORD.findall(text))
+
+    def score(sentence):
+        words = [word.lower() for word in WORD.findall(sentence)]
+        return sum(frequencies[word] for word in words) / (len(words) + 1)
+
+    kept = set()
+    total = 0
+    for i in sorted(range(len(sentences)), key=lambda i: score(sentences[i]), reverse=True):
+        tokens = count_tokens(sentences[i])
+        if total + tokens > max_tokens:
+            continue
+        kept.add(i)
+        total += tokens
+    return " ".join(sentences[i] for i in sorted(kept))
+
+
+async def llm_summary(text, model, max_tokens):
+    prompt = [
+        {"role": "system", "content": SUMMARY_INSTRUCTIONS.format(words=max_tokens * 2 // 3)},
+        {"role": "user", "content": text},
+    ]
+    estimated_tokens = count_tokens(text) + max_tokens
+    await summary_limiter.acquire(estimated_tokens)
+
+    async def create():
+        return await clients.openai.chat.completions.create(
+            model=model, messages=prompt, max_tokens=max_tokens, temperature=0
+        )
+
+    # A retry is billed like the first call
+    operation = Metered(summary_limiter, estimated_tokens, create)
+    try:
+        response = await summary_policy.call(operation)
+    except BaseException:
+        await operation.release()
+        raise
+    await summary_limiter.refund(estimated_tokens - response.usage.total_tokens)
+    logger.info(f"Summary by {model} used {response.usage.total_tokens} tokens")
+    return response.choices[0].message.content
+
+
+class Summarizer:
+    """
+    Rolling summary of the older messages of a conversation, so that prompts
+    stay short for long conversations.
+
+    Once the messages not covered by the summary weigh more than `threshold`
+    tokens, all of them but the last `keep` are folded, with the previous
+    summary, into a new summary of at most `max_tokens` tokens. This is done by
+    `model`, a cheaper model than the chat one, or locally when `model` is
+    EXTRACTIVE or OpenAI fails.
+
+    Args:
+        history_manager (HistoryManager): Gives the messages still in use.
+        threshold (int): Tokens of unsummarized messages triggering a summary.
+        keep (int): Number of recent messages left out of the summary.
+        max_tokens (int): Maximum length of a summary.
+        model (str): Chat model writing the summaries, or EXTRACTIVE.
+    """
+
+    def __init__(self, history_manager, threshold=600, keep=4, max_tokens=150, model="gpt-3.5-turbo"):
+        self.history_manager = history_manager
+        self.threshold = threshold
+        self.keep = keep
+        self.max_tokens = max_tokens
+        self.model = model
+
+    def due(self, history, summary=None, now=None):
+        """Whether the conversation should be summarized again."""
+        messages = self.history_manager.unsummarized(history, summary, now)
+        if len(messages) <= self.keep:
+            return False
+        return sum(self.history_manager.tokens(entry) for entry in messages) > self.threshold
+
+    async def summarize(self, history, summary=None, now=None):
+        """
+        Returns:
+            dict: The new summary, None if none is due.
+        """
+        if not self.due(history, summary, now):
+            return None
+        messages = self.history_manager.unsummarized(history, summary, now)[: -self.keep or None]
+        # Messages stored before they had a time cannot be marked as summarized
+        if messages[-1].get("ts") is None:
+            return None
+        text = transcript(summary, messages)
+
+        content = None
+        if self.model != EXTRACTIVE:
+            try:
+                content = await llm_summary(text, self.model, self.max_tokens)
+            except (openai.OpenAIError, asyncio.TimeoutError, CircuitOpenError) as e:
+                logger.error(f"Summary by {self.model} failed, falling back to extractive: {e!r}")
+        if not content:
+            content = extractive_summary(text, self.max_tokens)
+
+        return {
+            "content": content,
+            "tokens": count_tokens(content),
+            "until": messages[-1]["ts"],
+        }
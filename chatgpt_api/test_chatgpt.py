@@ -1,15 +1,28 @@
 import asyncio
+import os
 from pathlib import Path
 
 import pytest
+import pytest_asyncio
 from dotenv import load_dotenv
 
-from chatgpt_api.chatgpt import ask_chat_conversation
+from benchmarks.fake_upstreams import FakeUpstreams
+from chatgpt_api import chatgpt
+from chatgpt_api.chatgpt import ask_chat_conversation, stream_chat_conversation
+from http_clients import ClientPool
+from rate_limiter import AsyncRateLimiter
+from resilience import CircuitBreaker
 
 load_dotenv(dotenv_path=Path("..", ".env.development"))
+# Key of the tests running against a fake OpenAI
+FAKE_API_KEY = "sk-test"
 # OpenAI Chat GPT
 
 
+@pytest.mark.skipif(
+    os.getenv("OPENAI_API_KEY", FAKE_API_KEY) == FAKE_API_KEY,
+    reason="Calls the real OpenAI API, which needs a real OPENAI_API_KEY",
+)
 @pytest.mark.asyncio
 async def test_ask_chat_conversation_multiple_calls():
     message_logs = [
@@ -39,3 +52,58 @@ async def test_ask_chat_conversation_multiple_calls():
     for response in responses:
         assert response is not None
         assert len(response) > 0
+
+
+@pytest_asyncio.fixture
+async def fake_openai(monkeypatch):
+    upstreams = FakeUpstreams(llm_latency=0)
+    await upstreams.start()
+    monkeypatch.setenv("OPENAI_BASE_URL", f"{upstreams.url}/v1")
+    monkeypatch.setenv("OPENAI_API_KEY", FAKE_API_KEY)
+    pool = ClientPool()
+    monkeypatch.setattr(chatgpt, "clients", pool)
+    # Failures of the other tests must not leave the circuit open
+    breaker = CircuitBreaker("openai")
+    monkeypatch.setattr(chatgpt, "openai_breaker", breaker)
+    monkeypatch.setattr(chatgpt.chat_policy, "breaker", breaker)
+    yield upstreams
+    await pool.stop()
+    await upstreams.stop()
+
+
+@pytest.mark.asyncio
+async def test_stalled_stream_hits_the_deadline(fake_openai, monkeypatch):
+    fake_openai.token_interval = 0.5
+    monkeypatch.setattr(chatgpt, "STREAM_DEADLINE", 0.2)
+    prompt = [{"role": "user", "content": "Bonjour"}]
+
+    parts = []
+    with pytest.raises(asyncio.TimeoutError):
+        async for delta in stream_chat_conversation(prompt, model="gpt-3.5-turbo"):
+            parts.append(delta)
+    assert parts == ["Voici "]
+    # The fake notices the closed connection on its next write
+    await asyncio.sleep(0.5)
+
+
+@pytest.mark.asyncio
+async def test_hedged_attempts_draw_from_the_limiter(fake_openai, monkeypatch):
+    fake_openai.llm_latency = 0.3
+    limiter = AsyncRateLimiter("test-chat", requests_per_minute=1000, tokens_per_minute=600)
+    monkeypatch.setitem(chatgpt.model_limiters, "gpt-3.5-turbo", limiter)
+    prompt = [{"role": "user", "content": "Bonjour"}]
+    estimated = chatgpt.estimate_tokens(prompt, 100, "gpt-3.5-turbo")
+
+    answer = await ask_chat_conversation(
+        prompt, max_tokens=100, model="gpt-3.5-turbo", hedge_after=0.05
+    )
+
+    assert answer == fake_openai.answer
+    assert fake_openai.chat_calls == 2
+    assert limiter.acquired == 2
+    # The answer is billed its real usage, the lost hedge its estimate
+    assert limiter.metrics()["tokens_available"] == pytest.approx(
+        600 - 120 - estimated, abs=10
+    )
+    # The fake is still answering the lost hedge
+    await asyncio.sleep(fake_openai.llm_latency)
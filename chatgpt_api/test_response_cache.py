@@ -0,0 +1,63 @@
+from chatgpt_api.response_cache import ResponseCache
+
+
+def test_exact_tier_uses_the_normalized_question_model_and_max_tokens():
+    cache = ResponseCache()
+    cache.put("Qu'est-ce que le machine learning ?", "gpt-4", 500, "Une branche de l'IA.", 120)
+
+    assert cache.get("qu'est-ce que le   machine learning", "gpt-4", 500) == "Une branche de l'IA."
+    assert cache.get("Qu'est-ce que le machine learning ?", "gpt-3.5-turbo", 500) is None
+    assert cache.get("Qu'est-ce que le machine learning ?", "gpt-4", 200) is None
+
+    stats = cache.stats()
+    assert stats["exact_hits"] == 1
+    assert stats["misses"] == 2
+    assert stats["saved_tokens"] == 120
+
+
+def test_similarity_tier_catches_rephrasings_only():
+    cache = ResponseCache(similarity=0.8)
+    cache.put(
+        "Comment fonctionne un moteur à combustion interne ?", "gpt-4", 500, "Par explosions.", 200
+    )
+
+    assert cache.get("comment fonctionne un moteur a combustion interne", "gpt-4", 500) == (
+        "Par explosions."
+    )
+    assert cache.get("Quel est le meilleur restaurant italien ?", "gpt-4", 500) is None
+    assert cache.stats()["similar_hits"] == 1
+
+
+def test_expired_and_least_recently_used_answers_are_dropped():
+    cache = ResponseCache(maxsize=2, ttl=0)
+    cache.put("a", "gpt-4", 500, "A", 1)
+    assert cache.get("a", "gpt-4", 500) is None
+
+    cache = ResponseCache(maxsize=2)
+    for question in ("a", "b", "c"):
+        cache.put(question, "gpt-4", 500, question.upper(), 1)
+    assert cache.get("a", "gpt-4", 500) is None
+    assert cache.get("c", "gpt-4", 500) == "C"
+    assert cache.stats()["size"] == 2
+
+
+def test_similar_questions_differing_by_a_date_day_or_negation_miss():
+    cache = ResponseCache(similarity=0.8)
+    pairs = [
+        (
+            "Quelle était la population de la France métropolitaine en 2023 ?",
+            "Quelle était la population de la France métropolitaine en 2022 ?",
+        ),
+        (
+            "Écris un email à mon équipe pour dire que la réunion est reportée à lundi",
+            "Écris un email à mon équipe pour dire que la réunion est reportée à mardi",
+        ),
+        (
+            "Rédige un message d'absence pour dire que je serai absent toute la semaine",
+            "Rédige un message d'absence pour dire que je ne serai pas absent toute la semaine",
+        ),
+    ]
+    for cached, asked in pairs:
+        cache.put(cached, "gpt-4", 500, "Réponse", 100)
+        assert cache.get(asked, "gpt-4", 500) is None
+    assert cache.stats()["similar_hits"] == 0
@@ -0,0 +1,24 @@
+from chatgpt_api.router import ModelRouter, cost, parse_route
+from metrics import LLM_COST, ROUTES
+
+
+def test_routes_depend_on_the_plan_and_the_question_length():
+    router = ModelRouter(
+        trial=parse_route("gpt-3.5-turbo:300"),
+        subscriber=parse_route("gpt-4:500"),
+        short=parse_route("gpt-3.5-turbo : 200"),
+        short_tokens=15,
+    )
+
+    assert router.route(200, subscriber=False) == ("gpt-3.5-turbo", 300, "trial")
+    assert router.route(10, subscriber=True) == ("gpt-3.5-turbo", 200, "short")
+    route = router.route(40, subscriber=True)
+    assert route == ("gpt-4", 500, "subscriber")
+    assert ROUTES.value(plan="subscriber", model="gpt-4", reason="subscriber") >= 1
+
+    spent = LLM_COST.value(model="gpt-4")
+    router.record(route, 1.5, prompt_tokens=1000, completion_tokens=500)
+    assert LLM_COST.value(model="gpt-4") - spent == cost("gpt-4", 1000, 500) == 0.06
+
+    without_short = ModelRouter(trial=("gpt-3.5-turbo", 300), subscriber=("gpt-4", 500), short=parse_route(""))
+    assert without_short.route(1, subscriber=True).model == "gpt-4"
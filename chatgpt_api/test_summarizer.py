@@ -0,0 +1,79 @@
+import datetime
+from types import SimpleNamespace
+
+import pytest
+
+from chatgpt_api import summarizer as summarizer_module
+from chatgpt_api.summarizer import EXTRACTIVE, Summarizer, llm_summary
+from history import HistoryManager
+from rate_limiter import AsyncRateLimiter
+from resilience import CircuitBreaker
+
+NOW = datetime.datetime(2024, 1, 1, 12, 0)
+
+ANSWER = (
+    "Le moteur à combustion interne brûle du carburant dans un cylindre. "
+    "La combustion pousse le piston, qui fait tourner le vilebrequin. "
+    "Il existe aussi des moteurs électriques. "
+)
+
+
+def conversation(nb_turns):
+    history = []
+    for i in range(nb_turns):
+        ts = NOW - datetime.timedelta(minutes=nb_turns - i)
+        history.append({"role": "user", "content": f"Question {i} sur le moteur ?", "tokens": 8, "ts": ts})
+        history.append({"role": "assistant", "content": ANSWER * 3, "tokens": 120, "ts": ts})
+    return history
+
+
+@pytest.mark.asyncio
+async def test_older_messages_are_folded_into_a_short_summary():
+    manager = HistoryManager(token_budget=1000, ttl=10)
+    summarizer = Summarizer(manager, threshold=300, keep=2, max_tokens=40, model=EXTRACTIVE)
+
+    assert not summarizer.due(conversation(2), now=NOW)
+    history = conversation(4)
+    assert summarizer.due(history, now=NOW)
+
+    summary = await summarizer.summarize(history, now=NOW)
+    assert 0 < summary["tokens"] <= 40
+    assert "moteur" in summary["content"]
+    assert summary["until"] == history[-3]["ts"]
+    # Only the last turn is left next to the summary
+    assert manager.trim(history, now=NOW, summary=summary) == history[-2:]
+    assert not summarizer.due(history, summary, now=NOW)
+
+    assert manager.savings(history, summary, now=NOW) == 3 * 128 - summary["tokens"]
+    prompt = manager.prompt({"role": "system", "content": "sys"}, history[-2:], summary)
+    assert prompt[1]["content"].endswith(summary["content"])
+    assert len(prompt) == 4
+
+
+class Unavailable(Exception):
+    status = 503
+
+
+@pytest.mark.asyncio
+async def test_retried_summary_draws_from_the_limiter_again(monkeypatch):
+    faults = [Unavailable()]
+
+    async def create(**kwargs):
+        if faults:
+            raise faults.pop()
+        return SimpleNamespace(
+            usage=SimpleNamespace(total_tokens=50),
+            choices=[SimpleNamespace(message=SimpleNamespace(content="Résumé"))],
+        )
+
+    openai = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    monkeypatch.setattr(summarizer_module, "clients", SimpleNamespace(openai=openai))
+    limiter = AsyncRateLimiter("test-summary", requests_per_minute=1000, tokens_per_minute=6000)
+    monkeypatch.setattr(summarizer_module, "summary_limiter", limiter)
+    monkeypatch.setattr(summarizer_module.summary_policy, "breaker", CircuitBreaker("test-summary"))
+    monkeypatch.setattr(summarizer_module.summary_policy, "backoff", 0.01)
+
+    assert await llm_summary("User: Bonjour", "gpt-3.5-turbo", max_tokens=100) == "Résumé"
+    assert limiter.acquired == 2
+    # The failed attempt gave its tokens back, the answer is billed its real usage
+    assert limiter.metrics()["tokens_available"] == pytest.approx(6000 - 50, abs=10)
@@ -0,0 +1,142 @@
+"""
+Stream the users to stdout or a file, as NDJSON or CSV, in constant memory.
+
+    python export_users.py --format ndjson > users.ndjson
+    python export_users.py --format csv --fields phone_number,nb_tokens,current_period_end
+    python export_users.py --after 64f1c0ffee0123456789abcd >> users.ndjson
+
+Chat histories are left out unless --with-history is given. The `_id` of the
+last exported user is printed on stderr at the end, or when the export is
+interrupted, to resume it with --after.
+"""
+import argparse
+import csv
+import datetime
+import json
+import sys
+
+from bson import ObjectId
+
+from mongodb_db import UserCollection
+
+DEFAULT_FIELDS = [
+    "_id",
+    "phone_number",
+    "current_period_end",
+    "nb_tokens",
+    "nb_messages",
+    "is_blocked",
+    "datetime_created",
+    "timestamp_last_messages",
+]
+
+
+def to_json(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def export_users(
+    users,
+    output,
+    format="ndjson",
+    fields=None,
+    with_history=False,
+    batch_size=500,
+    after=None,
+    header=None,
+):
+    """
+    Write the users to `output`.
+
+    Args:
+        users (UserCollection): The collection to export.
+        output (file): Text stream written to.
+        format (str): "ndjson" or "csv".
+        fields (list, optional): Fields to export, every field but the history by default
+            for NDJSON, DEFAULT_FIELDS for CSV.
+        with_history (bool): Also export the chat histories.
+        batch_size (int): Number of documents read per query.
+        after (ObjectId, optional): `_id` of the last user already exported.
+        header (bool, optional): Write the CSV header, by default unless resuming
+            with `after`.
+
+    Returns:
+        ObjectId: `_id` of the last exported user, None if there was none.
+    """
+    if format == "csv" and fields is None:
+        fields = DEFAULT_FIELDS
+    if fields is not None:
+        projection = {field: 1 for field in fields}
+        if with_history:
+            projection["history"] = 1
+    else:
+        projection = None if with_history else {"history": 0}
+
+    # A resumed export is appended to a file that already has the header
+    if header is None:
+        header = after is None
+    writer = None
+    if format == "csv":
+        columns = list(fields) + (["history"] if with_history else [])
+        writer = csv.DictWriter(output, fieldnames=columns, extrasaction="ignore")
+        if header:
+            writer.writeheader()
+
+    last_id = after
+    try:
+        for doc in users.iter_users(projection=projection, batch_size=batch_size, after=after):
+            if writer is not None:
+                if "history" in doc:
+                    doc["history"] = json.dumps(doc["history"], default=to_json)
+                writer.writerow(doc)
+            else:
+                output.write(json.dumps(doc, default=to_json, ensure_ascii=False) + "\n")
+            last_id = doc["_id"]
+    finally:
+        if last_id is not None:
+            print(f"Last exported user: {last_id}", file=sys.stderr)
+    return last_id
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--format", choices=["ndjson", "csv"], default="ndjson")
+    parser.add_argument("--fields", help="Comma separated fields to export")
+    parser.add_argument("--with-history", action="store_true")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--after", help="_id of the last user already exported")
+    parser.add_argument("--output", help="File to write, stdout by default")
+    parser.add_argument("--collection", default="users")
+    args = parser.parse_args()
+
+    header = None
+    if args.output:
+        # Only a resumed export appends to the file
+        output = open(args.output, "a" if args.after else "w", newline="")
+        header = output.tell() == 0
+    else:
+        output = sys.stdout
+    try:
+        export_users(
+            UserCollection(args.collection),
+            output,
+            format=args.format,
+            fields=args.fields.split(",") if args.fields else None,
+            with_history=args.with_history,
+            batch_size=args.batch_size,
+            after=ObjectId(args.after) if args.after else None,
+            header=header,
+        )
+    except KeyboardInterrupt:
+        sys.exit(130)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
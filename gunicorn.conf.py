@@ -0,0 +1,36 @@
+"""
+Production server: gunicorn managing one uvicorn worker process per core.
+
+    gunicorn chatbot:app -c gunicorn.conf.py
+
+The workers coordinate through the SQLite database at SHARED_STATE_PATH (rate
+limits, per-user ordering of the turns, deduplication, cache versions, voice
+replies, maintenance, metrics). It is reset when gunicorn starts.
+"""
+import multiprocessing
+import os
+
+CERTS = "/etc/letsencrypt/live/secure.whatia.fr"
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+worker_class = "uvicorn.workers.UvicornWorker"
+# The workers are asynchronous, one per core keeps every core busy
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+keyfile = os.getenv("SSL_KEYFILE", f"{CERTS}/privkey.pem")
+certfile = os.getenv("SSL_CERTFILE", f"{CERTS}/fullchain.pem")
+# Queued turns are drained on shutdown, and the longest turn (a transcription
+# then a full answer) takes a few minutes
+graceful_timeout = 300
+timeout = 120
+keepalive = 60
+
+shared_state_path = os.environ.setdefault("SHARED_STATE_PATH", "/tmp/whatia-state.sqlite3")
+
+
+def on_starting(server):
+    # Leases and inboxes of the previous run are meaningless to the new workers
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            os.remove(shared_state_path + suffix)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,124 @@
+import datetime
+
+from utils import count_tokens
+
+
+class HistoryManager:
+    """
+    Keeps the stored conversation history within a token budget and an age limit.
+
+    History entries are stored as `{"role", "content", "tokens", "ts"}`: the token
+    count is computed once, when the message is added, and reused on every
+    following turn. Entries written before these fields existed are counted on
+    the fly and never considered expired.
+
+    Older messages may be replaced by a summary `{"content", "tokens", "until"}`,
+    `until` being the time of the last message it covers. Those messages are
+    then left out of the window, and the summary expires with them.
+
+    Args:
+        token_budget (int): Maximum number of tokens of history sent with a question.
+        ttl (int): Age in minutes after which a message is dropped from the history.
+    """
+
+    def __init__(self, token_budget=1000, ttl=10):
+        self.token_budget = token_budget
+        self.ttl = datetime.timedelta(minutes=ttl)
+
+    @staticmethod
+    def tokens(entry):
+        tokens = entry.get("tokens")
+        if tokens is None:
+            tokens = count_tokens(entry["content"])
+        return tokens
+
+    def add(self, history, role, content, tokens=None):
+        if tokens is None:
+            tokens = count_tokens(content)
+        history.append(
+            {
+                "role": role,
+                "content": content,
+                "tokens": tokens,
+                "ts": datetime.datetime.utcnow(),
+            }
+        )
+
+    def active_summary(self, summary, now=None):
+        """The summary, None if there is none or it has expired."""
+        if summary is None:
+            return None
+        if now is None:
+            now = datetime.datetime.utcnow()
+        if summary["until"] < now - self.ttl:
+            return None
+        return summary
+
+    def unsummarized(self, history, summary=None, now=None):
+        """Entries younger than `ttl` and not covered by `summary`."""
+        if now is None:
+            now = datetime.datetime.utcnow()
+        return [entry for entry in history if not self._dropped(entry, now, summary)]
+
+    def _dropped(self, entry, now, summary):
+        ts = entry.get("ts")
+        if ts is None:
+            return False
+        return ts < now - self.ttl or summary is not None and ts <= summary["until"]
+
+    def trim(self, history, now=None, summary=None):
+        """
+        Returns:
+            list[dict]: The most recent entries that are younger than `ttl`, not
+            covered by `summary`, and fit in `token_budget` once the summary is
+            counted. The last entry is always kept.
+        """
+        if now is None:
+            now = datetime.datetime.utcnow()
+
+        kept = []
+        total = summary["tokens"] if summary is not None else 0
+        for entry in reversed(history):
+            if self._dropped(entry, now, summary):
+                break
+            total += self.tokens(entry)
+            if kept and total > self.token_budget:
+                break
+            kept.append(entry)
+        kept.reverse()
+
+        # A window starting with an answer has lost its question
+        while len(kept) > 1 and kept[0]["role"] == "assistant":
+            kept.pop(0)
+        return kept
+
+    def savings(self, history, summary, now=None):
+        """
+        Prompt tokens saved by `summary`: the window without it, minus the
+        window with it and the summary itself. Negative when the summary brings
+        back context that no longer fitted in the budget.
+        """
+        if summary is None:
+            return 0
+        window = self.trim(history, now)
+        summarized = self.trim(history, now, summary)
+        return (
+            sum(self.tokens(entry) for entry in window)
+            - sum(self.tokens(entry) for entry in summarized)
+            - summary["tokens"]
+        )
+
+    @staticmethod
+    def prompt(system_message, history, summary=None):
+        """Messages to send to the chat API, without the bookkeeping fields."""
+        messages = [system_message]
+        if summary is not None:
+            messages.append(
+                {
+                    "role": "system",
+                    "content": f"Summary of the earlier conversation: {summary['content']}",
+                }
+            )
+        return messages + [
+            {"role": entry["role"], "content": entry["content"]} for entry in history
+        ]
@@ -0,0 +1,127 @@
+import asyncio
+import logging
+import threading
+
+import aiohttp
+import boto3
+import httpx
+from botocore.config import Config
+from openai import AsyncOpenAI
+
+logger = logging.getLogger(__name__)
+
+# Idle connections are kept this long, in seconds, to be reused by the next call
+KEEPALIVE_TIMEOUT = 60
+CONNECT_TIMEOUT = 5
+
+# Per upstream: size of the connection pool and deadline of a request, in seconds
+DEFAULT_LIMITS = {
+    "twilio": {"connections": 10, "timeout": 15},
+    "assemblyai": {"connections": 10, "timeout": 30},
+    "openai": {"connections": 20, "timeout": 120},
+    "polly": {"connections": 10, "timeout": 10},
+}
+
+POLLY_REGION = "us-west-2"
+
+
+class ClientPool:
+    """
+    Application-lifetime connections to the upstream APIs, shared by every call
+    of every integration instead of each call opening its own.
+
+    The aiohttp sessions, the OpenAI client and the Polly client are created on
+    first use and keep their connections alive between calls. `stop` closes
+    them all; a client used again afterwards is recreated. The Polly client is
+    used from worker threads, it is created by `start` and behind a lock.
+
+    Args:
+        limits (dict, optional): Overrides of DEFAULT_LIMITS, by upstream name.
+    """
+
+    def __init__(self, limits=None):
+        self.limits = {name: dict(limit) for name, limit in DEFAULT_LIMITS.items()}
+        for name, limit in (limits or {}).items():
+            self.limits.setdefault(name, {}).update(limit)
+        self._sessions = {}
+        self._openai = None
+        self._polly = None
+        self._polly_lock = threading.Lock()
+
+    async def start(self):
+        for name in ("twilio", "assemblyai"):
+            self.session(name)
+        # Building a boto3 client reads files, off the event loop
+        await asyncio.to_thread(lambda: self.polly)
+
+    async def stop(self):
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions = {}
+        if self._openai is not None:
+            await self._openai.close()
+            self._openai = None
+        with self._polly_lock:
+            if self._polly is not None:
+                self._polly.close()
+                self._polly = None
+
+    def session(self, name):
+        """
+        aiohttp session dedicated to the upstream `name`, which must be called
+        from the event loop.
+        """
+        session = self._sessions.get(name)
+        if session is None or session.closed:
+            limit = self.limits[name]
+            session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=limit["connections"],
+                    keepalive_timeout=KEEPALIVE_TIMEOUT,
+                    ttl_dns_cache=300,
+                ),
+                timeout=aiohttp.ClientTimeout(
+                    total=limit["timeout"], connect=CONNECT_TIMEOUT
+                ),
+            )
+            self._sessions[name] = session
+        return session
+
+    @property
+    def openai(self):
+        if self._openai is None:
+            limit = self.limits["openai"]
+            # Retries are made by the resilience policies, not by the client
+            self._openai = AsyncOpenAI(
+                max_retries=0,
+                http_client=httpx.AsyncClient(
+                    limits=httpx.Limits(
+                        max_connections=limit["connections"],
+                        max_keepalive_connections=limit["connections"],
+                        keepalive_expiry=KEEPALIVE_TIMEOUT,
+                    ),
+                    timeout=httpx.Timeout(limit["timeout"], connect=CONNECT_TIMEOUT),
+                )
+            )
+        return self._openai
+
+    @property
+    def polly(self):
+        # Concurrent first calls from `asyncio.to_thread` would each build a client
+        with self._polly_lock:
+            if self._polly is None:
+                limit = self.limits["polly"]
+                self._polly = boto3.client(
+                    "polly",
+                    region_name=POLLY_REGION,
+                    config=Config(
+                        max_pool_connections=limit["connections"],
+                        connect_timeout=CONNECT_TIMEOUT,
+                        read_timeout=limit["timeout"],
+                        retries={"max_attempts": 2, "mode": "standard"},
+                    ),
+                )
+            return self._polly
+
+
+clients = ClientPool()
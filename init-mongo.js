@@ -12,4 +12,13 @@ targetDb.createUser({
 targetDb.createCollection("users");
 
 // Create a unique index on the "phone_number" field in the "users" collection
-targetDb.users.createIndex({ phone_number: 1 }, { unique: true });
\ No newline at end of file
+targetDb.users.createIndex({ phone_number: 1 }, { unique: true });
+// Used by the maintenance jobs
+targetDb.users.createIndex({ current_period_end: 1 });
+targetDb.users.createIndex({ timestamp_last_messages: 1 });
+// Append-only log of the conversation turns, read per user in time order
+targetDb.createCollection("messages");
+targetDb.messages.createIndex({ phone_number: 1, ts: 1 });
+// Stripe webhook events, keyed by event id for idempotency
+targetDb.createCollection("stripe_events");
+targetDb.stripe_events.createIndex({ status: 1, received_at: 1 });
@@ -0,0 +1,95 @@
+import asyncio
+import logging
+import time
+
+from metrics import MAINTENANCE_DOCUMENTS, MAINTENANCE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class MaintenanceScheduler:
+    """
+    In-process scheduler of the periodic maintenance jobs, run one after the
+    other every `interval` seconds.
+
+    A job is a coroutine function called with a `throttle` coroutine, to be
+    awaited between two batches, and returning the number of documents it
+    touched. The throttle pauses `pause` seconds, and keeps pausing while `busy`
+    reports live traffic, up to `max_wait` seconds, so that maintenance does not
+    compete with conversations for the database.
+
+    When the app runs in several processes, `leader` elects the one running the
+    jobs: a round is skipped by the processes for which it returns False.
+
+    Args:
+        interval (float): Seconds between two runs of the jobs.
+        first_delay (float): Seconds between the start and the first run.
+        pause (float): Seconds to wait between two batches.
+        busy (callable, optional): Returns True while live traffic is high.
+        max_wait (float): Longest wait for traffic to calm down, in seconds.
+        leader (callable, optional): Returns True if this process runs the jobs.
+    """
+
+    def __init__(
+        self, interval=86400, first_delay=60, pause=0.1, busy=None, max_wait=60, leader=None
+    ):
+        self.interval = interval
+        self.first_delay = first_delay
+        self.pause = pause
+        self.busy = busy
+        self.max_wait = max_wait
+        self.leader = leader
+        self.jobs = {}
+        self.reports = {}
+        self._task = None
+
+    def add(self, name, job):
+        self.jobs[name] = job
+
+    async def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def throttle(self):
+        await asyncio.sleep(self.pause)
+        waited = 0.0
+        while self.busy is not None and self.busy() and waited < self.max_wait:
+            await asyncio.sleep(1)
+            waited += 1
+
+    async def run(self, name):
+        """
+        Run the job `name` once.
+
+        Returns:
+            dict: The report of the run, also kept in `reports`.
+        """
+        start = time.perf_counter()
+        documents = await self.jobs[name](self.throttle)
+        duration = time.perf_counter() - start
+
+        MAINTENANCE_SECONDS.observe(duration, job=name)
+        MAINTENANCE_DOCUMENTS.inc(documents, job=name)
+        report = {"job": name, "duration": duration, "documents": documents, "finished_at": time.time()}
+        self.reports[name] = report
+        logger.info(f"Maintenance job {name}: {documents} documents in {duration:.2f}s")
+        return report
+
+    async def _loop(self):
+        await asyncio.sleep(self.first_delay)
+        while True:
+            if self.leader is not None and not self.leader():
+                logger.info("Maintenance jobs left to another process")
+                await asyncio.sleep(self.interval)
+                continue
+            for name in self.jobs:
+                try:
+                    await self.run(name)
+                except Exception:
+                    logger.exception(f"Maintenance job {name} failed")
+            await asyncio.sleep(self.interval)
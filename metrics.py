@@ -0,0 +1,290 @@
+import bisect
+import time
+from contextlib import contextmanager
+
+# Upper bounds of the latency buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Metric:
+    """
+    Base of the in-process metrics. Values are kept per tuple of label values,
+    in the order of `labelnames`, and rendered in the Prometheus text format.
+
+    `dump` exports the values as JSON, so that the metrics of several worker
+    processes can be rendered together by `merged_samples`.
+    """
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _format_labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (
+            (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for name, value in pairs
+        )
+        return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+    def samples(self):
+        raise NotImplementedError
+
+    def dump(self):
+        raise NotImplementedError
+
+    def merged_samples(self, dumps, live):
+        """
+        Args:
+            dumps (dict): `dump` of the metric in each worker, by worker name.
+            live (set): Names of the workers still running.
+        """
+        raise NotImplementedError
+
+    def render(self, dumps=None, live=None):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self.samples() if dumps is None else self.merged_samples(dumps, live))
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self, values=None):
+        for key, value in (values if values is not None else self._values).items():
+            yield f"{self.name}{self._format_labels(key)} {value}"
+
+    def dump(self):
+        return [[list(key), value] for key, value in self._values.items()]
+
+    def merged_samples(self, dumps, live):
+        # Summed, those of the workers that exited included, so that it never decreases
+        values = {}
+        for dump in dumps.values():
+            for key, value in dump:
+                key = tuple(key)
+                values[key] = values.get(key, 0) + value
+        return self.samples(values)
+
+
+class Gauge(Metric):
+    """
+    Gauge either set explicitly or read from a callback at scrape time, which
+    costs nothing on the hot path. Merged, each running worker has its own
+    sample, under a `worker` label.
+    """
+
+    type = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values = {}
+        self._callbacks = {}
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def track(self, callback, **labels):
+        self._callbacks[self._key(labels)] = callback
+
+    def value(self, **labels):
+        key = self._key(labels)
+        callback = self._callbacks.get(key)
+        return callback() if callback is not None else self._values.get(key, 0)
+
+    def _current(self):
+        values = dict(self._values)
+        for key, callback in self._callbacks.items():
+            values[key] = callback()
+        return values
+
+    def samples(self):
+        for key, value in self._current().items():
+            yield f"{self.name}{self._format_labels(key)} {value}"
+
+    def dump(self):
+        return [[list(key), value] for key, value in self._current().items()]
+
+    def merged_samples(self, dumps, live):
+        for worker, dump in dumps.items():
+            if worker not in live:
+                continue
+            for key, value in dump:
+                labels = self._format_labels(tuple(key), [("worker", worker)])
+                yield f"{self.name}{labels} {value}"
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, *args, buckets=DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+        # Per key: count of each bucket (not cumulative, the last one is +Inf) and sum
+        self._counts = {}
+        self._sums = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        counts = self._counts.get(key)
+        if counts is None:
+            counts = self._counts[key] = [0] * (len(self.buckets) + 1)
+            self._sums[key] = 0.0
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._sums[key] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        return sum(self._counts.get(self._key(labels), ()))
+
+    def samples(self, all_counts=None, sums=None):
+        all_counts = all_counts if all_counts is not None else self._counts
+        sums = sums if sums is not None else self._sums
+        for key, counts in all_counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                labels = self._format_labels(key, [("le", bound)])
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            yield f"{self.name}_sum{self._format_labels(key)} {sums[key]}"
+            yield f"{self.name}_count{self._format_labels(key)} {cumulative}"
+
+    def dump(self):
+        return [[list(key), counts, self._sums[key]] for key, counts in self._counts.items()]
+
+    def merged_samples(self, dumps, live):
+        counts, sums = {}, {}
+        for dump in dumps.values():
+            for key, worker_counts, worker_sum in dump:
+                key = tuple(key)
+                total = counts.setdefault(key, [0] * (len(self.buckets) + 1))
+                for i, count in enumerate(worker_counts):
+                    total[i] += count
+                sums[key] = sums.get(key, 0.0) + worker_sum
+        return self.samples(counts, sums)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+
+    def snapshot(self):
+        """Values of every metric of this process, JSON serializable."""
+        return {name: metric.dump() for name, metric in self._metrics.items()}
+
+    def render(self, snapshots=None, live=None):
+        """
+        Every metric, in the Prometheus text exposition format.
+
+        Args:
+            snapshots (dict, optional): `snapshot` of each worker process, by
+                worker name, rendered together instead of this process alone:
+                counters and histograms are summed, gauges are labelled by worker.
+            live (set, optional): Workers still running, the others' gauges are left out.
+        """
+        if snapshots is None:
+            return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+        live = set(snapshots) if live is None else live
+        return "\n".join(
+            metric.render(
+                {worker: snapshot.get(name, []) for worker, snapshot in snapshots.items()}, live
+            )
+            for name, metric in self._metrics.items()
+        ) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = Histogram(
+    "whatia_stage_seconds", "Duration of each stage of the message pipeline.", ("stage",)
+)
+TOKENS = Counter("whatia_tokens_total", "Tokens used by conversation turns, per plan.", ("plan",))
+TOKENS_SAVED = Counter(
+    "whatia_tokens_saved_total",
+    "Prompt tokens saved by conversation summaries, per plan.",
+    ("plan",),
+)
+UPSTREAM_ERRORS = Counter(
+    "whatia_upstream_errors_total",
+    "Failed calls to upstream APIs, rate limits included.",
+    ("upstream", "kind"),
+)
+CIRCUIT_OPEN = Gauge(
+    "whatia_circuit_open",
+    "1 while the circuit breaker of an upstream refuses calls, or lets a trial one through.",
+    ("upstream",),
+)
+HEDGES = Counter(
+    "whatia_hedged_calls_total", "Calls raced against a second request.", ("upstream",)
+)
+LLM_SECONDS = Histogram(
+    "whatia_llm_seconds", "Duration of the answers of each chat model.", ("model",)
+)
+LLM_TOKENS = Counter(
+    "whatia_llm_tokens_total", "Tokens billed by each chat model.", ("model", "kind")
+)
+LLM_COST = Counter(
+    "whatia_llm_cost_usd_total", "Estimated cost of each chat model, in USD.", ("model",)
+)
+ROUTES = Counter(
+    "whatia_routes_total", "Turns routed to each chat model.", ("plan", "model", "reason")
+)
+QUEUE_DEPTH = Gauge("whatia_queue_depth", "Items waiting in the in-process queues.", ("queue",))
+RATE_LIMITER_SATURATION = Gauge(
+    "whatia_rate_limiter_saturation",
+    "Share of the per-minute budget of each rate limiter in use.",
+    ("limiter",),
+)
+SESSION_CACHE = Gauge(
+    "whatia_session_cache",
+    "Size, hits, misses, evictions, expirations and invalidations of the user session cache.",
+    ("stat",),
+)
+RESPONSE_CACHE = Gauge(
+    "whatia_response_cache",
+    "Size, exact and similar hits, misses, hit rate and saved tokens of the answer cache.",
+    ("stat",),
+)
+MAINTENANCE_SECONDS = Histogram(
+    "whatia_maintenance_seconds",
+    "Duration of the runs of the maintenance jobs.",
+    ("job",),
+    buckets=(0.1, 1, 10, 60, 300, 1800),
+)
+MAINTENANCE_DOCUMENTS = Counter(
+    "whatia_maintenance_documents_total",
+    "Documents updated or deleted by the maintenance jobs.",
+    ("job",),
+)
@@ -3,7 +3,9 @@ import logging
 import os
 
 import pymongo
-from pymongo import ReturnDocument
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, monitoring
 
 from utils import load_config
 
@@ -24,19 +26,64 @@ MONGODB_USERNAME = os.getenv("MONGODB_USERNAME")
 MONGODB_PASSWORD = os.getenv("MONGODB_PASSWORD")
 MONGODB_DATABASE = os.getenv("MONGODB_DATABASE")
 
-client = pymongo.MongoClient(
-    database_uri.format(
-        MONGODB_USERNAME=MONGODB_USERNAME,
-        MONGODB_PASSWORD=MONGODB_PASSWORD,
-        MONGODB_HOSTNAME=MONGODB_HOSTNAME,
-        MONGODB_DATABASE=MONGODB_DATABASE,
-    )
+mongodb_uri = database_uri.format(
+    MONGODB_USERNAME=MONGODB_USERNAME,
+    MONGODB_PASSWORD=MONGODB_PASSWORD,
+    MONGODB_HOSTNAME=MONGODB_HOSTNAME,
+    MONGODB_DATABASE=MONGODB_DATABASE,
 )
 
 
+class RoundTripCounter(monitoring.CommandListener):
+    """Counts the commands sent to the server, by command name."""
+
+    def __init__(self):
+        self.counts = {}
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+    def started(self, event):
+        self.counts[event.command_name] = self.counts.get(event.command_name, 0) + 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+round_trips = RoundTripCounter()
+
+# Blocking client, for scripts and maintenance jobs running outside the event loop
+client = pymongo.MongoClient(mongodb_uri, event_listeners=[round_trips])
+# Non-blocking client, for the FastAPI handlers
+async_client = AsyncIOMotorClient(mongodb_uri, event_listeners=[round_trips])
+
+
+def _new_user(phone_number, current_period_end=None, history=None):
+    if history is None:
+        history = []
+
+    if phone_number is None:
+        raise NoUserPhoneNumber("Provide a valid phone number.")
+    if current_period_end is not None:
+        current_period_end = datetime.datetime.utcfromtimestamp(current_period_end)
+    return {
+        "phone_number": phone_number,
+        "history": history,
+        "current_period_end": current_period_end,
+        "nb_tokens": 0,
+        "nb_messages": 0,
+        "is_blocked": False,
+        "datetime_created": datetime.datetime.utcnow(),
+    }
+
+
 class UserCollection:
-    def __init__(self, collection_name):
-        self.db = client["mydatabase"]
+    def __init__(self, collection_name, db=None):
+        self.db = db if db is not None else client["mydatabase"]
         self.collection = self.db[collection_name]
 
     def delete_document(self, query):
@@ -80,23 +127,8 @@ class UserCollection:
             return doc["_id"]
 
     def add_user(self, phone_number, current_period_end=None, history=None):
-        if history is None:
-            history = []
-
-        if phone_number is None:
-            raise NoUserPhoneNumber("Provide a valid phone number.")
-        if current_period_end is not None:
-            current_period_end = datetime.datetime.utcfromtimestamp(current_period_end)
+        user = _new_user(phone_number, current_period_end, history)
         user_id = self.get_user_id_with_phone_number(phone_number)
-        user = {
-            "phone_number": phone_number,
-            "history": history,
-            "current_period_end": current_period_end,
-            "nb_tokens": 0,
-            "nb_messages": 0,
-            "is_blocked": False,
-            "datetime_created": datetime.datetime.utcnow(),
-        }
 
         try:
             if user_id is None:
@@ -114,22 +146,42 @@ class UserCollection:
     def get_user(self, user_id):
         return self.collection.find_one({"_id": user_id})
 
-    # TODO run on a daily basis
     def delete_ended_subsciption(self):
-        # Get today's date and time as a datetime object
-        # today_timestamp = datetime.datetime.timestamp(
-        #     datetime.datetime.today() - datetime.timedelta(hours=24)
-        # )
-        today_timestamp = datetime.datetime.utcnow().timestamp()
+        # current_period_end is stored as a UTC datetime by `_new_user`
+        today = datetime.datetime.utcnow()
         # Delete documents where the current_period_end field is older than today's date
-        result = self.collection.delete_many(
-            {"current_period_end": {"$lt": today_timestamp}}
-        )
+        result = self.collection.delete_many({"current_period_end": {"$lt": today}})
         logging.info(f"Deleted {result.deleted_count} documents.")
 
     def list_all_users(self):
         return list(self.collection.find({}))
 
+    def iter_users(self, projection=None, batch_size=500, after=None):
+        """
+        Iterate over every user in `_id` order, reading `batch_size` documents
+        at a time, so that memory does not grow with the number of users.
+
+        Each page is a new query starting after the last `_id` seen, so an
+        interrupted export can be resumed by passing that `_id` as `after`.
+
+        Args:
+            projection (dict, optional): Fields to return or to omit, e.g. {"history": 0}.
+                `_id` must be kept.
+            batch_size (int): Number of documents read per query.
+            after (ObjectId, optional): `_id` of the last user already read.
+
+        Yields:
+            dict: The user documents.
+        """
+        while True:
+            query = {} if after is None else {"_id": {"$gt": after}}
+            cursor = self.collection.find(query, projection).sort("_id", 1).limit(batch_size)
+            docs = list(cursor)
+            yield from docs
+            if len(docs) < batch_size:
+                return
+            after = docs[-1]["_id"]
+
     def block_user(self, user_id):
         self.collection.update_one(
             {"_id": user_id},
@@ -137,6 +189,311 @@ class UserCollection:
         )
 
 
+class AsyncUserCollection:
+    """
+    Same interface as `UserCollection`, backed by Motor so that database round
+    trips are awaited instead of blocking the event loop.
+
+    The user document only keeps the last `history_window` messages of the
+    conversation, the whole conversation is in `AsyncMessageLog`.
+    """
+
+    def __init__(self, collection_name, db=None, history_window=20):
+        self.db = db if db is not None else async_client["mydatabase"]
+        self.collection = self.db[collection_name]
+        self.history_window = history_window
+
+    async def delete_document(self, query):
+        return await self.collection.delete_one(query)
+
+    async def increment_nb_tokens_messages(self, doc, amount):
+        # increment the field by the specified amount for the specified document
+        timestamp = datetime.datetime.utcnow()
+        await self.collection.update_one(
+            {"_id": doc["_id"]},
+            {
+                "$inc": {"nb_tokens": amount, "nb_messages": 1},
+                "$set": {"timestamp_last_messages": timestamp},
+            },
+        )
+
+    async def create_indexes(self):
+        """Indexes of the maintenance jobs, a no-op when they already exist."""
+        await self.collection.create_index("current_period_end")
+        await self.collection.create_index("timestamp_last_messages")
+
+    async def _batches(self, query, batch_size, throttle):
+        """
+        Yield the documents matching `query` `batch_size` at a time, awaiting
+        `throttle` between two batches. The caller must make the documents of a
+        batch stop matching `query`, by updating or deleting them.
+        """
+        while True:
+            cursor = self.collection.find(query, {"_id": 1, "phone_number": 1})
+            docs = await cursor.limit(batch_size).to_list(length=batch_size)
+            if not docs:
+                return
+            yield docs
+            if throttle is not None:
+                await throttle()
+
+    async def reset_tokens(self, batch_size=500, throttle=None):
+        """
+        Reset the token counter of the users whose subscription ended more than
+        a day ago, in batches of `batch_size` users.
+
+        Args:
+            throttle (coroutine function, optional): Awaited between two batches.
+
+        Returns:
+            int: Number of users updated.
+        """
+        yesterday = datetime.datetime.utcnow() - datetime.timedelta(hours=24)
+        query = {"current_period_end": {"$lt": yesterday}, "nb_tokens": {"$ne": 0}}
+        modified = 0
+        async for docs in self._batches(query, batch_size, throttle):
+            result = await self.collection.update_many(
+                {"_id": {"$in": [doc["_id"] for doc in docs]}}, {"$set": {"nb_tokens": 0}}
+            )
+            modified += result.modified_count
+        logging.info(f"{modified} tokens resetted.")
+        return modified
+
+    async def update_user_history(self, phone_number, message=None):
+        query = {"phone_number": phone_number}
+        update = {"$set": {"history": message}}
+        await self.collection.find_one_and_update(
+            query, update, upsert=True, return_document=ReturnDocument.AFTER
+        )
+
+    async def find_document(self, field_name, field_value):
+        return await self.collection.find_one({field_name: field_value})
+
+    async def get_user_id_with_phone_number(self, phone_number):
+        doc = await self.find_document("phone_number", phone_number)
+        if doc:
+            return doc["_id"]
+
+    async def add_user(self, phone_number, current_period_end=None, history=None):
+        user = _new_user(phone_number, current_period_end, history)
+        user_id = await self.get_user_id_with_phone_number(phone_number)
+
+        try:
+            if user_id is None:
+                result = await self.collection.insert_one(user)
+                return result.inserted_id
+            else:
+                await self.collection.update_one(
+                    {"_id": user_id},
+                    {"$set": user},
+                )
+
+        except pymongo.errors.DuplicateKeyError:
+            raise DuplicateUser(f"Following user already exist: {phone_number}")
+
+    async def get_user(self, user_id):
+        return await self.collection.find_one({"_id": user_id})
+
+    async def delete_ended_subsciption(self, batch_size=500, throttle=None, on_deleted=None):
+        """
+        Delete the users whose subscription has ended, in batches of
+        `batch_size` users.
+
+        Args:
+            throttle (coroutine function, optional): Awaited between two batches.
+            on_deleted (coroutine function, optional): Awaited with the phone
+                numbers of each batch of deleted users.
+
+        Returns:
+            int: Number of users deleted.
+        """
+        # current_period_end is stored as a UTC datetime by `_new_user`
+        query = {"current_period_end": {"$lt": datetime.datetime.utcnow()}}
+        deleted = 0
+        async for docs in self._batches(query, batch_size, throttle):
+            # The condition is checked again for users who renewed in the meantime
+            result = await self.collection.delete_many(
+                {"_id": {"$in": [doc["_id"] for doc in docs]}, **query}
+            )
+            deleted += result.deleted_count
+            if on_deleted is not None:
+                await on_deleted([doc["phone_number"] for doc in docs])
+        logging.info(f"Deleted {deleted} documents.")
+        return deleted
+
+    async def list_all_users(self):
+        return await self.collection.find({}).to_list(length=None)
+
+    async def iter_users(self, projection=None, batch_size=500, after=None):
+        """Async counterpart of `UserCollection.iter_users`."""
+        while True:
+            query = {} if after is None else {"_id": {"$gt": after}}
+            cursor = self.collection.find(query, projection).sort("_id", 1).limit(batch_size)
+            docs = await cursor.to_list(length=batch_size)
+            for doc in docs:
+                yield doc
+            if len(docs) < batch_size:
+                return
+            after = docs[-1]["_id"]
+
+    async def block_user(self, user_id):
+        await self.collection.update_one(
+            {"_id": user_id},
+            {"$set": {"is_blocked": True}},
+        )
+
+    async def get_or_create_user(self, phone_number):
+        """
+        Fetch the user, creating it if needed, in a single atomic round trip.
+
+        Returns:
+            tuple[dict, bool]: The user document and whether it was just created.
+        """
+        user = _new_user(phone_number)
+        # Generated here so that the inserted document is known without reading it back
+        user["_id"] = ObjectId()
+        del user["phone_number"]
+        try:
+            doc = await self.collection.find_one_and_update(
+                {"phone_number": phone_number},
+                {"$setOnInsert": user},
+                upsert=True,
+                return_document=ReturnDocument.BEFORE,
+            )
+        except pymongo.errors.DuplicateKeyError:
+            # Lost an insert race against a concurrent message of the same user
+            return await self.find_document("phone_number", phone_number), False
+
+        if doc is None:
+            return {"phone_number": phone_number, **user}, True
+        return doc, False
+
+    async def commit_turn(self, doc, messages, nb_tokens, block=False, tokens_saved=0):
+        """
+        Persist the outcome of a conversation turn in a single update: the
+        messages of the turn, appended to the history which is capped to
+        `history_window` messages, the token and message counters, the prompt
+        tokens saved by the summary and, for trial users who reached the limit,
+        the block flag.
+        """
+        update = {
+            "$inc": {
+                "nb_tokens": nb_tokens,
+                "nb_messages": 1,
+                "nb_tokens_saved": tokens_saved,
+            },
+            "$set": {"timestamp_last_messages": datetime.datetime.utcnow()},
+            "$push": {
+                "history": {"$each": messages, "$slice": -self.history_window}
+            },
+        }
+        if block:
+            update["$set"]["is_blocked"] = True
+        await self.collection.update_one({"_id": doc["_id"]}, update)
+
+    async def set_summary(self, phone_number, summary):
+        await self.collection.update_one(
+            {"phone_number": phone_number}, {"$set": {"summary": summary}}
+        )
+
+
+class AsyncMessageLog:
+    """
+    Append-only log of the conversation turns, one document per turn written
+    with a single insert. It is kept for analytics and never read while
+    answering, so it does not weigh on the user documents.
+    """
+
+    def __init__(self, collection_name="messages", db=None):
+        self.db = db if db is not None else async_client["mydatabase"]
+        self.collection = self.db[collection_name]
+
+    async def create_indexes(self):
+        await self.collection.create_index(
+            [("phone_number", pymongo.ASCENDING), ("ts", pymongo.ASCENDING)]
+        )
+
+    async def append(self, phone_number, messages, nb_tokens):
+        """
+        Args:
+            messages (list[dict]): History entries of the turn, question first.
+            nb_tokens (int): Tokens used by the turn.
+        """
+        await self.collection.insert_one(
+            {
+                "phone_number": phone_number,
+                "ts": datetime.datetime.utcnow(),
+                "messages": messages,
+                "nb_tokens": nb_tokens,
+            }
+        )
+
+    async def conversation(self, phone_number, since=None, limit=100):
+        """
+        Returns:
+            list[dict]: The first `limit` turns of the user since `since`, oldest first.
+        """
+        query = {"phone_number": phone_number}
+        if since is not None:
+            query["ts"] = {"$gt": since}
+        cursor = self.collection.find(query).sort("ts", 1).limit(limit)
+        return await cursor.to_list(length=limit)
+
+
+class AsyncStripeEventCollection:
+    """
+    Stripe webhook events, keyed by their event id so that a retried delivery
+    of the same event is recorded only once.
+    """
+
+    def __init__(self, collection_name="stripe_events", db=None):
+        self.db = db if db is not None else async_client["mydatabase"]
+        self.collection = self.db[collection_name]
+
+    async def record(self, event):
+        """
+        Returns:
+            bool: False if the event had already been received.
+        """
+        try:
+            await self.collection.insert_one(
+                {
+                    "_id": event["id"],
+                    "type": event["type"],
+                    "event": event,
+                    "status": "pending",
+                    "received_at": datetime.datetime.utcnow(),
+                }
+            )
+        except pymongo.errors.DuplicateKeyError:
+            return False
+        return True
+
+    async def mark_done(self, event_id):
+        await self.collection.update_one(
+            {"_id": event_id},
+            {"$set": {"status": "done", "done_at": datetime.datetime.utcnow()}},
+        )
+
+    async def is_pending(self, event_id):
+        return await self.collection.find_one({"_id": event_id, "status": "pending"}) is not None
+
+    async def pending(self, received_before=None):
+        """
+        Args:
+            received_before (datetime.datetime, optional): Only the events received
+                before then, the more recent ones may still be in the queue.
+
+        Returns:
+            list: The events not applied yet, oldest first.
+        """
+        query = {"status": "pending"}
+        if received_before is not None:
+            query["received_at"] = {"$lt": received_before}
+        cursor = self.collection.find(query).sort("received_at", 1)
+        return [doc["event"] for doc in await cursor.to_list(length=None)]
+
+
 if __name__ == "__main__":
     # Initialize the UserCollection with the specified collection name
     users = UserCollection("users")
@@ -0,0 +1,5 @@
+import os
+
+# send_notification creates its Twilio client at import, which needs credentials
+os.environ.setdefault("TWILIO_ACCOUNT_SID", "ACtest")
+os.environ.setdefault("TWILIO_AUTH_TOKEN", "test")
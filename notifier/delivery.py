@@ -0,0 +1,155 @@
+import asyncio
+import functools
+import logging
+
+import aiohttp
+
+from metrics import STAGE_SECONDS
+from notifier.send_notification import TwilioSendError, async_send_message
+from resilience import CircuitBreaker, CircuitOpenError, Policy
+
+logger = logging.getLogger(__name__)
+
+
+class DeliveryQueue:
+    """
+    Background delivery of outbound WhatsApp messages.
+
+    Each recipient gets its own FIFO drained by a dedicated task, so chunks of an
+    answer arrive in order and the pause between them only delays that recipient.
+    The pause is kept between any two messages to a recipient, including the
+    chunks of a streamed answer submitted one by one.
+    Calls to Twilio are bounded by a semaphore shared by all recipients, and
+    retryable failures (network errors, 429 and 5xx) are retried with an
+    exponential, jittered backoff. While Twilio keeps failing, the circuit
+    breaker drops the messages without calling it.
+
+    Args:
+        send (coroutine function, optional): `send(body, phone_number, media_url)`.
+            Defaults to the Twilio REST sender using the queue's own HTTP session.
+        pacing (float): Seconds to wait between two messages to the same recipient.
+        max_concurrency (int): Maximum number of in-flight requests to Twilio.
+        max_retries (int): Number of retries after the first failed attempt.
+        backoff (float): Base delay in seconds of the retry backoff.
+        timeout (float): Deadline of one attempt, in seconds.
+        breaker (CircuitBreaker, optional): Breaker of Twilio, a new one by default.
+    """
+
+    def __init__(
+        self,
+        send=None,
+        pacing=1.0,
+        max_concurrency=5,
+        max_retries=3,
+        backoff=0.5,
+        timeout=15,
+        breaker=None,
+    ):
+        self.send = send
+        self.pacing = pacing
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        # Waiting for the semaphore does not count against the deadline of a call
+        self.policy = Policy(
+            "twilio",
+            timeout=None,
+            retries=max_retries,
+            backoff=backoff,
+            breaker=breaker or CircuitBreaker("twilio"),
+            retryable=is_retryable,
+        )
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._queues = {}
+        self._workers = {}
+        # Loop time of the last message to each recipient, forgotten after `pacing`
+        self._last_sent = {}
+        self._session = None
+        self._default_send = False
+
+    async def start(self, session=None):
+        """
+        Args:
+            session (aiohttp.ClientSession, optional): Shared session used by the
+                default sender, which otherwise opens and closes its own.
+        """
+        if self.send is None:
+            if session is None:
+                session = self._session = aiohttp.ClientSession()
+            self.send = functools.partial(async_send_message, session)
+            self._default_send = True
+
+    async def stop(self):
+        await self.join()
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        if self._default_send:
+            self.send = None
+            self._default_send = False
+
+    def submit(self, body_mess, phone_number, media_url=None):
+        """Queue a message for `phone_number` and return immediately."""
+        queue = self._queues.get(phone_number)
+        if queue is None:
+            queue = self._queues[phone_number] = asyncio.Queue()
+        queue.put_nowait((body_mess, media_url))
+
+        if phone_number not in self._workers:
+            self._workers[phone_number] = asyncio.create_task(
+                self._drain(phone_number, queue)
+            )
+
+    async def join(self):
+        """Wait until every queued message has been delivered or given up on."""
+        while self._workers:
+            await asyncio.gather(*self._workers.values(), return_exceptions=True)
+
+    def qsize(self):
+        return sum(queue.qsize() for queue in self._queues.values())
+
+    async def _drain(self, phone_number, queue):
+        loop = asyncio.get_running_loop()
+        try:
+            while not queue.empty():
+                body_mess, media_url = queue.get_nowait()
+                last_sent = self._last_sent.get(phone_number)
+                if last_sent is not None and loop.time() - last_sent < self.pacing:
+                    await asyncio.sleep(self.pacing - (loop.time() - last_sent))
+                try:
+                    await self._deliver(body_mess, phone_number, media_url)
+                except Exception:
+                    # The next messages of the recipient must not be lost with this one
+                    logger.exception(f"Message to {phone_number} dropped")
+                self._last_sent[phone_number] = loop.time()
+        finally:
+            del self._workers[phone_number]
+            del self._queues[phone_number]
+            if phone_number in self._last_sent:
+                loop.call_later(
+                    self.pacing, self._forget, phone_number, self._last_sent[phone_number]
+                )
+
+    def _forget(self, phone_number, sent_at):
+        if self._last_sent.get(phone_number) == sent_at:
+            del self._last_sent[phone_number]
+
+    async def _deliver(self, body_mess, phone_number, media_url):
+        async def send():
+            async with self._semaphore:
+                with STAGE_SECONDS.time(stage="twilio_send"):
+                    return await asyncio.wait_for(
+                        self.send(body_mess, phone_number, media_url), self.timeout
+                    )
+
+        try:
+            return await self.policy.call(send)
+        except (TwilioSendError, aiohttp.ClientError, asyncio.TimeoutError, CircuitOpenError) as e:
+            logger.error(f"Message to {phone_number} dropped: {e!r}")
+
+
+def is_retryable(error):
+    # Any network error may be transient, Twilio errors know if they are
+    if isinstance(error, (TwilioSendError, aiohttp.ClientError, asyncio.TimeoutError)):
+        return getattr(error, "retryable", True)
+    return False
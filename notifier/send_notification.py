@@ -1,6 +1,8 @@
 import logging
 import os
 
+import aiohttp
+from twilio.http.http_client import TwilioHttpClient
 from twilio.rest import Client
 
 from utils import load_config
@@ -14,8 +16,24 @@ logger = logging.getLogger(__name__)
 account_sid = os.getenv("TWILIO_ACCOUNT_SID")
 auth_token = os.getenv("TWILIO_AUTH_TOKEN")
 twilio_phone_numer = os.getenv("TWILIO_PHONE_NUMBER")
+messaging_service_sid = "MG160b0c8183ce26835f658d9f3b2dd0a7"
+# Overridable so that the async sender can be pointed at a local fake Twilio
+twilio_api_url = os.getenv("TWILIO_API_URL", "https://api.twilio.com")
 
-client = Client(account_sid, auth_token)
+# Pooled keep-alive connections, and a deadline instead of waiting forever
+client = Client(
+    account_sid, auth_token, http_client=TwilioHttpClient(pool_connections=True, timeout=15)
+)
+
+
+class TwilioSendError(Exception):
+    def __init__(self, status, message):
+        super().__init__(f"Twilio answered {status}: {message}")
+        self.status = status
+
+    @property
+    def retryable(self):
+        return self.status == 429 or self.status >= 500
 
 
 def send_message(body_mess, phone_number, media_url=None):
@@ -27,7 +45,7 @@ def send_message(body_mess, phone_number, media_url=None):
         phone_number (str): The recipient's phone number.
     """
     response = client.messages.create(
-        messaging_service_sid="MG160b0c8183ce26835f658d9f3b2dd0a7",
+        messaging_service_sid=messaging_service_sid,
         from_=f"whatsapp:{twilio_phone_numer}",
         body=body_mess,
         to=f"whatsapp:{phone_number}",
@@ -36,6 +54,41 @@ def send_message(body_mess, phone_number, media_url=None):
     logger.info(response.sid)
 
 
+async def async_send_message(session, body_mess, phone_number, media_url=None):
+    """
+    Send a WhatsApp message through the Twilio REST API without blocking the event loop.
+
+    Args:
+        session (aiohttp.ClientSession): The HTTP session used to reach Twilio.
+        body_mess (str): The content of the message to send.
+        phone_number (str): The recipient's phone number.
+        media_url (str, optional): URL of a media to attach to the message.
+
+    Raises:
+        TwilioSendError: If Twilio does not accept the message.
+    """
+    data = {
+        "MessagingServiceSid": messaging_service_sid,
+        "From": f"whatsapp:{twilio_phone_numer}",
+        "To": f"whatsapp:{phone_number}",
+        "Body": body_mess,
+    }
+    if media_url:
+        data["MediaUrl"] = media_url
+
+    async with session.post(
+        f"{twilio_api_url}/2010-04-01/Accounts/{account_sid}/Messages.json",
+        data=data,
+        auth=aiohttp.BasicAuth(account_sid, auth_token),
+    ) as response:
+        # Errors of the proxies in front of Twilio are not JSON
+        if response.status >= 400:
+            raise TwilioSendError(response.status, await response.text())
+        payload = await response.json(content_type=None)
+    logger.info(payload["sid"])
+    return payload["sid"]
+
+
 if __name__ == "__main__":
     ACTIVATION_MESSAGE_FR = """🇫🇷
     					🎉Bienvenue dans le cercle privilégié des utilisateurs premium de WhatIA! Félicitations! 🎊 \n
@@ -0,0 +1,157 @@
+import asyncio
+import functools
+import time
+
+import aiohttp
+import pytest
+import pytest_asyncio
+from aiohttp import web
+
+from notifier import send_notification
+from notifier.delivery import DeliveryQueue
+
+
+class FakeTwilio:
+    """Local stand-in for the Twilio Messages endpoint."""
+
+    def __init__(self, latency=0.0, failures=0, status=500, error_body=None):
+        self.latency = latency
+        self.failures = failures
+        self.status = status
+        self.error_body = error_body
+        self.received = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def messages(self, request):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+            form = await request.post()
+            if self.failures:
+                self.failures -= 1
+                if self.error_body is not None:
+                    return web.Response(
+                        text=self.error_body, status=self.status, content_type="text/html"
+                    )
+                return web.json_response({"message": "boom"}, status=self.status)
+            self.received.append((form["To"], form["Body"], time.monotonic()))
+            return web.json_response({"sid": f"SM{len(self.received)}"}, status=201)
+        finally:
+            self.in_flight -= 1
+
+
+@pytest_asyncio.fixture
+async def fake_twilio(monkeypatch):
+    fake = FakeTwilio()
+    app = web.Application()
+    app.router.add_post("/2010-04-01/Accounts/{sid}/Messages.json", fake.messages)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    monkeypatch.setattr(send_notification, "twilio_api_url", f"http://127.0.0.1:{port}")
+    yield fake
+    await runner.cleanup()
+
+
+@pytest_asyncio.fixture
+async def session():
+    async with aiohttp.ClientSession() as session:
+        yield session
+
+
+def make_queue(session, **kwargs):
+    send = functools.partial(send_notification.async_send_message, session)
+    return DeliveryQueue(send=send, **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_messages_keep_order_and_pacing_per_recipient(fake_twilio, session):
+    queue = make_queue(session, pacing=0.2)
+    for chunk in ("one", "two", "three"):
+        queue.submit(chunk, "+33600000001")
+    queue.submit("other", "+33600000002")
+    await queue.join()
+
+    first = [r for r in fake_twilio.received if r[0] == "whatsapp:+33600000001"]
+    assert [body for _, body, _ in first] == ["one", "two", "three"]
+    assert first[2][2] - first[0][2] >= 0.4
+    # The other recipient is not held back by the first one's pacing
+    other = [r for r in fake_twilio.received if r[0] == "whatsapp:+33600000002"]
+    assert other[0][2] < first[1][2]
+
+
+@pytest.mark.asyncio
+async def test_pacing_holds_for_messages_submitted_one_by_one(fake_twilio, session):
+    queue = make_queue(session, pacing=0.2)
+    # Chunks of a streamed answer, each arriving after the previous one was sent
+    for chunk in ("one", "two"):
+        queue.submit(chunk, "+33600000001")
+        await queue.join()
+
+    first, second = fake_twilio.received
+    assert second[2] - first[2] >= 0.2
+
+
+@pytest.mark.asyncio
+async def test_concurrency_towards_twilio_is_bounded(fake_twilio, session):
+    fake_twilio.latency = 0.05
+    queue = make_queue(session, pacing=0, max_concurrency=2)
+    for i in range(6):
+        queue.submit("hello", f"+3360000000{i}")
+    await queue.join()
+
+    assert len(fake_twilio.received) == 6
+    assert fake_twilio.max_in_flight == 2
+
+
+@pytest.mark.asyncio
+async def test_retryable_errors_are_retried(fake_twilio, session):
+    fake_twilio.failures = 2
+    queue = make_queue(session, backoff=0.01)
+    queue.submit("hello", "+33600000001")
+    await queue.join()
+
+    assert [body for _, body, _ in fake_twilio.received] == ["hello"]
+
+
+@pytest.mark.asyncio
+async def test_errors_that_are_not_json_are_retried(fake_twilio, session):
+    fake_twilio.failures = 1
+    fake_twilio.status = 503
+    fake_twilio.error_body = "<html><body>Service Unavailable</body></html>"
+    queue = make_queue(session, pacing=0, backoff=0.01)
+    queue.submit("hello", "+33600000001")
+    queue.submit("world", "+33600000001")
+    await queue.join()
+
+    assert [body for _, body, _ in fake_twilio.received] == ["hello", "world"]
+
+
+@pytest.mark.asyncio
+async def test_client_errors_are_not_retried(fake_twilio, session):
+    fake_twilio.failures = 1
+    fake_twilio.status = 400
+    queue = make_queue(session, backoff=0.01)
+    queue.submit("hello", "+33600000001")
+    queue.submit("world", "+33600000001")
+    await queue.join()
+
+    assert [body for _, body, _ in fake_twilio.received] == ["world"]
+
+
+@pytest.mark.asyncio
+async def test_circuit_opens_while_twilio_is_down(fake_twilio, session):
+    fake_twilio.failures = 100
+    queue = make_queue(session, pacing=0, max_retries=1, backoff=0.01)
+    queue.policy.breaker.failure_threshold = 2
+    for chunk in ("one", "two", "three"):
+        queue.submit(chunk, "+33600000001")
+    await queue.join()
+
+    # Two calls opened the circuit, the other messages were dropped without a call
+    assert fake_twilio.failures == 98
+    assert queue.policy.breaker.state == "open"
@@ -1,44 +1,110 @@
 import asyncio
 import logging
+import re
+import time
+from collections import OrderedDict
 
-import aiohttp
 import openai
-from openai import AsyncOpenAI
-from ratelimit import sleep_and_retry, limits
 
+from http_clients import clients
+from rate_limiter import AsyncRateLimiter
+from resilience import CircuitBreaker, Policy
 from utils import load_config
 
-ONE_MINUTE = 60
 MAX_CALLS_PER_MINUTE = 30
 MAX_TOKENS = 400
 
 load_config()
 
-# Initialize the OpenAI client
-client = AsyncOpenAI()
-
-
-async def generate_image(prompt):
-    async with aiohttp.ClientSession() as session:
-
-        @sleep_and_retry
-        @limits(calls=MAX_CALLS_PER_MINUTE, period=ONE_MINUTE)
-        async def request():
-            try:
-                print(prompt)
-                response = await client.images.generate(
-                    prompt=prompt,
-                    size="256x256",
-                    quality="standard",
-                    n=1,
-                )
-                image_url = response.data[0].url
-
-                return image_url
-            except openai.RateLimitError as e:
-                logging.error("Rate limit reached for DALL-E")
-
-        return await request()
+logger = logging.getLogger(__name__)
+
+image_limiter = AsyncRateLimiter("image", requests_per_minute=MAX_CALLS_PER_MINUTE)
+image_policy = Policy(
+    "dalle", timeout=60, retries=1, backoff=2, breaker=CircuitBreaker("dalle")
+)
+
+
+async def generate_image(prompt, size="256x256"):
+    """
+    Returns:
+        str: URL of the generated image.
+
+    Raises:
+        openai.OpenAIError: If the image could not be generated.
+        asyncio.TimeoutError: If it took too long.
+        CircuitOpenError: If DALL-E has been failing, without calling it.
+    """
+    await image_limiter.acquire()
+
+    async def generate():
+        return await clients.openai.images.generate(
+            prompt=prompt,
+            size=size,
+            quality="standard",
+            n=1,
+        )
+
+    try:
+        response = await image_policy.call(generate)
+    except openai.RateLimitError:
+        logger.error("Rate limit reached for DALL-E")
+        raise
+    return response.data[0].url
+
+
+def normalize(prompt):
+    return re.sub(r"\s+", " ", prompt.lower()).strip()
+
+
+class ImageCache:
+    """
+    URLs of generated images, keyed on the normalized prompt and the size, so
+    that a popular prompt is only paid for once. Concurrent requests for the
+    same prompt share the same generation.
+
+    Args:
+        generate (coroutine function, optional): `generate(prompt, size)`.
+            Defaults to `generate_image`.
+        maxsize (int): Maximum number of cached images.
+        ttl (float): Lifetime of a cached URL in seconds, shorter than the
+            hour after which OpenAI expires it.
+    """
+
+    def __init__(self, generate=None, maxsize=256, ttl=3000):
+        self.generate = generate or generate_image
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._urls = OrderedDict()
+        self._pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, prompt, size="256x256"):
+        key = (normalize(prompt), size)
+        entry = self._urls.get(key)
+        if entry is not None and entry[1] > time.monotonic():
+            self._urls.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+        task = self._pending.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self.generate(prompt, size))
+            self._pending[key] = task
+        try:
+            url = await task
+        finally:
+            self._pending.pop(key, None)
+
+        self._urls[key] = (url, time.monotonic() + self.ttl)
+        self._urls.move_to_end(key)
+        while len(self._urls) > self.maxsize:
+            self._urls.popitem(last=False)
+        return url
+
+    def stats(self):
+        return {"size": len(self._urls), "hits": self.hits, "misses": self.misses}
 
 
 # Example usage
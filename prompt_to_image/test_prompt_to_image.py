@@ -0,0 +1,43 @@
+import asyncio
+
+import pytest
+
+from prompt_to_image.prompt_to_image import ImageCache
+
+
+class FakeDalle:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.calls = []
+
+    async def __call__(self, prompt, size):
+        self.calls.append((prompt, size))
+        await asyncio.sleep(0.01)
+        if self.fail:
+            raise RuntimeError("rate limited")
+        return f"https://images.example/{len(self.calls)}.png"
+
+
+@pytest.mark.asyncio
+async def test_prompts_are_generated_once_per_normalized_prompt_and_size():
+    dalle = FakeDalle()
+    images = ImageCache(generate=dalle)
+
+    urls = await asyncio.gather(images.get("Un chat  siamois"), images.get("un chat siamois "))
+    assert urls[0] == urls[1]
+    assert await images.get("UN CHAT SIAMOIS") == urls[0]
+    assert await images.get("un chat siamois", size="512x512") != urls[0]
+
+    assert len(dalle.calls) == 2
+    assert images.stats() == {"size": 2, "hits": 1, "misses": 2}
+
+
+@pytest.mark.asyncio
+async def test_failures_are_not_cached():
+    dalle = FakeDalle(fail=True)
+    images = ImageCache(generate=dalle)
+
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            await images.get("un chat")
+    assert len(dalle.calls) == 2
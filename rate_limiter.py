@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+ONE_MINUTE = 60
+
+# Every limiter created, by name, so that their state can be exported
+limiters = {}
+
+
+class AsyncRateLimiter:
+    """
+    Token-bucket limiter for coroutines, accounting for requests per minute and
+    optionally for (model) tokens per minute.
+
+    Callers wait on an `asyncio.Lock`, which wakes them up in arrival order, so a
+    large request is not starved by a stream of small ones. Waiting is done with
+    `asyncio.sleep` and never blocks the event loop.
+
+    Once `share` is called, the bucket lives in a `SharedState` instead, so that
+    the worker processes of the app draw from the same budget. Each call then
+    reserves its share of the bucket right away, possibly going into debt, and
+    sleeps until the debt is repaid: calls are still served in arrival order,
+    across processes.
+
+    Args:
+        name (str): Name under which the limiter is registered in `limiters`.
+        requests_per_minute (int): Maximum number of calls per minute.
+        tokens_per_minute (int, optional): Maximum number of tokens per minute.
+    """
+
+    def __init__(self, name, requests_per_minute, tokens_per_minute=None):
+        self.name = name
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._requests = float(requests_per_minute)
+        self._tokens = float(tokens_per_minute or 0)
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+        self.state = None
+        self.waiting = 0
+        self.acquired = 0
+        self.throttled = 0
+        self.wait_seconds = 0.0
+        limiters[name] = self
+
+    def share(self, state):
+        """
+        Args:
+            state (SharedState): Where the bucket is kept from now on.
+        """
+        self.state = state
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated_at
+        self._updated_at = now
+        self._requests = min(
+            self.requests_per_minute,
+            self._requests + elapsed * self.requests_per_minute / ONE_MINUTE,
+        )
+        if self.tokens_per_minute:
+            self._tokens = min(
+                self.tokens_per_minute,
+                self._tokens + elapsed * self.tokens_per_minute / ONE_MINUTE,
+            )
+
+    def _delay(self, tokens):
+        delay = 0.0
+        if self._requests < 1:
+            delay = (1 - self._requests) * ONE_MINUTE / self.requests_per_minute
+        if self.tokens_per_minute and self._tokens < tokens:
+            delay = max(
+                delay, (tokens - self._tokens) * ONE_MINUTE / self.tokens_per_minute
+            )
+        return delay
+
+    async def acquire(self, tokens=0):
+        """
+        Wait until one request and `tokens` tokens are available, then consume them.
+
+        Args:
+            tokens (int): Estimated number of tokens used by the call.
+        """
+        if self.tokens_per_minute:
+            tokens = min(tokens, self.tokens_per_minute)
+        self.waiting += 1
+        start = time.monotonic()
+        try:
+            if self.state is not None:
+                delay = await self.state.call(
+                    "reserve", self.name, self.requests_per_minute, self.tokens_per_minute, tokens
+                )
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            else:
+                await self._acquire(tokens)
+        finally:
+            self.waiting -= 1
+
+        waited = time.monotonic() - start
+        self.acquired += 1
+        self.wait_seconds += waited
+        if waited > 0.01:
+            self.throttled += 1
+            logger.info(f"Rate limiter {self.name} delayed a call by {waited:.2f}s")
+
+    async def _acquire(self, tokens):
+        async with self._lock:
+            self._refill()
+            delay = self._delay(tokens)
+            while delay > 0:
+                await asyncio.sleep(delay)
+                self._refill()
+                delay = self._delay(tokens)
+            self._requests -= 1
+            if self.tokens_per_minute:
+                self._tokens -= tokens
+
+    async def refund(self, tokens):
+        """
+        Correct an estimate once the real usage is known. A negative amount
+        consumes extra tokens.
+        """
+        if not self.tokens_per_minute:
+            return
+        if self.state is not None:
+            await self.state.call(
+                "refund", self.name, self.requests_per_minute, self.tokens_per_minute, tokens
+            )
+            return
+        self._refill()
+        self._tokens = min(self.tokens_per_minute, self._tokens + tokens)
+
+    def metrics(self):
+        if self.state is not None:
+            self._requests, self._tokens = self.state.bucket(
+                self.name, self.requests_per_minute, self.tokens_per_minute
+            )
+        else:
+            self._refill()
+        metrics = {
+            "requests_available": self._requests,
+            "requests_saturation": 1 - self._requests / self.requests_per_minute,
+            "waiting": self.waiting,
+            "acquired_total": self.acquired,
+            "throttled_total": self.throttled,
+            "wait_seconds_total": self.wait_seconds,
+        }
+        if self.tokens_per_minute:
+            metrics["tokens_available"] = self._tokens
+            metrics["tokens_saturation"] = 1 - self._tokens / self.tokens_per_minute
+        return metrics
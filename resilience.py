@@ -0,0 +1,238 @@
+import asyncio
+import logging
+import random
+import time
+
+import aiohttp
+import openai
+
+from metrics import CIRCUIT_OPEN, HEDGES, UPSTREAM_ERRORS
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose circuit is open."""
+
+
+def status_of(error):
+    """HTTP status of a failed call, None if it did not get an answer."""
+    return getattr(error, "status_code", None) or getattr(error, "status", None)
+
+
+def is_retryable(error):
+    """
+    Whether a failed call may succeed if made again: timeouts, connection
+    errors, rate limits and server errors. Errors with a `retryable` attribute
+    decide for themselves.
+    """
+    retryable = getattr(error, "retryable", None)
+    if retryable is not None:
+        return retryable
+    if isinstance(
+        error, (asyncio.TimeoutError, aiohttp.ClientConnectionError, openai.APIConnectionError)
+    ):
+        return True
+    status = status_of(error)
+    return status is not None and (status == 429 or status >= 500)
+
+
+def error_kind(error):
+    if isinstance(error, asyncio.TimeoutError):
+        return "timeout"
+    if status_of(error) == 429:
+        return "rate_limit"
+    return "error"
+
+
+class CircuitBreaker:
+    """
+    Stops calling an upstream that keeps failing, so that callers fail fast
+    instead of piling up behind timeouts.
+
+    After `failure_threshold` consecutive failures the circuit opens and every
+    call is refused for `reset_timeout` seconds. The next call is then let
+    through as a trial: the circuit closes if it succeeds and opens again
+    otherwise. Rate limits are not failures, the upstream is up.
+
+    Args:
+        name (str): Name of the upstream, in logs and metrics.
+        failure_threshold (int): Consecutive failures opening the circuit.
+        reset_timeout (float): Seconds before a trial call, once open.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        CIRCUIT_OPEN.track(lambda: int(self.state != "closed"), upstream=name)
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if self._trial or time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def before_call(self):
+        """
+        Raises:
+            CircuitOpenError: If the call must not be made.
+        """
+        if self.opened_at is None:
+            return
+        if self._trial or time.monotonic() - self.opened_at < self.reset_timeout:
+            raise CircuitOpenError(f"Circuit of {self.name} is open")
+        self._trial = True
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info(f"Circuit of {self.name} closed")
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    def abandon(self):
+        """The call let through was cancelled, the next one is the trial."""
+        self._trial = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self._trial or self.failures >= self.failure_threshold:
+            if self.opened_at is None or self._trial:
+                logger.error(f"Circuit of {self.name} opened after {self.failures} failures")
+            self.opened_at = time.monotonic()
+        self._trial = False
+
+
+class Policy:
+    """
+    How the calls to one upstream are made: a deadline per attempt and for the
+    whole call, retries of the retryable errors after a jittered exponential
+    backoff, an optional circuit breaker and optional hedging.
+
+    With `hedge_after`, an attempt still running after that many seconds is
+    raced against a second, identical request, and the first one to succeed
+    wins: this caps the tail latency for the price of a few extra requests.
+
+    Failed attempts are counted in UPSTREAM_ERRORS and hedges in HEDGES, under `name`.
+
+    Args:
+        name (str): Name of the upstream, in logs and metrics.
+        timeout (float): Deadline of an attempt in seconds, None if the
+            operation enforces its own.
+        retries (int): Number of retries after the first failed attempt.
+        backoff (float): Base delay of the retry backoff, in seconds.
+        max_backoff (float): Longest delay between two attempts.
+        deadline (float, optional): Deadline of the whole call, retries included.
+        breaker (CircuitBreaker, optional): Breaker of the upstream.
+        hedge_after (float, optional): Delay before hedging an attempt.
+        retryable (callable): Tells whether an error is worth a retry.
+    """
+
+    def __init__(
+        self,
+        name,
+        timeout,
+        retries=2,
+        backoff=0.5,
+        max_backoff=8,
+        deadline=None,
+        breaker=None,
+        hedge_after=None,
+        retryable=is_retryable,
+    ):
+        self.name = name
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+        self.breaker = breaker
+        self.hedge_after = hedge_after
+        self.retryable = retryable
+
+    async def call(self, operation, hedge_after=None):
+        """
+        Run `operation`, a coroutine function making one attempt of the call.
+
+        Args:
+            hedge_after (float, optional): Overrides the `hedge_after` of the policy.
+
+        Raises:
+            CircuitOpenError: If the circuit of the upstream is open.
+            asyncio.TimeoutError: If the deadline was reached.
+            Exception: The error of the last attempt.
+        """
+        hedge_after = hedge_after or self.hedge_after
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            if self.breaker is not None:
+                try:
+                    self.breaker.before_call()
+                except CircuitOpenError:
+                    UPSTREAM_ERRORS.inc(upstream=self.name, kind="circuit_open")
+                    raise
+            timeout = self.timeout
+            if self.deadline is not None:
+                remaining = self.deadline - (time.monotonic() - start)
+                timeout = remaining if timeout is None else min(timeout, remaining)
+            try:
+                if timeout is not None and timeout <= 0:
+                    raise asyncio.TimeoutError()
+                result = await asyncio.wait_for(self._attempt(operation, hedge_after), timeout)
+            except Exception as e:
+                retryable = self.retryable(e)
+                UPSTREAM_ERRORS.inc(upstream=self.name, kind=error_kind(e))
+                if self.breaker is not None:
+                    if retryable and status_of(e) != 429:
+                        self.breaker.record_failure()
+                    else:
+                        self.breaker.record_success()
+                if not retryable or attempt >= self.retries:
+                    raise
+                # Full jitter, so that callers failing together do not retry together
+                delay = random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+                if self.deadline is not None and time.monotonic() - start + delay >= self.deadline:
+                    raise
+                logger.warning(f"Call to {self.name} failed ({e!r}), retry in {delay:.2f}s")
+                await asyncio.sleep(delay)
+                attempt += 1
+            except BaseException:
+                # Cancelled: says nothing about the upstream, but must not hold the trial
+                if self.breaker is not None:
+                    self.breaker.abandon()
+                raise
+            else:
+                if self.breaker is not None:
+                    self.breaker.record_success()
+                return result
+
+    async def _attempt(self, operation, hedge_after):
+        if not hedge_after:
+            return await operation()
+
+        first = asyncio.ensure_future(operation())
+        tasks = {first}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+            if not done:
+                HEDGES.inc(upstream=self.name)
+                logger.info(f"Call to {self.name} hedged after {hedge_after}s")
+                tasks.add(asyncio.ensure_future(operation()))
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
@@ -0,0 +1,156 @@
+import copy
+import datetime
+import logging
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class UserSessionCache:
+    """
+    Bounded LRU cache of user documents in front of `AsyncUserCollection`, so that
+    an active conversation does not re-read its user document on every message.
+
+    Writes go through to Mongo and update the cached copy, so the cache never
+    holds anything that is not persisted. Entries expire after `ttl` seconds,
+    which bounds how long a change made elsewhere (another worker, a script) can
+    go unnoticed. Users added or deleted through the cache, as the Stripe
+    webhook does, are invalidated right away.
+
+    With a `SharedState`, every write through the cache also bumps the version
+    of the user in the shared state, and an entry is only served while its
+    version is the current one, so that the worker processes of the app never
+    serve a user changed by another one.
+
+    Args:
+        users (AsyncUserCollection): The collection being cached.
+        maxsize (int): Maximum number of cached users.
+        ttl (float): Lifetime of an entry, in seconds.
+        state (SharedState, optional): Versions shared with the other processes.
+    """
+
+    def __init__(self, users, maxsize=1000, ttl=300, state=None):
+        self.users = users
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.state = state
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def _get(self, phone_number):
+        entry = self._entries.get(phone_number)
+        if entry is None:
+            return None
+        doc, expires_at, version = entry
+        if expires_at < time.monotonic():
+            del self._entries[phone_number]
+            self.expirations += 1
+            return None
+        if self.state is not None and self.state.version(phone_number) != version:
+            del self._entries[phone_number]
+            self.invalidations += 1
+            return None
+        self._entries.move_to_end(phone_number)
+        return doc
+
+    def _put(self, phone_number, doc, version=None):
+        self._entries[phone_number] = (doc, time.monotonic() + self.ttl, version)
+        self._entries.move_to_end(phone_number)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def get_or_create_user(self, phone_number):
+        """
+        Same as `AsyncUserCollection.get_or_create_user`, served from the cache
+        when possible. The caller gets its own copy of the document.
+        """
+        doc = self._get(phone_number)
+        if doc is not None:
+            self.hits += 1
+            return copy.deepcopy(doc), False
+
+        self.misses += 1
+        # Read first, a write made during the lookup makes the entry stale
+        version = self.state.version(phone_number) if self.state is not None else None
+        doc, created = await self.users.get_or_create_user(phone_number)
+        self._put(phone_number, doc, version)
+        return copy.deepcopy(doc), created
+
+    async def commit_turn(self, doc, messages, nb_tokens, block=False, tokens_saved=0):
+        await self.users.commit_turn(
+            doc, messages, nb_tokens, block=block, tokens_saved=tokens_saved
+        )
+
+        phone_number = doc["phone_number"]
+        cached = self._get(phone_number)
+        if cached is None:
+            await self._bump(phone_number)
+            return
+        history = cached.get("history", []) + copy.deepcopy(messages)
+        cached["history"] = history[-self.users.history_window:]
+        cached["nb_tokens"] = cached.get("nb_tokens", 0) + nb_tokens
+        cached["nb_messages"] = cached.get("nb_messages", 0) + 1
+        cached["nb_tokens_saved"] = cached.get("nb_tokens_saved", 0) + tokens_saved
+        cached["timestamp_last_messages"] = datetime.datetime.utcnow()
+        if block:
+            cached["is_blocked"] = True
+        if self.state is not None:
+            _, expires_at, version = self._entries[phone_number]
+            bumped = await self.state.call("bump", phone_number)
+            entry = self._entries.get(phone_number)
+            if entry is None or entry[0] is not cached:
+                # Dropped or replaced meanwhile
+                return
+            # Unless another process wrote in between, the entry is still up to date
+            if bumped == version + 1:
+                self._entries[phone_number] = (cached, expires_at, version + 1)
+            else:
+                del self._entries[phone_number]
+
+    async def set_summary(self, phone_number, summary):
+        await self.users.set_summary(phone_number, summary)
+        await self.invalidate(phone_number)
+
+    async def add_user(self, phone_number, current_period_end=None, history=None):
+        result = await self.users.add_user(phone_number, current_period_end, history)
+        await self.invalidate(phone_number)
+        return result
+
+    async def delete_document(self, query):
+        result = await self.users.delete_document(query)
+        if "phone_number" in query:
+            await self.invalidate(query["phone_number"])
+        else:
+            self.clear()
+        return result
+
+    def clear(self):
+        self.invalidations += len(self._entries)
+        self._entries.clear()
+
+    async def invalidate(self, phone_number):
+        """Drop the cached user, e.g. after its subscription changed."""
+        await self._bump(phone_number)
+        if self._entries.pop(phone_number, None) is not None:
+            self.invalidations += 1
+            logger.info(f"Session of {phone_number} invalidated")
+
+    async def _bump(self, phone_number):
+        if self.state is not None:
+            await self.state.call("bump", phone_number)
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
@@ -0,0 +1,355 @@
+import asyncio
+import functools
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+ONE_MINUTE = 60
+# Message ids are remembered this long, Twilio and Stripe retry within minutes
+SEEN_TTL = 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    name TEXT PRIMARY KEY, requests REAL, tokens REAL, updated_at REAL
+);
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY, owner TEXT, expires_at REAL
+);
+CREATE TABLE IF NOT EXISTS seen (
+    id TEXT PRIMARY KEY, seen_at REAL
+);
+CREATE INDEX IF NOT EXISTS seen_at ON seen (seen_at);
+CREATE TABLE IF NOT EXISTS inbox (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT, queue TEXT, key TEXT, payload TEXT
+);
+CREATE INDEX IF NOT EXISTS inbox_key ON inbox (queue, key, seq);
+CREATE TABLE IF NOT EXISTS versions (
+    key TEXT PRIMARY KEY, version INTEGER
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    key TEXT PRIMARY KEY, value BLOB, content_type TEXT, created_at REAL
+);
+CREATE TABLE IF NOT EXISTS metrics (
+    worker TEXT PRIMARY KEY, snapshot TEXT, updated_at REAL
+);
+"""
+
+
+class SharedState:
+    """
+    State shared by the worker processes of one host, in a SQLite database.
+
+    Gunicorn runs several copies of the app, each with its own event loop and
+    memory. What must be agreed on by all of them lives here: rate limiter
+    buckets, leases (locks that expire), ids of the messages already received,
+    turns waiting to be run, versions of the cached users and voice replies,
+    and the metrics of each process.
+
+    Every operation is a single short transaction on a local file in WAL mode.
+    Read-modify-write operations take the write lock up front (BEGIN IMMEDIATE),
+    which makes them atomic across processes, but may then wait for another
+    process to release it: the ones made on the hot path go through `call`,
+    which runs them on a thread of the state, in submission order, instead of
+    the event loop. Each thread has its own connection.
+
+    Args:
+        path (str): Path of the database file, created if needed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._executor = None
+        self._executor_pid = None
+        self._inserts = 0
+
+    @property
+    def connection(self):
+        # A connection must not cross a fork, each process opens its own
+        local = self._local
+        if getattr(local, "connection", None) is None or local.pid != os.getpid():
+            local.connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            local.connection.execute("PRAGMA journal_mode=WAL")
+            local.connection.execute("PRAGMA synchronous=NORMAL")
+            local.connection.executescript(SCHEMA)
+            local.pid = os.getpid()
+        return local.connection
+
+    async def call(self, operation, *args):
+        """
+        Run the method `operation` with `args` off the event loop, on the
+        thread of the state.
+        """
+        # Threads do not survive a fork either
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(1, thread_name_prefix="shared-state")
+            self._executor_pid = os.getpid()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(getattr(self, operation), *args)
+        )
+
+    def _transaction(self, operation):
+        connection = self.connection
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            result = operation(connection)
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        return result
+
+    def close(self):
+        if self._executor is not None and self._executor_pid == os.getpid():
+            self._executor.submit(self._close).result()
+            self._executor.shutdown()
+        self._executor = None
+        self._close()
+
+    def _close(self):
+        local = self._local
+        if getattr(local, "connection", None) is not None and local.pid == os.getpid():
+            local.connection.close()
+        local.connection = None
+
+    def reserve(self, name, requests_per_minute, tokens_per_minute=None, tokens=0):
+        """
+        Take one request and `tokens` tokens from the bucket `name`, going into
+        debt if they are not available yet.
+
+        Returns:
+            float: Seconds to wait before making the call, until the debt is repaid.
+        """
+
+        def reserve(connection):
+            now = time.time()
+            requests, available = self._refill(
+                connection, name, requests_per_minute, tokens_per_minute, now
+            )
+            requests -= 1
+            available -= tokens
+            self._save(connection, name, requests, available, now)
+            delay = max(0.0, -requests * ONE_MINUTE / requests_per_minute)
+            if tokens_per_minute and available < 0:
+                delay = max(delay, -available * ONE_MINUTE / tokens_per_minute)
+            return delay
+
+        return self._transaction(reserve)
+
+    def refund(self, name, requests_per_minute, tokens_per_minute, tokens):
+        """Give `tokens` back to the bucket `name`, a negative amount takes more."""
+
+        def refund(connection):
+            now = time.time()
+            requests, available = self._refill(
+                connection, name, requests_per_minute, tokens_per_minute, now
+            )
+            available = min(tokens_per_minute or 0, available + tokens)
+            self._save(connection, name, requests, available, now)
+
+        self._transaction(refund)
+
+    def bucket(self, name, requests_per_minute, tokens_per_minute=None):
+        """
+        Returns:
+            tuple: Requests and tokens available in the bucket `name`.
+        """
+        return self._refill(
+            self.connection, name, requests_per_minute, tokens_per_minute, time.time()
+        )
+
+    def _refill(self, connection, name, requests_per_minute, tokens_per_minute, now):
+        row = connection.execute(
+            "SELECT requests, tokens, updated_at FROM buckets WHERE name = ?", (name,)
+        ).fetchone()
+        if row is None:
+            return float(requests_per_minute), float(tokens_per_minute or 0)
+        requests, tokens, updated_at = row
+        elapsed = max(0.0, now - updated_at)
+        requests = min(
+            requests_per_minute, requests + elapsed * requests_per_minute / ONE_MINUTE
+        )
+        if tokens_per_minute:
+            tokens = min(
+                tokens_per_minute, tokens + elapsed * tokens_per_minute / ONE_MINUTE
+            )
+        return requests, tokens
+
+    def _save(self, connection, name, requests, tokens, now):
+        connection.execute(
+            "INSERT OR REPLACE INTO buckets (name, requests, tokens, updated_at) "
+            "VALUES (?, ?, ?, ?)",
+            (name, requests, tokens, now),
+        )
+
+    def acquire_lease(self, name, owner, ttl):
+        """
+        Take or renew the lease `name` for `ttl` seconds. An expired lease is
+        taken over, which recovers from a worker that died holding it.
+
+        Returns:
+            bool: True if `owner` holds the lease.
+        """
+
+        def acquire(connection):
+            now = time.time()
+            connection.execute(
+                "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, "
+                "expires_at = excluded.expires_at "
+                "WHERE leases.owner = excluded.owner OR leases.expires_at < ?",
+                (name, owner, now + ttl, now),
+            )
+            row = connection.execute(
+                "SELECT owner FROM leases WHERE name = ?", (name,)
+            ).fetchone()
+            return row[0] == owner
+
+        return self._transaction(acquire)
+
+    def release_lease(self, name, owner):
+        self.connection.execute(
+            "DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner)
+        )
+
+    def remember(self, id):
+        """
+        Record a message id.
+
+        Returns:
+            bool: False if the id was already recorded, by any process.
+        """
+        now = time.time()
+        connection = self.connection
+        cursor = connection.execute(
+            "INSERT OR IGNORE INTO seen (id, seen_at) VALUES (?, ?)", (id, now)
+        )
+        self._inserts += 1
+        if self._inserts % 100 == 0:
+            connection.execute("DELETE FROM seen WHERE seen_at < ?", (now - SEEN_TTL,))
+        return cursor.rowcount == 1
+
+    def known(self, id):
+        """Whether `id` was recorded by `remember` less than SEEN_TTL seconds ago."""
+        row = self.connection.execute(
+            "SELECT 1 FROM seen WHERE id = ? AND seen_at >= ?", (id, time.time() - SEEN_TTL)
+        ).fetchone()
+        return row is not None
+
+    def push(self, queue, key, item):
+        """Append a JSON serializable `item` to the inbox of `key` in `queue`."""
+        self.connection.execute(
+            "INSERT INTO inbox (queue, key, payload) VALUES (?, ?, ?)",
+            (queue, key, json.dumps(item)),
+        )
+
+    def pop(self, queue, key, limit=None):
+        """
+        Remove the oldest items of the inbox of `key` in `queue`.
+
+        Args:
+            limit (int, optional): Maximum number of items, all of them by default.
+
+        Returns:
+            list: The items, oldest first.
+        """
+
+        def pop(connection):
+            rows = connection.execute(
+                "SELECT seq, payload FROM inbox WHERE queue = ? AND key = ? "
+                "ORDER BY seq LIMIT ?",
+                (queue, key, -1 if limit is None else limit),
+            ).fetchall()
+            if rows:
+                connection.execute(
+                    "DELETE FROM inbox WHERE queue = ? AND key = ? AND seq <= ?",
+                    (queue, key, rows[-1][0]),
+                )
+            return [json.loads(payload) for _, payload in rows]
+
+        return self._transaction(pop)
+
+    def pending(self, queue, key):
+        """Number of items in the inbox of `key` in `queue`."""
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM inbox WHERE queue = ? AND key = ?", (queue, key)
+        ).fetchone()[0]
+
+    def version(self, key):
+        row = self.connection.execute(
+            "SELECT version FROM versions WHERE key = ?", (key,)
+        ).fetchone()
+        return row[0] if row is not None else 0
+
+    def bump(self, key):
+        """
+        Increment the version of `key`, telling the other processes that their
+        copy of it is stale.
+
+        Returns:
+            int: The new version.
+        """
+        return self.connection.execute(
+            "INSERT INTO versions (key, version) VALUES (?, 1) "
+            "ON CONFLICT (key) DO UPDATE SET version = version + 1 RETURNING version",
+            (key,),
+        ).fetchone()[0]
+
+    def put_blob(self, key, value, content_type, max_bytes):
+        """Store `value`, evicting the oldest blobs beyond `max_bytes` in total."""
+
+        def put(connection):
+            connection.execute(
+                "INSERT OR REPLACE INTO blobs (key, value, content_type, created_at) "
+                "VALUES (?, ?, ?, ?)",
+                (key, value, content_type, time.time()),
+            )
+            size = 0
+            rows = connection.execute(
+                "SELECT key, length(value) FROM blobs ORDER BY created_at DESC"
+            ).fetchall()
+            for i, (_, length) in enumerate(rows):
+                size += length
+                if size > max_bytes and i > 0:
+                    connection.executemany(
+                        "DELETE FROM blobs WHERE key = ?", [(key,) for key, _ in rows[i:]]
+                    )
+                    break
+
+        self._transaction(put)
+
+    def get_blob(self, key):
+        """
+        Returns:
+            tuple: The blob and its content type, None if there is none.
+        """
+        return self.connection.execute(
+            "SELECT value, content_type FROM blobs WHERE key = ?", (key,)
+        ).fetchone()
+
+    def put_metrics(self, worker, snapshot):
+        """Replace the metrics snapshot of the process `worker`."""
+        self.connection.execute(
+            "INSERT OR REPLACE INTO metrics (worker, snapshot, updated_at) VALUES (?, ?, ?)",
+            (worker, json.dumps(snapshot), time.time()),
+        )
+
+    def metrics(self):
+        """
+        Returns:
+            dict: The metrics snapshot of each process and its age in seconds, by process.
+        """
+        now = time.time()
+        return {
+            worker: (json.loads(snapshot), now - updated_at)
+            for worker, snapshot, updated_at in self.connection.execute(
+                "SELECT worker, snapshot, updated_at FROM metrics"
+            )
+        }
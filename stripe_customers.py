@@ -0,0 +1,51 @@
+import asyncio
+import logging
+import time
+
+import stripe
+
+logger = logging.getLogger(__name__)
+
+
+class CustomerPhoneCache:
+    """
+    Phone numbers of Stripe customers, fetched off the event loop and remembered
+    for `ttl` seconds so that bursts of events for the same customer (created,
+    updated, renewed...) cost a single Stripe API call.
+
+    Args:
+        ttl (float): Lifetime of a cached phone number, in seconds.
+        maxsize (int): Maximum number of cached customers.
+    """
+
+    def __init__(self, ttl=3600, maxsize=10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._phones = {}
+        self._pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, customer_id):
+        entry = self._phones.get(customer_id)
+        if entry is not None and entry[1] > time.monotonic():
+            self.hits += 1
+            return entry[0]
+
+        # Concurrent events for the same customer share the same API call
+        task = self._pending.get(customer_id)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(
+                asyncio.to_thread(stripe.Customer.retrieve, customer_id)
+            )
+            self._pending[customer_id] = task
+        try:
+            customer = await task
+        finally:
+            self._pending.pop(customer_id, None)
+
+        if len(self._phones) >= self.maxsize:
+            self._phones.pop(next(iter(self._phones)))
+        self._phones[customer_id] = (customer["phone"], time.monotonic() + self.ttl)
+        return customer["phone"]
@@ -0,0 +1,87 @@
+import csv
+import io
+import json
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault("DATABASE_URI", "mongodb://localhost:27017")
+
+from benchmarks.fake_mongo import AsyncInMemoryCollection, InMemoryCollection  # noqa: E402
+import export_users as export_users_module  # noqa: E402
+from export_users import export_users  # noqa: E402
+from mongodb_db import AsyncUserCollection, UserCollection  # noqa: E402
+
+
+def make_users(nb_users):
+    users = UserCollection("users", db={"users": InMemoryCollection()})
+    for i in range(nb_users):
+        users.add_user(f"+336000000{i:02d}", history=[{"role": "user", "content": "bonjour"}])
+    return users
+
+
+def test_iteration_is_paginated_and_resumable():
+    users = make_users(7)
+    collection = users.collection
+
+    round_trips = collection.round_trips
+    docs = list(users.iter_users(projection={"history": 0}, batch_size=3))
+    assert [doc["phone_number"] for doc in docs] == [f"+336000000{i:02d}" for i in range(7)]
+    assert all("history" not in doc for doc in docs)
+    assert collection.round_trips - round_trips == 3
+
+    resumed = list(users.iter_users(batch_size=3, after=docs[3]["_id"]))
+    assert [doc["_id"] for doc in resumed] == [doc["_id"] for doc in docs[4:]]
+    assert resumed[0]["history"] == [{"role": "user", "content": "bonjour"}]
+
+
+@pytest.mark.asyncio
+async def test_async_iteration_matches_the_sync_one():
+    users = AsyncUserCollection("users", db={"users": AsyncInMemoryCollection()})
+    for i in range(5):
+        await users.add_user(f"+336000000{i:02d}")
+
+    docs = [doc async for doc in users.iter_users(projection={"phone_number": 1}, batch_size=2)]
+    assert [set(doc) for doc in docs] == [{"_id", "phone_number"}] * 5
+
+
+def test_export_as_ndjson_and_csv():
+    users = make_users(3)
+
+    output = io.StringIO()
+    last_id = export_users(users, output, batch_size=2)
+    lines = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert [line["phone_number"] for line in lines] == ["+33600000000", "+33600000001", "+33600000002"]
+    assert "history" not in lines[0]
+    assert lines[0]["datetime_created"].startswith("20")
+    assert last_id == lines[-1]["_id"]
+
+    output = io.StringIO()
+    export_users(users, output, format="csv", fields=["phone_number", "nb_tokens"], with_history=True)
+    rows = list(csv.DictReader(io.StringIO(output.getvalue())))
+    assert rows[0] == {
+        "phone_number": "+33600000000",
+        "nb_tokens": "0",
+        "history": '[{"role": "user", "content": "bonjour"}]',
+    }
+
+
+def test_cli_overwrites_the_output_unless_resuming(tmp_path, monkeypatch):
+    users = make_users(2)
+    monkeypatch.setattr(export_users_module, "UserCollection", lambda name: users)
+    path = tmp_path / "users.csv"
+    argv = ["export_users.py", "--format", "csv", "--fields", "phone_number", "--output", str(path)]
+
+    for _ in range(2):
+        monkeypatch.setattr(sys, "argv", argv)
+        export_users_module.main()
+    assert path.read_text().splitlines() == ["phone_number", "+33600000000", "+33600000001"]
+
+    # The in-memory collection numbers its documents
+    monkeypatch.setattr(export_users_module, "ObjectId", int)
+    first_id = str(users.collection.find_one()["_id"])
+    path.unlink()
+    monkeypatch.setattr(sys, "argv", argv + ["--after", first_id])
+    export_users_module.main()
+    assert path.read_text().splitlines() == ["phone_number", "+33600000001"]
@@ -0,0 +1,58 @@
+import datetime
+
+from history import HistoryManager
+
+NOW = datetime.datetime(2024, 1, 1, 12, 0)
+
+
+def entry(role, tokens, minutes_ago):
+    return {
+        "role": role,
+        "content": f"{role} {minutes_ago}",
+        "tokens": tokens,
+        "ts": NOW - datetime.timedelta(minutes=minutes_ago),
+    }
+
+
+def test_trim_keeps_the_most_recent_messages_within_the_budget():
+    manager = HistoryManager(token_budget=100, ttl=10)
+    history = [
+        entry("user", 30, 5),
+        entry("assistant", 40, 5),
+        entry("user", 10, 4),
+        entry("assistant", 50, 4),
+        entry("user", 20, 1),
+    ]
+
+    assert manager.trim(history, now=NOW) == history[2:]
+
+
+def test_trim_drops_expired_messages_and_orphan_answers():
+    manager = HistoryManager(token_budget=1000, ttl=10)
+    history = [
+        entry("user", 10, 30),
+        entry("assistant", 10, 5),
+        entry("user", 10, 1),
+    ]
+
+    assert manager.trim(history, now=NOW) == history[2:]
+
+
+def test_last_message_is_kept_even_over_budget():
+    manager = HistoryManager(token_budget=10, ttl=10)
+    history = [entry("user", 5, 2), entry("user", 50, 1)]
+
+    assert manager.trim(history, now=NOW) == history[1:]
+
+
+def test_prompt_strips_bookkeeping_fields_and_legacy_entries_are_counted():
+    manager = HistoryManager()
+    history = [{"role": "user", "content": "bonjour"}]
+    manager.add(history, "assistant", "salut", tokens=3)
+
+    assert manager.tokens(history[0]) > 0
+    assert manager.prompt({"role": "system", "content": "sys"}, history) == [
+        {"role": "system", "content": "sys"},
+        {"role": "user", "content": "bonjour"},
+        {"role": "assistant", "content": "salut"},
+    ]
@@ -0,0 +1,34 @@
+import asyncio
+
+import pytest
+
+from http_clients import ClientPool
+
+
+@pytest.mark.asyncio
+async def test_clients_are_shared_until_stopped(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    pool = ClientPool(limits={"twilio": {"connections": 3}})
+    await pool.start()
+    session = pool.session("twilio")
+    openai_client = pool.openai
+
+    assert pool.session("twilio") is session
+    assert pool.openai is openai_client
+    assert session.connector.limit == 3
+    assert pool.limits["twilio"]["timeout"] == 15
+
+    await pool.stop()
+    assert session.closed
+    assert pool.session("twilio") is not session
+    assert pool.openai is not openai_client
+    await pool.stop()
+
+
+@pytest.mark.asyncio
+async def test_polly_client_is_built_once_by_concurrent_threads():
+    pool = ClientPool()
+    polly_clients = await asyncio.gather(*(asyncio.to_thread(lambda: pool.polly) for _ in range(8)))
+
+    assert all(client is polly_clients[0] for client in polly_clients)
+    await pool.stop()
@@ -0,0 +1,69 @@
+import os
+import time
+
+import pytest
+
+os.environ.setdefault("DATABASE_URI", "mongodb://localhost:27017")
+
+from benchmarks.fake_mongo import AsyncInMemoryCollection  # noqa: E402
+from maintenance import MaintenanceScheduler  # noqa: E402
+from mongodb_db import AsyncUserCollection  # noqa: E402
+
+
+async def make_users():
+    users = AsyncUserCollection("users", db={"users": AsyncInMemoryCollection()})
+    now = time.time()
+    for i, current_period_end in enumerate([None, now + 3600, now - 60, now - 2 * 86400, now - 3 * 86400]):
+        await users.add_user(f"+3360000000{i}", current_period_end)
+        await users.collection.update_one({"phone_number": f"+3360000000{i}"}, {"$set": {"nb_tokens": 100}})
+    return users
+
+
+@pytest.mark.asyncio
+async def test_jobs_run_in_batches_and_report_what_they_touched():
+    users = await make_users()
+    batches = []
+
+    async def throttle():
+        batches.append(len(users.collection.docs))
+
+    scheduler = MaintenanceScheduler(pause=0)
+    scheduler.add("reset_tokens", lambda _: users.reset_tokens(batch_size=1, throttle=throttle))
+    report = await scheduler.run("reset_tokens")
+    assert report["documents"] == 2
+    assert len(batches) == 2
+    reset = [doc["phone_number"] for doc in users.collection.docs.values() if doc["nb_tokens"] == 0]
+    assert reset == ["+33600000003", "+33600000004"]
+
+    deleted = []
+
+    async def on_deleted(phone_numbers):
+        deleted.extend(phone_numbers)
+
+    scheduler.add(
+        "delete_ended_subscriptions",
+        lambda throttle: users.delete_ended_subsciption(
+            batch_size=2, throttle=throttle, on_deleted=on_deleted
+        ),
+    )
+    report = await scheduler.run("delete_ended_subscriptions")
+    assert report["documents"] == 3
+    assert sorted(deleted) == ["+33600000002", "+33600000003", "+33600000004"]
+    remaining = [doc["phone_number"] for doc in users.collection.docs.values()]
+    assert remaining == ["+33600000000", "+33600000001"]
+    assert scheduler.reports["delete_ended_subscriptions"]["duration"] >= 0
+
+
+@pytest.mark.asyncio
+async def test_throttle_waits_while_traffic_is_high():
+    calls = []
+
+    def busy():
+        calls.append(None)
+        return len(calls) < 2
+
+    scheduler = MaintenanceScheduler(pause=0, busy=busy, max_wait=5)
+    start = time.monotonic()
+    await scheduler.throttle()
+    assert 0.9 <= time.monotonic() - start < 2
+    assert len(calls) == 2
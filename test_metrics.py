@@ -0,0 +1,57 @@
+from metrics import Counter, Gauge, Histogram, Registry
+
+
+def test_histogram_buckets_are_cumulative_in_the_exposition():
+    registry = Registry()
+    histogram = Histogram("stage_seconds", "Stages.", ("stage",), buckets=(0.1, 1), registry=registry)
+    for value in (0.05, 0.5, 0.5, 5):
+        histogram.observe(value, stage="llm")
+
+    lines = registry.render().splitlines()
+    assert 'stage_seconds_bucket{stage="llm",le="0.1"} 1' in lines
+    assert 'stage_seconds_bucket{stage="llm",le="1"} 3' in lines
+    assert 'stage_seconds_bucket{stage="llm",le="+Inf"} 4' in lines
+    assert 'stage_seconds_count{stage="llm"} 4' in lines
+    assert 'stage_seconds_sum{stage="llm"} 6.05' in lines
+    assert "# TYPE stage_seconds histogram" in lines
+
+
+def test_counters_and_gauges_per_label():
+    registry = Registry()
+    tokens = Counter("tokens_total", "Tokens.", ("plan",), registry=registry)
+    depth = Gauge("queue_depth", "Depth.", ("queue",), registry=registry)
+    tokens.inc(120, plan="trial")
+    tokens.inc(30, plan="trial")
+    tokens.inc(500, plan="subscriber")
+    pending = [1, 2, 3]
+    depth.track(lambda: len(pending), queue="turns")
+    pending.pop()
+
+    lines = registry.render().splitlines()
+    assert 'tokens_total{plan="trial"} 150' in lines
+    assert 'tokens_total{plan="subscriber"} 500' in lines
+    assert 'queue_depth{queue="turns"} 2' in lines
+
+
+def test_snapshots_of_several_workers_render_together():
+    registry = Registry()
+    tokens = Counter("tokens_total", "Tokens.", ("plan",), registry=registry)
+    depth = Gauge("queue_depth", "Depth.", ("queue",), registry=registry)
+    seconds = Histogram("stage_seconds", "Stages.", ("stage",), buckets=(1,), registry=registry)
+    snapshots = {}
+    for worker, amount in (("101", 120), ("102", 30), ("103", 5)):
+        tokens.inc(amount, plan="trial")
+        depth.set(amount, queue="turns")
+        seconds.observe(amount / 100, stage="llm")
+        snapshots[worker] = registry.snapshot()
+        tokens._values.clear()
+        seconds._counts.clear()
+
+    # Worker 103 has exited
+    lines = registry.render(snapshots, live={"101", "102"}).splitlines()
+    assert 'tokens_total{plan="trial"} 155' in lines
+    assert 'queue_depth{queue="turns",worker="101"} 120' in lines
+    assert 'queue_depth{queue="turns",worker="102"} 30' in lines
+    assert not any('worker="103"' in line for line in lines)
+    assert 'stage_seconds_bucket{stage="llm",le="1"} 2' in lines
+    assert 'stage_seconds_count{stage="llm"} 3' in lines
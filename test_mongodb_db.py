@@ -0,0 +1,26 @@
+import datetime
+import os
+
+import pytest
+
+os.environ.setdefault("DATABASE_URI", "mongodb://localhost:27017")
+
+from benchmarks.fake_mongo import AsyncInMemoryCollection  # noqa: E402
+from mongodb_db import AsyncStripeEventCollection  # noqa: E402
+
+
+@pytest.mark.asyncio
+async def test_pending_stripe_events_can_be_replayed():
+    events = AsyncStripeEventCollection(db={"stripe_events": AsyncInMemoryCollection()})
+    for event_id in ("evt_1", "evt_2"):
+        assert await events.record({"id": event_id, "type": "customer.subscription.created"})
+    assert not await events.record({"id": "evt_1", "type": "customer.subscription.created"})
+    await events.mark_done("evt_2")
+
+    assert await events.is_pending("evt_1")
+    assert not await events.is_pending("evt_2")
+    assert [event["id"] for event in await events.pending()] == ["evt_1"]
+
+    # Events received after the cut-off may still be in the queue
+    an_hour_ago = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+    assert await events.pending(received_before=an_hour_ago) == []
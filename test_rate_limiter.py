@@ -0,0 +1,57 @@
+import asyncio
+import time
+
+import pytest
+
+from rate_limiter import AsyncRateLimiter
+
+
+@pytest.mark.asyncio
+async def test_waits_for_tokens_without_blocking_the_loop():
+    limiter = AsyncRateLimiter("test-tokens", requests_per_minute=600, tokens_per_minute=600)
+    await limiter.acquire(600)
+
+    ticks = 0
+
+    async def ticker():
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.01)
+            ticks += 1
+
+    task = asyncio.create_task(ticker())
+    start = time.monotonic()
+    await limiter.acquire(3)
+    elapsed = time.monotonic() - start
+    task.cancel()
+
+    assert 0.25 <= elapsed < 0.6
+    assert ticks >= 10
+    assert limiter.metrics()["throttled_total"] == 1
+
+
+@pytest.mark.asyncio
+async def test_callers_are_served_in_arrival_order():
+    limiter = AsyncRateLimiter("test-fifo", requests_per_minute=600, tokens_per_minute=600)
+    await limiter.acquire(600)
+    order = []
+
+    async def call(name, tokens):
+        await limiter.acquire(tokens)
+        order.append(name)
+
+    await asyncio.gather(call("big", 3), call("small", 1), call("tiny", 0))
+
+    assert order == ["big", "small", "tiny"]
+
+
+@pytest.mark.asyncio
+async def test_refund_and_saturation():
+    limiter = AsyncRateLimiter("test-refund", requests_per_minute=60, tokens_per_minute=1000)
+    await limiter.acquire(800)
+    assert limiter.metrics()["tokens_saturation"] == pytest.approx(0.8, abs=0.01)
+
+    await limiter.refund(500)
+    metrics = limiter.metrics()
+    assert metrics["tokens_saturation"] == pytest.approx(0.3, abs=0.01)
+    assert metrics["requests_saturation"] == pytest.approx(1 / 60, abs=0.01)
@@ -0,0 +1,108 @@
+import asyncio
+
+import pytest
+
+from metrics import HEDGES
+from resilience import CircuitBreaker, CircuitOpenError, Policy
+
+
+class Unavailable(Exception):
+    status = 503
+
+
+class BadRequest(Exception):
+    status = 400
+
+
+class FlakyUpstream:
+    """Fails or stalls on the first calls, as scripted, then answers."""
+
+    def __init__(self, faults=(), latency=0.0):
+        self.faults = list(faults)
+        self.latency = latency
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        fault = self.faults.pop(0) if self.faults else None
+        if isinstance(fault, Exception):
+            raise fault
+        await asyncio.sleep(fault if fault is not None else self.latency)
+        return f"answer {self.calls}"
+
+
+@pytest.mark.asyncio
+async def test_retryable_errors_and_timeouts_are_retried():
+    upstream = FlakyUpstream([Unavailable(), 1.0])
+    policy = Policy("fake", timeout=0.1, retries=2, backoff=0.01)
+
+    assert await policy.call(upstream) == "answer 3"
+
+    upstream = FlakyUpstream([BadRequest()])
+    with pytest.raises(BadRequest):
+        await policy.call(upstream)
+    assert upstream.calls == 1
+
+
+@pytest.mark.asyncio
+async def test_deadline_bounds_the_retries():
+    upstream = FlakyUpstream(latency=1.0)
+    policy = Policy("fake", timeout=0.1, retries=10, backoff=0.01, deadline=0.35)
+
+    start = asyncio.get_running_loop().time()
+    with pytest.raises(asyncio.TimeoutError):
+        await policy.call(upstream)
+    assert asyncio.get_running_loop().time() - start < 0.5
+    assert upstream.calls <= 4
+
+
+@pytest.mark.asyncio
+async def test_circuit_fails_fast_then_recovers():
+    breaker = CircuitBreaker("fake", failure_threshold=2, reset_timeout=0.2)
+    policy = Policy("fake", timeout=1, retries=0, breaker=breaker)
+    upstream = FlakyUpstream([Unavailable(), Unavailable(), Unavailable()])
+
+    for _ in range(2):
+        with pytest.raises(Unavailable):
+            await policy.call(upstream)
+    with pytest.raises(CircuitOpenError):
+        await policy.call(upstream)
+    assert upstream.calls == 2
+
+    # The trial call fails, the circuit opens again
+    await asyncio.sleep(0.2)
+    with pytest.raises(Unavailable):
+        await policy.call(upstream)
+    assert breaker.state == "open"
+
+    await asyncio.sleep(0.2)
+    assert await policy.call(upstream) == "answer 4"
+    assert breaker.state == "closed"
+
+
+@pytest.mark.asyncio
+async def test_hedged_call_beats_a_slow_attempt():
+    upstream = FlakyUpstream([1.0], latency=0.01)
+    policy = Policy("hedged", timeout=2, retries=0)
+    hedges = HEDGES.value(upstream="hedged")
+
+    start = asyncio.get_running_loop().time()
+    assert await policy.call(upstream, hedge_after=0.05) == "answer 2"
+    assert asyncio.get_running_loop().time() - start < 0.5
+    assert HEDGES.value(upstream="hedged") == hedges + 1
+
+
+@pytest.mark.asyncio
+async def test_cancelled_trial_does_not_keep_the_circuit_open():
+    breaker = CircuitBreaker("fake", failure_threshold=1, reset_timeout=0.1)
+    policy = Policy("fake", timeout=5, retries=0, breaker=breaker)
+    with pytest.raises(Unavailable):
+        await policy.call(FlakyUpstream([Unavailable()]))
+
+    await asyncio.sleep(0.1)
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(policy.call(FlakyUpstream(latency=1.0)), 0.05)
+    assert breaker.state == "half_open"
+
+    assert await policy.call(FlakyUpstream()) == "answer 1"
+    assert breaker.state == "closed"
@@ -0,0 +1,122 @@
+import os
+
+import pytest
+
+os.environ.setdefault("DATABASE_URI", "mongodb://localhost:27017")
+
+from benchmarks.fake_mongo import AsyncInMemoryCollection  # noqa: E402
+from mongodb_db import AsyncMessageLog, AsyncUserCollection  # noqa: E402
+from session_cache import UserSessionCache  # noqa: E402
+from shared_state import SharedState  # noqa: E402
+
+
+def make_cache(**kwargs):
+    collection = AsyncInMemoryCollection()
+    users = AsyncUserCollection("users", db={"users": collection})
+    return UserSessionCache(users, **kwargs), collection
+
+
+@pytest.mark.asyncio
+async def test_turns_are_served_from_the_cache_and_written_through():
+    sessions, collection = make_cache()
+
+    doc, created = await sessions.get_or_create_user("+33600000001")
+    assert created
+    doc["history"].append({"role": "user", "content": "pending"})
+    await sessions.commit_turn(doc, [{"role": "user", "content": "bonjour"}], 12)
+
+    round_trips = collection.round_trips
+    doc, created = await sessions.get_or_create_user("+33600000001")
+    assert not created
+    assert collection.round_trips == round_trips
+    assert doc["history"] == [{"role": "user", "content": "bonjour"}]
+    assert doc["nb_tokens"] == 12
+    assert doc["nb_messages"] == 1
+
+    stored = await sessions.users.find_document("phone_number", "+33600000001")
+    assert stored["history"] == doc["history"]
+    assert stored["nb_tokens"] == 12
+    assert sessions.stats()["hits"] == 1
+    assert sessions.stats()["misses"] == 1
+
+
+@pytest.mark.asyncio
+async def test_subscription_changes_invalidate_the_session():
+    sessions, _ = make_cache()
+    doc, _ = await sessions.get_or_create_user("+33600000001")
+    assert doc["current_period_end"] is None
+
+    await sessions.add_user("+33600000001", current_period_end=1893456000)
+    doc, _ = await sessions.get_or_create_user("+33600000001")
+    assert doc["current_period_end"] is not None
+
+    await sessions.delete_document({"phone_number": "+33600000001"})
+    doc, created = await sessions.get_or_create_user("+33600000001")
+    assert created
+    assert sessions.stats()["invalidations"] == 2
+
+
+@pytest.mark.asyncio
+async def test_least_recently_used_sessions_are_evicted():
+    sessions, _ = make_cache(maxsize=2)
+    for phone_number in ("+33600000001", "+33600000002", "+33600000001", "+33600000003"):
+        await sessions.get_or_create_user(phone_number)
+
+    stats = sessions.stats()
+    assert stats["size"] == 2
+    assert stats["evictions"] == 1
+    await sessions.get_or_create_user("+33600000001")
+    assert sessions.stats()["hits"] == 2
+
+
+@pytest.mark.asyncio
+async def test_a_write_from_another_process_makes_the_entry_stale(tmp_path):
+    state = SharedState(str(tmp_path / "state.sqlite3"))
+    collection = AsyncInMemoryCollection()
+    users = AsyncUserCollection("users", db={"users": collection})
+    # Two worker processes, each with its own cache
+    first = UserSessionCache(users, state=state)
+    second = UserSessionCache(users, state=state)
+
+    doc, _ = await first.get_or_create_user("+33600000001")
+    await first.commit_turn(doc, [{"role": "user", "content": "bonjour"}], 12)
+    doc, _ = await first.get_or_create_user("+33600000001")
+    assert first.stats()["hits"] == 1
+
+    other, _ = await second.get_or_create_user("+33600000001")
+    await second.commit_turn(other, [{"role": "user", "content": "au revoir"}], 5)
+
+    doc, _ = await first.get_or_create_user("+33600000001")
+    assert doc["history"][-1] == {"role": "user", "content": "au revoir"}
+    assert doc["nb_tokens"] == 17
+    assert first.stats()["misses"] == 2
+
+
+@pytest.mark.asyncio
+async def test_the_document_keeps_a_window_and_the_log_every_turn():
+    db = {"users": AsyncInMemoryCollection(), "messages": AsyncInMemoryCollection()}
+    sessions = UserSessionCache(AsyncUserCollection("users", db=db, history_window=4))
+    log = AsyncMessageLog(db=db)
+
+    doc, _ = await sessions.get_or_create_user("+33600000001")
+    for i in range(3):
+        messages = [
+            {"role": "user", "content": f"question {i}"},
+            {"role": "assistant", "content": f"réponse {i}"},
+        ]
+        await sessions.commit_turn(doc, messages, 10)
+        await log.append("+33600000001", messages, 10)
+
+    expected = ["question 1", "réponse 1", "question 2", "réponse 2"]
+    cached, _ = await sessions.get_or_create_user("+33600000001")
+    stored = await sessions.users.find_document("phone_number", "+33600000001")
+    assert [entry["content"] for entry in cached["history"]] == expected
+    assert [entry["content"] for entry in stored["history"]] == expected
+
+    turns = await log.conversation("+33600000001")
+    assert [turn["messages"][0]["content"] for turn in turns] == [
+        "question 0",
+        "question 1",
+        "question 2",
+    ]
+    assert db["messages"].round_trips == 4
@@ -0,0 +1,53 @@
+import time
+
+from shared_state import SharedState
+
+
+def test_budget_and_leases_are_shared_between_processes(tmp_path):
+    path = str(tmp_path / "state.sqlite3")
+    # Two connections to the same file, as two worker processes have
+    first, second = SharedState(path), SharedState(path)
+
+    assert first.reserve("chat", requests_per_minute=2) == 0
+    assert second.reserve("chat", requests_per_minute=2) == 0
+    # The third call of the minute waits for the bucket to refill, whoever makes it
+    assert 29 < first.reserve("chat", requests_per_minute=2) <= 30
+    assert 59 < second.reserve("chat", requests_per_minute=2) <= 60
+
+    assert first.acquire_lease("turns:+33600000000", "worker-1", ttl=60)
+    assert not second.acquire_lease("turns:+33600000000", "worker-2", ttl=60)
+    assert first.acquire_lease("turns:+33600000000", "worker-1", ttl=60)
+    first.release_lease("turns:+33600000000", "worker-1")
+    assert second.acquire_lease("turns:+33600000000", "worker-2", ttl=0.01)
+    time.sleep(0.02)
+    # worker-2 died holding the lease
+    assert first.acquire_lease("turns:+33600000000", "worker-1", ttl=60)
+
+
+def test_messages_versions_and_blobs(tmp_path):
+    path = str(tmp_path / "state.sqlite3")
+    first, second = SharedState(path), SharedState(path)
+
+    assert first.remember("SM1")
+    assert not second.remember("SM1")
+
+    first.push("turns", "+33600000000", {"text": "salut"})
+    second.push("turns", "+33600000000", {"text": "ça va ?"})
+    assert first.pending("turns", "+33600000000") == 2
+    assert second.pop("turns", "+33600000000", limit=1) == [{"text": "salut"}]
+    assert first.pop("turns", "+33600000000") == [{"text": "ça va ?"}]
+    assert first.pop("turns", "+33600000000") == []
+
+    assert first.version("+33600000000") == 0
+    assert second.bump("+33600000000") == 1
+    assert first.version("+33600000000") == 1
+
+    first.put_blob("a.mp3", b"a" * 6, "audio/mpeg", max_bytes=10)
+    first.put_blob("b.mp3", b"b" * 6, "audio/mpeg", max_bytes=10)
+    assert second.get_blob("a.mp3") is None
+    assert second.get_blob("b.mp3") == (b"b" * 6, "audio/mpeg")
+
+    first.put_metrics("101", {"tokens_total": [[["trial"], 120]]})
+    snapshot, age = second.metrics()["101"]
+    assert snapshot == {"tokens_total": [[["trial"], 120]]}
+    assert 0 <= age < 1
@@ -0,0 +1,53 @@
+import tiktoken
+
+from tokenizer import DEFAULT_ENCODING, Tokenizer
+
+MESSAGES = [
+    {"role": "system", "content": "Tu es WhatIA, un assistant sur WhatsApp."},
+    {"role": "user", "content": "Comment fonctionne un moteur à combustion ?", "name": "Lea"},
+]
+
+
+def expected_count(encoding, messages):
+    # The chat format of the OpenAI cookbook: 3 tokens per message, 1 per name, 3 for the reply
+    n = 3
+    for message in messages:
+        n += 3 + sum(len(encoding.encode(value)) for value in message.values())
+        n += 1 if "name" in message else 0
+    return n
+
+
+def test_counts_match_tiktoken():
+    tokenizer = Tokenizer("gpt-4")
+    # Loaded on first use only
+    assert tokenizer._encoding is None
+
+    encoding = tiktoken.encoding_for_model("gpt-4")
+    text = MESSAGES[1]["content"]
+    assert tokenizer.count(text) == len(encoding.encode(text))
+    assert tokenizer.count_messages(MESSAGES) == expected_count(encoding, MESSAGES)
+
+
+def test_unknown_model_falls_back_to_the_default_encoding():
+    tokenizer = Tokenizer("whatia-model-of-the-future")
+
+    assert tokenizer.encoding.name == DEFAULT_ENCODING
+    encoding = tiktoken.get_encoding(DEFAULT_ENCODING)
+    assert tokenizer.count_messages(MESSAGES) == expected_count(encoding, MESSAGES)
+
+
+def test_memo_hit_does_not_encode_again():
+    tokenizer = Tokenizer("gpt-4")
+    calls = []
+    encode = tokenizer.encoding.encode
+
+    class SpyEncoding:
+        def encode(self, text):
+            calls.append(text)
+            return encode(text)
+
+    tokenizer._encoding = SpyEncoding()
+    first = tokenizer.count("Bonjour WhatIA")
+    assert tokenizer.count("Bonjour WhatIA") == first
+    assert calls == ["Bonjour WhatIA"]
+    assert tokenizer.memo_info() == {"hits": 1, "misses": 1, "size": 1}
@@ -0,0 +1,78 @@
+import asyncio
+
+import pytest
+
+from shared_state import SharedState
+from turn_queue import SharedTurnQueue, TurnQueue
+
+
+@pytest.mark.asyncio
+async def test_burst_of_a_user_is_merged_into_one_turn():
+    handled = []
+
+    async def handler(turn):
+        handled.append(turn)
+
+    queue = TurnQueue(handler, debounce=0.05, merge=lambda turns: "\n".join(turns))
+    await queue.start()
+    for i, message in enumerate(["salut", "j'ai une question", "sur python"]):
+        assert queue.submit(message, message_id=f"SM{i}", key="+33600000000")
+    assert not queue.submit("salut", message_id="SM0", key="+33600000000")
+    await queue.stop()
+
+    assert handled == ["salut\nj'ai une question\nsur python"]
+
+
+@pytest.mark.asyncio
+async def test_turns_of_a_user_run_in_order_and_users_run_concurrently():
+    events = []
+
+    async def handler(turn):
+        events.append(("start", turn))
+        await asyncio.sleep(0.05)
+        events.append(("end", turn))
+
+    queue = TurnQueue(handler, workers=4, merge=lambda turns: "+".join(turns))
+    await queue.start()
+    queue.submit("a1", key="a")
+    queue.submit("b1", key="b")
+    await asyncio.sleep(0.01)
+    # Both arrive while a1 is running and make up the next turn of a
+    queue.submit("a2", key="a")
+    queue.submit("a3", key="a")
+    await queue.stop()
+
+    assert events.index(("start", "b1")) < events.index(("end", "a1"))
+    assert events.index(("end", "a1")) < events.index(("start", "a2+a3"))
+    assert [turn for event, turn in events if event == "start"] == ["a1", "b1", "a2+a3"]
+
+
+@pytest.mark.asyncio
+async def test_processes_sharing_state_run_a_user_once_at_a_time(tmp_path):
+    state = SharedState(str(tmp_path / "state.sqlite3"))
+    events = []
+
+    async def handler(turn):
+        events.append(("start", turn))
+        await asyncio.sleep(0.05)
+        events.append(("end", turn))
+
+    # Two workers of the app, each with its own queue
+    queues = [
+        SharedTurnQueue(handler, state, "turns", owner=f"worker-{i}", poll=0.01, merge="+".join)
+        for i in range(2)
+    ]
+    for queue in queues:
+        await queue.start()
+
+    assert queues[0].submit("a", message_id="SM0", key="+33600000000")
+    # Dropped in the background, by the shared state
+    queues[1].submit("a", message_id="SM0", key="+33600000000")
+    await asyncio.sleep(0.01)
+    assert queues[1].submit("b", message_id="SM1", key="+33600000000")
+    assert queues[0].submit("c", message_id="SM2", key="+33600000000")
+    for queue in queues:
+        await queue.stop()
+
+    # "b" and "c" arrived while "a" was running, on both workers
+    assert events == [("start", "a"), ("end", "a"), ("start", "b+c"), ("end", "b+c")]
@@ -0,0 +1,28 @@
+from utils import SentenceChunker, split_long_string
+
+TEXT = " ".join(
+    f"Phrase numéro {i} qui se termine{'!' if i % 3 else '.'}" for i in range(200)
+)
+
+
+def stream(text, chunker, step=7):
+    chunks = []
+    for i in range(0, len(text), step):
+        chunks += chunker.feed(text[i : i + step])
+    return chunks + chunker.close()
+
+
+def test_streamed_chunks_match_split_long_string():
+    assert stream(TEXT, SentenceChunker()) == split_long_string(TEXT)
+    assert stream(TEXT, SentenceChunker(max_len=100), step=3) == split_long_string(
+        TEXT, max_len=100
+    )
+
+
+def test_chunks_are_sent_early_once_flush_len_is_reached():
+    chunker = SentenceChunker(flush_len=40)
+    assert chunker.feed("Première phrase assez longue pour être envoyée") == []
+    assert chunker.feed(". Suite") == [
+        "Première phrase assez longue pour être envoyée."
+    ]
+    assert chunker.close() == ["Suite"]
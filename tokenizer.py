@@ -0,0 +1,86 @@
+import threading
+from collections import OrderedDict
+
+import tiktoken
+
+DEFAULT_MODEL = "gpt-4"
+# Encoding of the models unknown to tiktoken, that of the current chat models
+DEFAULT_ENCODING = "cl100k_base"
+
+# Chat format overhead of the gpt-3.5-turbo/gpt-4 models: every message is wrapped
+# in <|start|>{role}\n{content}<|end|>\n, and the reply is primed with <|start|>assistant
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_NAME = 1
+TOKENS_PER_REPLY = 3
+
+
+class Tokenizer:
+    """
+    Token counter for one model. The encoding is only loaded on first use, and
+    the counts of recently seen strings (system prompt, history, canned
+    messages...) are memoized. Models unknown to tiktoken are counted with
+    DEFAULT_ENCODING.
+
+    Args:
+        model (str): Name of the OpenAI model.
+        memo_size (int): Number of strings whose count is remembered.
+    """
+
+    def __init__(self, model=DEFAULT_MODEL, memo_size=4096):
+        self.model = model
+        self.memo_size = memo_size
+        self._encoding = None
+        self._memo = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def encoding(self):
+        if self._encoding is None:
+            try:
+                self._encoding = tiktoken.encoding_for_model(self.model)
+            except KeyError:
+                self._encoding = tiktoken.get_encoding(DEFAULT_ENCODING)
+        return self._encoding
+
+    def count(self, text):
+        n = self._memo.get(text)
+        if n is not None:
+            self._memo.move_to_end(text)
+            self.hits += 1
+            return n
+
+        self.misses += 1
+        n = len(self.encoding.encode(text))
+        self._memo[text] = n
+        if len(self._memo) > self.memo_size:
+            self._memo.popitem(last=False)
+        return n
+
+    def count_messages(self, messages):
+        """
+        Number of prompt tokens of a chat completion request, including the
+        per-message overhead of the chat format.
+        """
+        n = TOKENS_PER_REPLY
+        for message in messages:
+            n += TOKENS_PER_MESSAGE
+            n += self.count(message["role"]) + self.count(message["content"])
+            if "name" in message:
+                n += self.count(message["name"]) + TOKENS_PER_NAME
+        return n
+
+    def memo_info(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._memo)}
+
+
+_tokenizers = {}
+_lock = threading.Lock()
+
+
+def get_tokenizer(model=DEFAULT_MODEL):
+    tokenizer = _tokenizers.get(model)
+    if tokenizer is None:
+        with _lock:
+            tokenizer = _tokenizers.setdefault(model, Tokenizer(model))
+    return tokenizer
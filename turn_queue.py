@@ -0,0 +1,313 @@
+import asyncio
+import logging
+import os
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class TurnQueue:
+    """
+    In-process worker pool running conversation turns after the webhook has
+    been acknowledged.
+
+    Twilio retries a webhook that did not answer in time with the same
+    MessageSid, so recently seen ids are remembered and duplicates dropped.
+
+    Turns submitted with a `key` (the user's phone number) are serialized per
+    key: a key never has two turns running at once, and turns run in the order
+    they were submitted. Turns of the same key arriving less than `debounce`
+    seconds apart, or while a previous turn of the key is running, are merged
+    with `merge` into a single turn. Turns of different keys are not delayed by
+    each other.
+
+    Args:
+        handler (coroutine function): Called with each submitted turn.
+        workers (int): Number of turns processed concurrently.
+        maxsize (int): Maximum number of pending turns, 0 for unbounded.
+        seen_size (int): Number of message ids remembered for deduplication.
+        debounce (float): Quiet period in seconds before the turns of a key run.
+        merge (callable, optional): Builds one turn from a list of turns of a key.
+            Defaults to running only the last one.
+    """
+
+    def __init__(self, handler, workers=4, maxsize=0, seen_size=1000, debounce=0, merge=None):
+        self.handler = handler
+        self.workers = workers
+        self.seen_size = seen_size
+        self.debounce = debounce
+        self.merge = merge or (lambda turns: turns[-1])
+        self._queue = asyncio.Queue(maxsize)
+        self._seen = OrderedDict()
+        self._tasks = []
+        # Per key: turns not dispatched yet, debounce timers and keys running
+        self._pending = {}
+        self._timers = {}
+        self._running = set()
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    async def start(self):
+        self._tasks = [
+            asyncio.create_task(self._work()) for _ in range(self.workers)
+        ]
+
+    async def stop(self):
+        await self.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def join(self):
+        """Wait until every submitted turn has been processed."""
+        while self._pending or self._running:
+            self._idle.clear()
+            await self._idle.wait()
+        await self._queue.join()
+
+    def submit(self, turn, message_id=None, key=None):
+        """
+        Queue a turn for processing.
+
+        Returns:
+            bool: False if the turn was a duplicate or the queue is full.
+        """
+        if message_id is not None:
+            if message_id in self._seen:
+                logger.info(f"Duplicate message {message_id} ignored")
+                return False
+            self._seen[message_id] = None
+            if len(self._seen) > self.seen_size:
+                self._seen.popitem(last=False)
+
+        if key is None:
+            return self._put(turn)
+
+        self._pending.setdefault(key, []).append(turn)
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        if self.debounce:
+            loop = asyncio.get_running_loop()
+            self._timers[key] = loop.call_later(self.debounce, self._debounced, key)
+        else:
+            self._dispatch(key)
+        return True
+
+    def qsize(self):
+        return self._queue.qsize() + sum(len(turns) for turns in self._pending.values())
+
+    def _put(self, turn, key=None):
+        try:
+            self._queue.put_nowait((key, turn))
+        except asyncio.QueueFull:
+            logger.error("Turn queue is full, message dropped")
+            return False
+        return True
+
+    def _debounced(self, key):
+        del self._timers[key]
+        self._dispatch(key)
+
+    def _dispatch(self, key):
+        # A running turn dispatches the key again when it is done
+        if key in self._running or key in self._timers:
+            return
+        turns = self._pending.pop(key, None)
+        if not turns:
+            return
+        if len(turns) > 1:
+            logger.info(f"{len(turns)} messages of {key} merged into one turn")
+        self._running.add(key)
+        if not self._put(self.merge(turns), key):
+            self._done(key)
+
+    def _done(self, key):
+        self._running.discard(key)
+        self._dispatch(key)
+        if not self._pending and not self._running:
+            self._idle.set()
+
+    async def _work(self):
+        while True:
+            key, turn = await self._queue.get()
+            try:
+                await self.handler(turn)
+            except Exception:
+                logger.exception("Turn processing failed")
+            finally:
+                if key is not None:
+                    self._done(key)
+                self._queue.task_done()
+
+
+class SharedTurnQueue(TurnQueue):
+    """
+    `TurnQueue` whose guarantees hold across the worker processes of the app,
+    through a `SharedState`.
+
+    Message ids are deduplicated in the shared state, so a webhook retried on
+    another process is still dropped. Keyed turns are written to the shared
+    inbox of their key, and a process only runs a key while it holds the lease
+    of that key: it then takes every turn waiting in the inbox, whichever
+    process received them, oldest first. A process that finds the lease taken
+    tries again every `poll` seconds while turns of the key are waiting, which
+    keeps one turn per key running across processes, in order.
+
+    The shared state is only written off the event loop, so `submit` queues the
+    turn for the inbox and returns: a duplicate received by another process is
+    dropped there, in the background, and only a duplicate received by this
+    process makes `submit` return False.
+
+    Turns without a key run under a single key, the name of the queue, so they
+    are also run one at a time across processes. Turns must be JSON
+    serializable. Without `merge`, the turns of a key run one by one instead of
+    being merged.
+
+    Args:
+        handler (coroutine function): Called with each submitted turn.
+        state (SharedState): State shared by the processes.
+        name (str): Name of the queue in the shared state.
+        lease_ttl (float): Lifetime of a lease, in seconds, longer than any turn.
+        poll (float): Seconds between two attempts to take a busy lease.
+        owner (str, optional): Name of the process in leases, its pid by default.
+        **kwargs: Arguments of `TurnQueue`.
+    """
+
+    def __init__(self, handler, state, name, lease_ttl=600, poll=0.2, owner=None, **kwargs):
+        merge = kwargs.get("merge")
+        super().__init__(handler, **kwargs)
+        self.state = state
+        self.name = name
+        self.lease_ttl = lease_ttl
+        self.poll = poll
+        self._owner = owner
+        self._limit = None if merge is not None else 1
+        # Turns submitted but not written to the inbox yet
+        self._inbox = asyncio.Queue()
+
+    @property
+    def owner(self):
+        # Read late, the queue may be created before gunicorn forks the workers
+        return self._owner or str(os.getpid())
+
+    def _lease(self, key):
+        return f"{self.name}:{key}"
+
+    async def start(self):
+        await super().start()
+        self._tasks.append(asyncio.create_task(self._write()))
+
+    async def join(self):
+        while True:
+            await self._inbox.join()
+            await super().join()
+            if self._inbox.empty():
+                return
+
+    def submit(self, turn, message_id=None, key=None):
+        if message_id is not None:
+            if message_id in self._seen:
+                logger.info(f"Duplicate message {message_id} ignored")
+                return False
+            self._seen[message_id] = None
+            if len(self._seen) > self.seen_size:
+                self._seen.popitem(last=False)
+
+        key = key if key is not None else self.name
+        self._inbox.put_nowait((turn, message_id, key))
+        return True
+
+    def qsize(self):
+        return super().qsize() + self._inbox.qsize()
+
+    async def _write(self):
+        # A single writer, so that the turns reach the inbox in submission order
+        while True:
+            turn, message_id, key = await self._inbox.get()
+            try:
+                if message_id is not None and not await self.state.call(
+                    "remember", f"{self.name}:{message_id}"
+                ):
+                    logger.info(f"Duplicate message {message_id} ignored")
+                    continue
+                await self.state.call("push", self.name, key, turn)
+            except Exception:
+                logger.exception(f"Turn of {key} could not be queued, message dropped")
+                continue
+            finally:
+                self._inbox.task_done()
+            # Only a count of the local turns, the turns themselves are in the inbox
+            self._pending.setdefault(key, []).append(None)
+            timer = self._timers.pop(key, None)
+            if timer is not None:
+                timer.cancel()
+            if self.debounce:
+                loop = asyncio.get_running_loop()
+                self._timers[key] = loop.call_later(self.debounce, self._debounced, key)
+            else:
+                self._dispatch(key)
+
+    def _dispatch(self, key):
+        if key in self._running or key in self._timers or key not in self._pending:
+            return
+        # The key is busy from now on, until its lease is released
+        self._running.add(key)
+        asyncio.ensure_future(self._claim(key))
+
+    def _done(self, key):
+        # The key stays busy while the next turns are taken from the inbox
+        asyncio.ensure_future(self._next(key))
+
+    async def _claim(self, key):
+        try:
+            leased = await self.state.call(
+                "acquire_lease", self._lease(key), self.owner, self.lease_ttl
+            )
+        except Exception:
+            logger.exception(f"Lease of {key} could not be taken")
+            leased = False
+        if not leased:
+            # Another process runs the key, and may take our turns with its own
+            self._running.discard(key)
+            if key not in self._timers:
+                loop = asyncio.get_running_loop()
+                self._timers[key] = loop.call_later(self.poll, self._debounced, key)
+            return
+        self._pending.pop(key, None)
+        await self._run_next(key)
+
+    async def _next(self, key):
+        # The lease is still held, turns received meanwhile by any process run next
+        if key not in self._timers:
+            self._pending.pop(key, None)
+            await self._run_next(key)
+        else:
+            await self._release(key)
+
+    async def _run_next(self, key):
+        try:
+            turns = await self.state.call("pop", self.name, key, self._limit)
+        except Exception:
+            logger.exception(f"Turns of {key} could not be taken from the inbox")
+            turns = []
+        if not turns:
+            await self._release(key)
+            return
+        if len(turns) > 1:
+            logger.info(f"{len(turns)} messages of {key} merged into one turn")
+        if not self._put(self.merge(turns), key):
+            self._done(key)
+
+    async def _release(self, key):
+        try:
+            await self.state.call("release_lease", self._lease(key), self.owner)
+        except Exception:
+            # It expires after `lease_ttl`
+            logger.exception(f"Lease of {key} could not be released")
+        self._running.discard(key)
+        # Turns submitted meanwhile waited for the key to be free
+        self._dispatch(key)
+        if not self._pending and not self._running:
+            self._idle.set()
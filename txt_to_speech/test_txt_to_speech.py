@@ -0,0 +1,47 @@
+import asyncio
+import threading
+
+import pytest
+
+from txt_to_speech.txt_to_speech import SpeechSynthesizer
+
+
+class FakePolly:
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.calls = []
+        self.threads = set()
+
+    def __call__(self, text, output_format, language_code, voice):
+        self.calls.append(text)
+        self.threads.add(threading.get_ident())
+        threading.Event().wait(self.delay)
+        return f"{voice}:{text}".encode()
+
+
+@pytest.mark.asyncio
+async def test_same_text_is_synthesized_once_off_the_loop():
+    polly = FakePolly(delay=0.05)
+    speech = SpeechSynthesizer(synthesize=polly)
+
+    keys = await asyncio.gather(speech.speak("Bonjour"), speech.speak("Bonjour"))
+    assert keys[0] == keys[1]
+    assert await speech.speak("Bonjour") == keys[0]
+
+    assert polly.calls == ["Bonjour"]
+    assert threading.get_ident() not in polly.threads
+    assert speech.get(keys[0]) == (b"Lea:Bonjour", "audio/mpeg")
+    assert speech.stats()["hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_least_recently_used_audio_is_evicted_past_max_bytes():
+    speech = SpeechSynthesizer(synthesize=FakePolly(), max_bytes=20)
+    first = await speech.speak("aaaaaa")
+    second = await speech.speak("bbbbbb")
+    speech.get(first)
+    await speech.speak("cccccc")
+
+    assert speech.get(second) is None
+    assert speech.get(first) is not None
+    assert speech.stats()["bytes"] <= 20
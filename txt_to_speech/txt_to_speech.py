@@ -1,34 +1,185 @@
-import tempfile
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
 
-import boto3
+from botocore.exceptions import BotoCoreError, ClientError
 
+from http_clients import clients
+from resilience import CircuitBreaker, Policy
 from utils import load_config
 
 load_config()
 
+logger = logging.getLogger(__name__)
 
-def text_to_speech(text, output_format="mp3", language_code="fr-FR"):
-    # Set up AWS Polly client
-    client = boto3.client(
-        "polly", region_name="us-west-2"
-    )  # Change the region as per your requirements
+# Polly refuses longer texts
+MAX_TEXT_LENGTH = 3000
 
-    # Set up the parameters for the synthesis
-    response = client.synthesize_speech(
-        Text=text, OutputFormat=output_format, VoiceId="Lea", LanguageCode=language_code
+CONTENT_TYPES = {"mp3": "audio/mpeg", "ogg_vorbis": "audio/ogg", "pcm": "audio/pcm"}
+
+
+def is_retryable(error):
+    # Network errors are BotoCoreError, Polly's own errors ClientError
+    if isinstance(error, (asyncio.TimeoutError, BotoCoreError)):
+        return True
+    if isinstance(error, ClientError):
+        return error.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0) >= 500
+    return False
+
+
+# botocore already retries once, the policy only bounds the wait and trips the breaker
+speech_policy = Policy(
+    "polly", timeout=15, retries=0, breaker=CircuitBreaker("polly"), retryable=is_retryable
+)
+
+
+def text_to_speech(text, output_format="mp3", language_code="fr-FR", voice="Lea"):
+    """
+    Synthesize `text` with AWS Polly.
+
+    Returns:
+        bytes: The audio, in `output_format`.
+    """
+    response = clients.polly.synthesize_speech(
+        Text=text, OutputFormat=output_format, VoiceId=voice, LanguageCode=language_code
     )
+    with response["AudioStream"] as stream:
+        return stream.read()
+
+
+class SpeechSynthesizer:
+    """
+    Text to speech off the event loop, keeping the audio in memory.
+
+    Synthesized audio is cached by (text hash, voice, format), so that the same
+    answer is only synthesized once, and served from memory to Twilio through
+    its key. The least recently used audio is evicted once the cache holds more
+    than `max_bytes`.
+
+    With a `SharedState`, the audio is also written to it, as Twilio may fetch
+    it from any of the worker processes of the app.
+
+    Args:
+        synthesize (callable, optional): `synthesize(text, output_format,
+            language_code, voice)` returning the audio. Defaults to Polly.
+        max_bytes (int): Maximum total size of the cached audio.
+        voice (str): Polly voice.
+        language_code (str): Language of the voice.
+        output_format (str): One of CONTENT_TYPES.
+        state (SharedState, optional): Where the audio is shared with the other processes.
+        policy (Policy, optional): Policy of the calls to Polly, `speech_policy` by default.
+    """
+
+    def __init__(
+        self,
+        synthesize=None,
+        max_bytes=20 * 1024 * 1024,
+        voice="Lea",
+        language_code="fr-FR",
+        output_format="mp3",
+        state=None,
+        policy=None,
+    ):
+        self.synthesize = synthesize or text_to_speech
+        self.policy = policy or speech_policy
+        self.max_bytes = max_bytes
+        self.voice = voice
+        self.language_code = language_code
+        self.output_format = output_format
+        self.state = state
+        self._audio = OrderedDict()
+        self._pending = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, text):
+        digest = hashlib.sha256(text.encode()).hexdigest()
+        return f"{digest}-{self.voice}.{self.output_format}"
+
+    async def speak(self, text):
+        """
+        Synthesize `text`, truncated to MAX_TEXT_LENGTH characters.
+
+        Returns:
+            str: Key of the audio, to be passed to `fetch`.
+
+        Raises:
+            asyncio.TimeoutError: If Polly did not answer in time.
+            CircuitOpenError: If Polly has been failing, without calling it.
+        """
+        text = text[:MAX_TEXT_LENGTH]
+        key = self.key(text)
+        if key in self._audio:
+            self._audio.move_to_end(key)
+            self.hits += 1
+            return key
+
+        # Concurrent requests for the same text share the same synthesis
+        task = self._pending.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(
+                self.policy.call(
+                    lambda: asyncio.to_thread(
+                        self.synthesize, text, self.output_format, self.language_code, self.voice
+                    )
+                )
+            )
+            self._pending[key] = task
+        try:
+            audio = await task
+        finally:
+            self._pending.pop(key, None)
+
+        if key not in self._audio:
+            if self.state is not None:
+                # Written under the write lock of the state, off the event loop
+                await self.state.call(
+                    "put_blob", key, audio, CONTENT_TYPES[self.output_format], self.max_bytes
+                )
+            self._audio[key] = audio
+            self.size += len(audio)
+            while self.size > self.max_bytes and len(self._audio) > 1:
+                _, evicted = self._audio.popitem(last=False)
+                self.size -= len(evicted)
+        return key
+
+    def get(self, key):
+        """
+        Returns:
+            tuple: The audio and its content type, None if this process did not cache it.
+        """
+        audio = self._audio.get(key)
+        if audio is None:
+            return None
+        self._audio.move_to_end(key)
+        return audio, CONTENT_TYPES[self.output_format]
 
-    # Save the audio as a temporary file
-    with tempfile.NamedTemporaryFile(suffix=f".{output_format}", delete=False) as f:
-        f.write(response["AudioStream"].read())
-        tmp_audio_file = f.name
+    async def fetch(self, key):
+        """
+        Same as `get`, but also looks for the audio synthesized by the other processes.
+        """
+        entry = self.get(key)
+        if entry is None and self.state is not None:
+            entry = await self.state.call("get_blob", key)
+        return entry
 
-    return tmp_audio_file
+    def stats(self):
+        return {
+            "size": len(self._audio),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
 
 
 if __name__ == "__main__":
     text = "Hello, this is a sample text to be converted to speech using AWS Polly."
     output_format = "mp3"
     language_code = "en-GB"
-    tmp_audio_file = text_to_speech(text, output_format, language_code)
-    print(f"The audio file has been saved to {tmp_audio_file}")
+    audio = text_to_speech(text, output_format, language_code, voice="Amy")
+    with open(f"sample.{output_format}", "wb") as f:
+        f.write(audio)
+    print(f"The audio file has been saved to sample.{output_format}")
@@ -4,16 +4,18 @@ import re
 from pathlib import Path
 from urllib.request import urlopen
 
-import tiktoken
 from dotenv import load_dotenv
 from mutagen.mp3 import MP3
 
-encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
+from tokenizer import DEFAULT_MODEL, get_tokenizer
 
 
-def count_tokens(phrase):
-    n = encoding.encode(phrase)
-    return len(n)
+def count_tokens(phrase, model=DEFAULT_MODEL):
+    return get_tokenizer(model).count(phrase)
+
+
+def count_message_tokens(messages, model=DEFAULT_MODEL):
+    return get_tokenizer(model).count_messages(messages)
 
 
 def get_audio_duration(url):
@@ -37,13 +39,84 @@ def load_config(env_name="DEVELOPMENT"):
     return config
 
 
+SENTENCE_BOUNDARY = re.compile("(?<=[.!?]) +")
+
+
+class SentenceChunker:
+    """
+    Incremental version of `split_long_string` for streamed text.
+
+    Text is fed as it arrives and chunks are returned as soon as they are
+    complete, i.e. when the next sentence would not fit in `max_len`, or, if
+    `flush_len` is set, as soon as a chunk holds at least `flush_len` characters
+    and ends a sentence.
+
+    Args:
+        max_len (int, optional): The maximum length of each chunk. Defaults to 1599.
+        flush_len (int, optional): Length from which a chunk is sent early.
+    """
+
+    def __init__(self, max_len=1599, flush_len=None):
+        self.max_len = max_len
+        self.flush_len = flush_len
+        self._pending = ""
+        self._current_chunk = ""
+
+    def feed(self, text):
+        """
+        Args:
+            text (str): The next piece of the text.
+
+        Returns:
+            list[str]: The chunks completed by this piece.
+        """
+        self._pending += text
+        # Trailing spaces do not end a sentence yet, more of them may follow
+        stripped = self._pending.rstrip(" ")
+        sentences = SENTENCE_BOUNDARY.split(stripped)
+        # The last sentence may still be growing
+        self._pending = sentences.pop() + self._pending[len(stripped) :]
+        result = []
+        for sentence in sentences:
+            result.extend(self._add(sentence))
+        return result
+
+    def close(self):
+        """
+        Returns:
+            list[str]: The remaining chunks once the whole text has been fed.
+        """
+        result = []
+        if self._pending:
+            for sentence in SENTENCE_BOUNDARY.split(self._pending):
+                result.extend(self._add(sentence))
+            self._pending = ""
+        if self._current_chunk:
+            result.append(self._current_chunk.strip())
+            self._current_chunk = ""
+        return result
+
+    def _add(self, sentence):
+        result = []
+        if len(self._current_chunk) + len(sentence) + 1 <= self.max_len:
+            self._current_chunk += " " + sentence
+        else:
+            result.append(self._current_chunk.strip())
+            self._current_chunk = sentence
+
+        if self.flush_len and len(self._current_chunk) >= self.flush_len:
+            result.append(self._current_chunk.strip())
+            self._current_chunk = ""
+        return result
+
+
 def split_long_string(text, max_len=1599):
     """
     Split a long string into a list of strings of maximum length `max_len`.
 
     Args:
         text (str): The input text to be split.
-        max_len (int, optional): The maximum length of each chunk. Defaults to 1200.
+        max_len (int, optional): The maximum length of each chunk. Defaults to 1599.
 
     Returns:
         list[str]: A list of strings, each with a length not exceeding `max_len`.
@@ -51,18 +124,5 @@ def split_long_string(text, max_len=1599):
     if len(text) <= max_len:
         return [text]
 
-    sentences = re.split("(?<=[.!?]) +", text)
-    result = []
-    current_chunk = ""
-
-    for sentence in sentences:
-        if len(current_chunk) + len(sentence) + 1 <= max_len:
-            current_chunk += " " + sentence
-        else:
-            result.append(current_chunk.strip())
-            current_chunk = sentence
-
-    if current_chunk:
-        result.append(current_chunk.strip())
-
-    return result
+    chunker = SentenceChunker(max_len)
+    return chunker.feed(text) + chunker.close()